@@ -0,0 +1,273 @@
+"""
+Benchmarks of the extraction: kernels, pipeline stages and full runs at several cohort sizes.
+
+    python benchmark.py run --output ./output/benchmarks/baseline.json
+    python benchmark.py run --output ./output/benchmarks/current.json --baseline ./output/benchmarks/baseline.json
+    python benchmark.py compare ./output/benchmarks/baseline.json ./output/benchmarks/current.json
+
+The micro suite times the kernels of extraction_utils (binning, interval
+expansion, roll-up, combine, outlier removal, imputation) on synthetic
+tables held in memory: best wall time of --repeat runs and the peak of the
+memory they allocate. The pipeline suite writes a synthetic cache (see
+synthetic.py) for every --sizes entry, runs main.py --offline on it in a
+fresh process and reads back its run report: wall and CPU time and peak
+RSS of the run, and the wall time of every stage.
+
+Results are one JSON file, a flat map of benchmark name to metrics;
+compare flags every wall time or peak memory that grew by more than
+--tolerance over the baseline and exits with 1 when there is any.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from extraction_utils import *
+from extract_database import MIMIC_SOURCE, _bin_events, _code_version, _json
+from synthetic import STAYS_PER_SCALE, mimic_tables, write_cache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# differences below these are noise, whatever the ratio
+MIN_WALL_S = 0.05
+MIN_MB = 5.0
+
+
+def _measure(fn, setup=None, repeat=5):
+    """Best and median wall time of *repeat* calls of fn(*setup()), and the peak MB allocated by one more."""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        t0 = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - t0)
+    args = setup() if setup else ()
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'wall_s': round(min(times), 4), 'wall_median_s': round(float(np.median(times)), 4),
+            'peak_mb': round(peak / 2 ** 20, 1)}
+
+
+def micro_data(scale, seed=0):
+    """Synthetic MIMIC tables and the intermediate frames the kernels work on, built like the pipeline does."""
+    tables = mimic_tables(max(int(round(scale * STAYS_PER_SCALE)), 1), np.random.default_rng(seed))
+    patient = tables['patient'].set_index('stay_id')
+    # hour template of every stay, as in extract_database
+    patient['max_hours'] = (to_bins(patient['icu_outtime'] - patient['icu_intime']) // window_factor(1)).astype(int)
+    hours = range_unnest(patient, 'max_hours', out_col_name='hours_in', reset_index=True)
+    fill_df = patient.reset_index()[ID_COLS].join(hours.set_index('stay_id'), on='stay_id')
+    fill_df = fill_df.set_index(ID_COLS + ['hours_in']).sort_index(level=['stay_id', 'hours_in'])
+    specs = {t['name']: t for t in MIMIC_SOURCE['tables']}
+    binned = {name: _bin_events(MIMIC_SOURCE, specs[name], tables[name].copy(), patient, ('sum', 'count'))
+              for name in ('bg', 'vitalsign', 'chemistry')}
+    rolled = [rollup_events(binned[name], window_factor(1), fill_df) for name in binned]
+    vital = rolled[0].join(rolled[1:])
+    idx = pd.IndexSlice
+    vital.loc[:, idx[:, ['sum', 'count']]] = vital.loc[:, idx[:, ['sum', 'count']]].fillna(0)
+    present = set(vital.columns.get_level_values(0))
+    pairs = [p for p in MIMIC_SOURCE['combine'] if isinstance(p, list) and set(p) <= present]
+    finalized = finalize_aggregates(combine_aggregates(vital.copy(), pairs))
+    mean_col = [c for c in finalized.columns if c[1] == 'mean']
+    names = {c[0] for c in mean_col}
+    low, high = ({k: v for k, v in _json(f).items() if k in names} for f in MIMIC_SOURCE['outliers'])
+    return {'tables': tables, 'patient': patient, 'fill_df': fill_df, 'specs': specs, 'binned': binned,
+            'vital': vital, 'pairs': pairs, 'finalized': finalized, 'mean_col': mean_col,
+            'bounds': compile_outlier_bounds(mean_col, low, high)}
+
+
+def run_micro(scale=5, repeat=5, seed=0):
+    """
+    Time the extraction kernels on a synthetic cohort
+    :param scale: float, cohort size in STAYS_PER_SCALE stays
+    :param repeat: int, timed runs of every kernel
+    :return: dict, 'micro/<kernel>' -> metrics
+    """
+    d = micro_data(scale, seed)
+    patient, fill_df = d['patient'], d['fill_df']
+    interventions = {name: d['tables'][name] for name in ('vent', 'antibiotics', 'vasoactive_norepinephrine',
+                                                          'crystalloid')}
+    windows = {name: interval_hours(df) for name, df in interventions.items()}
+    offsets = stay_offsets(d['finalized'].index, 'stay_id')
+    means = d['finalized'].loc[:, d['mean_col']].to_numpy(dtype=np.float32)
+    low, high = d['bounds']
+    kernels = {
+        'bin_events': (lambda df: _bin_events(MIMIC_SOURCE, d['specs']['vitalsign'], df, patient, ('sum', 'count')),
+                       lambda: (d['tables']['vitalsign'].copy(),)),
+        'bin_events_long': (lambda df: _bin_events(MIMIC_SOURCE, d['specs']['chart_lab'], df, patient,
+                                                   ('sum', 'count')), lambda: (d['tables']['chart_lab'].copy(),)),
+        'rollup_events': (lambda: rollup_events(d['binned']['vitalsign'], window_factor(1), fill_df), None),
+        'interval_hours': (lambda: [interval_hours(df) for df in interventions.values()], None),
+        'assemble_indicators': (lambda: assemble_indicators(fill_df.index, 'stay_id', windows), None),
+        'combine_aggregates': (lambda df: combine_aggregates(df, d['pairs']), lambda: (d['vital'].copy(),)),
+        'finalize_aggregates': (finalize_aggregates, lambda: (d['vital'].copy(),)),
+        'remove_outliers': (lambda df: remove_outliers(df, d['mean_col'], low, high),
+                            lambda: (d['finalized'].copy(),)),
+        'moment_stats': (lambda: moment_stats(d['finalized'].loc[:, d['mean_col']]), None),
+        'impute_ffill': (lambda: impute_segments(means, offsets, 'ffill'), None),
+        'impute_linear': (lambda: impute_segments(means, offsets, 'linear'), None),
+    }
+    results = {}
+    for name, (fn, setup) in kernels.items():
+        results[f'micro/{name}'] = _measure(fn, setup, repeat)
+        print(f"  micro/{name:<22} {results[f'micro/{name}']['wall_s']:8.3f}s  "
+              f"{results[f'micro/{name}']['peak_mb']:8.1f} MB")
+    return results
+
+
+def run_pipeline(size, work_dir, database='MIMIC', seed=0, extra_args=(), verbose=False):
+    """
+    One cold run of main.py --offline over a fresh synthetic cache
+    :param size: float, cohort size in STAYS_PER_SCALE stays
+    :param work_dir: str, directory for the synthetic cache and the outputs, replaced
+    :param extra_args: list, further main.py arguments, e.g. ['--workers', '4']
+    :return: dict, 'pipeline/<stays>' -> run metrics and 'stage/<stays>/<stage>' -> stage metrics
+    """
+    stays = max(int(round(size * STAYS_PER_SCALE)), 1)
+    # main.py runs from this directory
+    work_dir = os.path.abspath(work_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    cache_dir, output_dir = os.path.join(work_dir, 'cache'), os.path.join(work_dir, 'output')
+    write_cache(database, cache_dir, scale=size, seed=seed)
+    cmd = [sys.executable, 'main.py', '--database', database, '--offline', '--cache_dir', cache_dir,
+           '--output_dir', output_dir, *(['--norm_eicu', 'eICU'] if database == 'eICU' else []), *extra_args]
+    print(f"  pipeline/{stays}: {' '.join(cmd[1:])}")
+    env = dict(os.environ, **({} if verbose else {'PYTHONWARNINGS': 'ignore'}))
+    subprocess.run(cmd, cwd=HERE, env=env, check=True, stdout=None if verbose else subprocess.DEVNULL)
+    with open(max(glob.glob(os.path.join(output_dir, 'reports', '*.json')), key=os.path.getmtime)) as f:
+        report = json.load(f)
+    results = {f'pipeline/{stays}': {'wall_s': report['wall_s'], 'cpu_s': report['cpu_s'],
+                                     'peak_rss_mb': report['peak_rss_mb'], 'stays': stays}}
+    # a stage that runs several times (e.g. once per table or group) is summed up
+    for s in report['stages']:
+        entry = results.setdefault(f"stage/{stays}/{s['stage']}", {'wall_s': 0.0, 'peak_rss_mb': 0.0})
+        entry['wall_s'] = round(entry['wall_s'] + s['wall_s'], 3)
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], s['peak_rss_mb'] or 0.0)
+    print(f"  pipeline/{stays}: {report['wall_s']:.1f}s wall, {report['cpu_s']:.1f}s cpu, "
+          f"peak {report['peak_rss_mb']:.0f} MB")
+    return results
+
+
+def scaling_table(results):
+    """Text table of the pipeline runs by cohort size, with the exponent of time and memory between sizes."""
+    runs = sorted((r['stays'], r) for k, r in results.items() if k.startswith('pipeline/'))
+    lines = ['  stays    wall s  s/1k stays  cpu s  peak MB  time exp  mem exp']
+    for i, (stays, r) in enumerate(runs):
+        exp_t = exp_m = '-'
+        if i:
+            prev_stays, prev = runs[i - 1]
+            # 1.0 is linear in the number of stays
+            ratio = np.log(stays / prev_stays)
+            exp_t = f"{np.log(r['wall_s'] / prev['wall_s']) / ratio:.2f}"
+            exp_m = f"{np.log(r['peak_rss_mb'] / prev['peak_rss_mb']) / ratio:.2f}"
+        lines.append(f"  {stays:>6}  {r['wall_s']:8.1f}  {1000 * r['wall_s'] / stays:10.2f}  {r['cpu_s']:5.1f}  "
+                     f"{r['peak_rss_mb']:7.0f}  {exp_t:>8}  {exp_m:>7}")
+    return '\n'.join(lines)
+
+
+def environment():
+    """What the numbers depend on besides the code."""
+    return {'created': datetime.now().isoformat(timespec='seconds'), 'code_version': _code_version(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def compare(baseline, current, tolerance=0.2):
+    """
+    Compare two benchmark files
+    :param baseline: dict, loaded benchmark JSON
+    :param current: dict, loaded benchmark JSON
+    :param tolerance: float, allowed relative growth of wall time and peak memory, e.g. 0.2 for 20%
+    :return: (list, list), text lines of the comparison and the names of the regressed metrics
+    """
+    lines = [f"  {'benchmark':<40} {'metric':<12} {'baseline':>10} {'current':>10} {'ratio':>7}"]
+    regressions = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        base, cur = baseline['results'][name], current['results'][name]
+        for metric, floor in (('wall_s', MIN_WALL_S), ('peak_mb', MIN_MB), ('peak_rss_mb', MIN_MB)):
+            if base.get(metric) is None or cur.get(metric) is None:
+                continue
+            ratio = cur[metric] / base[metric] if base[metric] else np.inf
+            flag = ''
+            if cur[metric] - base[metric] > floor and ratio > 1 + tolerance:
+                flag = 'REGRESSION'
+                regressions.append(f'{name} {metric}')
+            elif base[metric] - cur[metric] > floor and ratio < 1 / (1 + tolerance):
+                flag = 'improved'
+            lines.append(f"  {name:<40} {metric:<12} {base[metric]:10.3f} {cur[metric]:10.3f} {ratio:7.2f}  {flag}")
+    only = set(baseline['results']) ^ set(current['results'])
+    if only:
+        lines.append(f'  ({len(only)} benchmarks in only one of the files not compared)')
+    return lines, regressions
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _report_comparison(baseline, current, tolerance):
+    lines, regressions = compare(baseline, current, tolerance)
+    print('\n'.join(lines))
+    if regressions:
+        print(f'{len(regressions)} regressions beyond {tolerance:.0%}: ' + ', '.join(regressions))
+        return 1
+    print(f'No regressions beyond {tolerance:.0%}')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the METRE extraction")
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='Run the benchmarks and save the results as JSON')
+    run.add_argument("--suite", type=str, nargs='+', default=['micro', 'pipeline'], choices=['micro', 'pipeline'])
+    run.add_argument("--sizes", type=float, nargs='+', default=[1, 10, 100],
+                     help=f'Cohort sizes of the pipeline runs in {STAYS_PER_SCALE} stays')
+    run.add_argument("--micro_scale", type=float, default=5, help=f'Cohort size of the micro suite in '
+                                                                   f'{STAYS_PER_SCALE} stays')
+    run.add_argument("--repeat", type=int, default=5, help='Timed runs of every kernel, the best one counts')
+    run.add_argument("--database", type=str, default='MIMIC', choices=['MIMIC', 'eICU'],
+                     help='Source of the pipeline runs')
+    run.add_argument("--pipeline_args", type=str, default='',
+                     help='Further main.py arguments of the pipeline runs, e.g. "--workers 4 --memory_budget 8"')
+    run.add_argument("--work_dir", type=str, default='./output/benchmarks/work',
+                     help='Synthetic caches and outputs of the pipeline runs (replaced)')
+    run.add_argument("--output", type=str, default='./output/benchmarks/benchmark.json')
+    run.add_argument("--baseline", type=str, default=None, help='Benchmark JSON to compare the results with')
+    run.add_argument("--tolerance", type=float, default=0.2)
+    run.add_argument("--verbose", action='store_true', default=False, help='Show the output of the pipeline runs')
+    cmp = sub.add_parser('compare', help='Compare two benchmark JSON files')
+    cmp.add_argument("baseline", type=str)
+    cmp.add_argument("current", type=str)
+    cmp.add_argument("--tolerance", type=float, default=0.2,
+                     help='Allowed relative growth of wall time and peak memory, e.g. 0.2 for 20%%')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        sys.exit(_report_comparison(_load(args.baseline), _load(args.current), args.tolerance))
+
+    results = {}
+    if 'micro' in args.suite:
+        print(f'Micro benchmarks ({int(args.micro_scale * STAYS_PER_SCALE)} stays, best of {args.repeat})')
+        results.update(run_micro(args.micro_scale, args.repeat))
+    if 'pipeline' in args.suite:
+        print('Pipeline benchmarks')
+        for size in args.sizes:
+            results.update(run_pipeline(size, args.work_dir, args.database, extra_args=args.pipeline_args.split(),
+                                        verbose=args.verbose))
+        print(scaling_table(results))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({**environment(), 'suite': args.suite, 'results': results}, f, indent=2)
+    print(f'Benchmarks -> {args.output}')
+    if args.baseline:
+        sys.exit(_report_comparison(_load(args.baseline), _load(args.output), args.tolerance))
@@ -0,0 +1,146 @@
+"""
+Optional DuckDB engine for the post-cache transformations (--engine duckdb).
+
+The raw event tables cached by extract_database are binned and aggregated
+into the event store with SQL over their parquet files: multi-threaded,
+vectorized, and spilling to disk instead of running out of memory. The
+result is the same store entry aggregate_events builds with pandas.
+duckdb is only imported when the engine is used.
+"""
+import numpy as np
+import pandas as pd
+from extraction_utils import BASE_BIN_MINUTES
+
+
+def connect(memory_limit=None, temp_dir=None, threads=None):
+    """
+    Open an in-memory DuckDB connection for binning the cached raw tables
+    :param memory_limit: int, bytes DuckDB may use before it spills to temp_dir, e.g. from --memory_budget
+    :param temp_dir: str, directory for spilled data
+    :param threads: int, worker threads, all cores if None
+    :return: duckdb.DuckDBPyConnection
+    """
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError('--engine duckdb needs the duckdb package, e.g. pip install duckdb') from e
+    con = duckdb.connect()
+    if memory_limit:
+        con.execute(f"SET memory_limit = '{int(memory_limit // 2 ** 20)}MB'")
+    if temp_dir:
+        con.execute(f"SET temp_directory = '{temp_dir}'")
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    return con
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_aggregate(value, agg):
+    """SQL for one piece of aggregate state of *value*, with the semantics of aggregate_events."""
+    v = _quote(value)
+    if agg == 'sum':
+        return f'coalesce(sum({v}), 0)'
+    if agg == 'count':
+        return f'count({v})'
+    if agg == 'sumsq':
+        return f'coalesce(sum({v} * {v}), 0)'
+    if agg in ('min', 'max'):
+        return f'{agg}({v})'
+    if agg == 'last':
+        # latest charting time, ties go to the later row like a stable sort
+        return f'arg_max({v}, [minutes, rn]) FILTER (WHERE {v} IS NOT NULL)'
+    if agg in ('t_first', 't_last'):
+        return f"{'min' if agg == 't_first' else 'max'}(minutes) FILTER (WHERE {v} IS NOT NULL)"
+    raise ValueError(f'unknown aggregate state {agg}')
+
+
+def bin_events(con, path, source, table, patient, aggs=('sum', 'count'), bin_minutes=BASE_BIN_MINUTES, raw_dir=None):
+    """
+    Bin and aggregate a cached raw event table in SQL, the DuckDB counterpart of _bin_events + aggregate_events
+    :param con: duckdb connection, see connect
+    :param path: str, cached raw parquet of the table
+    :param source: dict, source spec, e.g. MIMIC_SOURCE (id columns, event time, admission anchor, clipping)
+    :param table: dict, table entry of the spec (renames, dropped columns, long format, categorical columns)
+    :param patient: pd.DataFrame, cohort indexed by stay, holds the anchor when the table does not
+    :param aggs: tuple, aggregate state, see aggregate_state
+    :param bin_minutes: int, width of one fine bin in minutes
+    :param raw_dir: str, raw cache directory, where the prep of the table keeps its compiled resource files
+    :return: df: pd.DataFrame, index: id columns + bin, columns: multiindex of value and aggregate state,
+                empty if the raw table is
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if not pq.ParquetFile(path).metadata.num_rows:
+        return pd.DataFrame()
+    aggs = table.get('aggs', aggs)
+    rename = table.get('rename', {})
+    stay_col, time, anchor = source['stay_col'], table.get('time', source['time']), source['anchor']
+    keys = source['id_cols'] + ([table['long']] if 'long' in table else [])
+    if 'prep' in table:
+        # the table is prepared in python first, e.g. chart/lab items named by their LEVEL2 variable
+        df = table['prep'](pd.read_parquet(path).rename(columns=rename), raw_dir)
+        raw = pa.Table.from_pandas(df, preserve_index=False)
+        con.register('raw_events', raw.append_column('file_row_number', pa.array(np.arange(len(df)))))
+        relation, rename = 'raw_events', {}
+    else:
+        relation = f"read_parquet('{path}', file_row_number = true)"
+    described = con.execute(f'DESCRIBE SELECT * FROM {relation}').fetchall()
+    types = {rename.get(name, name): kind for name, kind, *_ in described}
+    columns = {rename.get(name, name): name for name, *_ in described}
+
+    # event times in minutes since admission, from timestamps (MIMIC) or offsets (eICU)
+    join = ''
+    if anchor is None:
+        minutes = f'CAST({_quote(columns[time])} AS DOUBLE)'
+    else:
+        if anchor in columns:
+            start = f'r.{_quote(columns[anchor])}'
+        else:
+            # admission times of the cohort
+            con.register('anchors', patient[[anchor]].reset_index())
+            join = f'LEFT JOIN anchors a ON r.{_quote(columns[stay_col])} = a.{_quote(stay_col)}'
+            start = f'a.{_quote(anchor)}'
+        minutes = f'(epoch_ns(r.{_quote(columns[time])}) - epoch_ns({start})) / 60e9'
+
+    # value columns, object columns other than categories become numbers (unparseable -> NULL)
+    skip = set(keys) | {time, anchor, 'file_row_number'} | set(table.get('drop', []))
+    values = [table['value']] if 'long' in table else \
+        [c for c in columns if c not in skip and not c.startswith('__index_level_')]
+    selected = []
+    for c in values:
+        col = f'r.{_quote(columns[c])}'
+        if c in table.get('categorical', []):
+            selected.append(f'{col} AS {_quote(c)}')
+        elif types[c] == 'VARCHAR':
+            selected.append(f'TRY_CAST({col} AS DOUBLE) AS {_quote(c)}')
+        else:
+            selected.append(f'CAST({col} AS DOUBLE) AS {_quote(c)}')
+
+    bins = f'floor(minutes / {bin_minutes})'
+    if source['clip']:
+        bins = f'CASE WHEN minutes < 0 THEN 0 ELSE {bins} END'
+    state = [(v, a) for v in values for a in aggs]
+    key_list = ', '.join(_quote(k) for k in keys)
+    query = f"""
+        WITH events AS (
+            SELECT {', '.join(f'r.{_quote(columns[k])} AS {_quote(k)}' for k in keys)},
+                   {minutes} AS minutes, r.file_row_number AS rn, {', '.join(selected)}
+            FROM {relation} r {join}
+        ), binned AS (
+            SELECT *, CAST({bins} AS BIGINT) AS bin FROM events
+        )
+        SELECT {key_list}, bin, {', '.join(f'{_sql_aggregate(v, a)} AS s{i}' for i, (v, a) in enumerate(state))}
+        FROM binned
+        WHERE bin IS NOT NULL AND {' AND '.join(f'{_quote(k)} IS NOT NULL' for k in keys)}
+        GROUP BY {key_list}, bin
+        ORDER BY {key_list}, bin
+    """
+    df = con.execute(query).fetch_arrow_table().to_pandas()
+    for name in ('raw_events', 'anchors'):
+        con.unregister(name)
+    df = df.set_index(keys + ['bin'])
+    df.columns = pd.MultiIndex.from_tuples(state)
+    return df
@@ -1,16 +1,20 @@
-# Set up Google big query
-from google.cloud import bigquery
 import os
+import ast
+import copy
 import json
+import hashlib
+import multiprocessing
 import pickle
 import numpy as np
 import pandas as pd
 from extraction_utils import *
 from extract_sql import *
+from run_report import RunReport, rss_mb, stage as report_stage
 
 # Note: For local execution, authenticate via:
 #   gcloud auth application-default login
 # The BigQuery client will automatically use these credentials.
+# google-cloud-bigquery is only imported when a run queries BigQuery (not with --offline).
 
 
 # ---------------------------------------------------------------------------
@@ -24,26 +28,61 @@ def cached_query(cache_dir, name, query_fn, *args, force=False, **kwargs):
     BigQuery, unless *force* is True.
     """
     path = os.path.join(cache_dir, f"{name}.parquet")
-    if not force and os.path.exists(path):
-        print(f"  [CACHE HIT]  {name}  <-  {path}")
-        return pd.read_parquet(path)
-    print(f"  [QUERYING]   {name}  from BigQuery ...")
-    df = query_fn(*args, **kwargs)
-    os.makedirs(cache_dir, exist_ok=True)
-    df.to_parquet(path)
-    print(f"  [CACHED]     {name}  ->  {path}")
-    return df
+    with report_stage(f'query/{name}') as st:
+        if not force and os.path.exists(path):
+            print(f"  [CACHE HIT]  {name}  <-  {path}")
+            st.status = 'cached'
+            df = pd.read_parquet(path)
+            st.output(df)
+            return df
+        print(f"  [QUERYING]   {name}  from BigQuery ...")
+        try:
+            df = query_fn(*args, **kwargs)
+        except OfflineError:
+            raise OfflineError(f"{name} is not cached ({path}) and --offline does not query BigQuery, write the "
+                               f"cache with synthetic.py or run once without --offline") from None
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(path)
+        st.output(df)
+        st.written(path)
+        print(f"  [CACHED]     {name}  ->  {path}")
+        return df
+
+
+class OfflineError(RuntimeError):
+    """A query result that is not cached was needed in an --offline run."""
+
+
+class OfflineClient:
+    """Stands in for the BigQuery client with --offline, every query must be answered by the cache."""
+
+    def query(self, sql, job_config=None):
+        raise OfflineError('--offline does not query BigQuery')
+
+
+def _client(args):
+    """BigQuery client of the billing project, or an OfflineClient with --offline."""
+    if getattr(args, 'offline', False):
+        if args.force_query:
+            raise ValueError('--force_query re-queries BigQuery, it cannot be used with --offline')
+        return OfflineClient()
+    from google.cloud import bigquery
+    os.environ["GOOGLE_CLOUD_PROJECT"] = args.project_id
+    return bigquery.Client(project=args.project_id)
 
 
 def _save_params(cache_dir, args):
-    """Persist the extraction parameters so we can detect mismatches later."""
+    """Persist the extraction parameters so we can detect mismatches later.
+
+    The time window is not part of them: raw tables and the event store are
+    window independent, window-specific outputs live in their own directories.
+    Neither is the patient group, every group is filtered from the same cohort.
+    """
     params = {
         'database': args.database,
-        'patient_group': args.patient_group,
         'age_min': args.age_min,
         'los_min': args.los_min,
         'los_max': args.los_max,
-        'time_window': args.time_window,
     }
     os.makedirs(cache_dir, exist_ok=True)
     path = os.path.join(cache_dir, '_params.json')
@@ -60,11 +99,9 @@ def _check_params(cache_dir, args):
         cached = json.load(f)
     current = {
         'database': args.database,
-        'patient_group': args.patient_group,
         'age_min': args.age_min,
         'los_min': args.los_min,
         'los_max': args.los_max,
-        'time_window': args.time_window,
     }
     if cached != current:
         print("WARNING: Cached data was generated with different parameters!")
@@ -73,956 +110,1157 @@ def _check_params(cache_dir, args):
         print("  Use --force_query to re-extract, or delete the cache directory.\n")
 
 
-def extract_mimic(args):
-    os.environ["GOOGLE_CLOUD_PROJECT"] = args.project_id
-    client = bigquery.Client(project=args.project_id)
-    # MIMIC-IV id
-    ID_COLS = ['subject_id', 'hadm_id', 'stay_id']
-    # datatime format to hour
-    to_hours = lambda x: max(0, x.days * 24//args.time_window + x.seconds // (3600 * args.time_window))
+def cached_store(store_dir, name, build_fn, *args, force=False, **kwargs):
+    """Build an event-store entry with *build_fn* and cache it as parquet.
 
-    # --- cache setup ---
-    raw_dir = os.path.join(args.cache_dir, f"MIMIC_{args.patient_group}", "raw")
-    force = args.force_query
-    _check_params(os.path.join(args.cache_dir, f"MIMIC_{args.patient_group}"), args)
-    _save_params(os.path.join(args.cache_dir, f"MIMIC_{args.patient_group}"), args)
-
-    # get group id, could be sepsis3, ARF, shock, COPD, CHF
-    patient = cached_query(raw_dir, 'patient', get_patient_group, args, client, force=force)
-    print("Patient icu info query done, start querying variables in Dynamic table")
-    # get icu stay id and subject id
-    icuids_to_keep = patient['stay_id']
-    icuids_to_keep = set([str(s) for s in icuids_to_keep])
-    subject_to_keep = patient['subject_id']
-    subject_to_keep = set([str(s) for s in subject_to_keep])
-    # create template fill_df with time window for each stay based on icu in/out time
-    patient.set_index('stay_id', inplace=True)
-    patient['max_hours'] = (patient['icu_outtime'] - patient['icu_intime']).apply(to_hours)
-    missing_hours_fill = range_unnest(patient, 'max_hours', out_col_name='hours_in', reset_index=True)
-    missing_hours_fill['tmp'] = np.NaN
-    fill_df = patient.reset_index()[ID_COLS].join(missing_hours_fill.set_index('stay_id'), on='stay_id')
-    fill_df.set_index(ID_COLS + ['hours_in'], inplace=True)
-
-    # start with mimic_derived_data
-    # query bg table
-    bg = cached_query(raw_dir, 'bg', query_bg_mimic, client, subject_to_keep, force=force)
-    # initial process bg table
-    bg['hours_in'] = (bg['charttime'] - bg['icu_intime']).apply(to_hours)
-    bg.drop(columns=['charttime', 'icu_intime', 'aado2_calc', 'specimen'], inplace=True) # aado2_calc, specimen not used
-    bg = process_query_results(bg, fill_df)
-
-    # query vital sign
-    vitalsign = cached_query(raw_dir, 'vitalsign', query_vitals_mimic, client, icuids_to_keep, force=force)
-    # temperature/glucose is a repeat name but different itemid, rename for now and combine later
-    vitalsign.rename(columns={'temperature': 'temp_vital'}, inplace=True)
-    vitalsign.rename(columns={'glucose': 'glucose_vital'}, inplace=True)
-    vitalsign['hours_in'] = (vitalsign['charttime'] - vitalsign['icu_intime']).apply(to_hours)
-    vitalsign.drop(columns=['charttime', 'icu_intime', 'temperature_site'], inplace=True) # temperature_site is not used
-    vitalsign = process_query_results(vitalsign, fill_df)
-
-    # query blood differential
-    blood_diff = cached_query(raw_dir, 'blood_diff', query_blood_diff_mimic, client, subject_to_keep, force=force)
-    blood_diff['hours_in'] = (blood_diff['charttime'] - blood_diff['icu_intime']).apply(to_hours)
-    blood_diff.drop(columns=['charttime', 'icu_intime', 'specimen_id'], inplace=True)
-    blood_diff = process_query_results(blood_diff, fill_df)
-
-    # query cardiac marker
-    cardiac_marker = cached_query(raw_dir, 'cardiac_marker', query_cardiac_marker_mimic, client, subject_to_keep, force=force)
-    cardiac_marker['troponin_t'].replace(to_replace=[None], value=np.nan, inplace=True)
-    cardiac_marker['troponin_t'] = pd.to_numeric(cardiac_marker['troponin_t'])
-    cardiac_marker['hours_in'] = (cardiac_marker['charttime'] - cardiac_marker['icu_intime']).apply(to_hours)
-    cardiac_marker.drop(columns=['charttime', 'icu_intime', 'specimen_id'], inplace=True)
-    cardiac_marker = process_query_results(cardiac_marker, fill_df)
-
-    # query chemistry
-    chemistry = cached_query(raw_dir, 'chemistry', query_chemistry_mimic, client, subject_to_keep, force=force)
-    # rename glucose into glucose_chem and others
-    chemistry.rename(columns={'glucose': 'glucose_chem'}, inplace=True)
-    chemistry.rename(columns={'bicarbonate': 'bicarbonate_chem'}, inplace=True)
-    chemistry.rename(columns={'chloride': 'chloride_chem'}, inplace=True)
-    chemistry.rename(columns={'calcium': 'calcium_chem'}, inplace=True)
-    chemistry.rename(columns={'potassium': 'potassium_chem'}, inplace=True)
-    chemistry.rename(columns={'sodium': 'sodium_chem'}, inplace=True)
-    chemistry['hours_in'] = (chemistry['charttime'] - chemistry['icu_intime']).apply(to_hours)
-    chemistry.drop(columns=['charttime', 'icu_intime', 'specimen_id'], inplace=True)
-    chemistry = process_query_results(chemistry, fill_df)
-
-    # query coagulation
-    coagulation = cached_query(raw_dir, 'coagulation', query_coagulation_mimic, client, subject_to_keep, force=force)
-    coagulation['hours_in'] = (coagulation['charttime'] - coagulation['icu_intime']).apply(to_hours)
-    coagulation.drop(columns=['charttime', 'icu_intime', 'specimen_id'], inplace=True)
-    coagulation = process_query_results(coagulation, fill_df)
-
-    # query cbc
-    cbc = cached_query(raw_dir, 'cbc', query_cbc_mimic, client, subject_to_keep, force=force)
-    cbc.rename(columns={'hematocrit': 'hematocrit_cbc'}, inplace=True)
-    cbc.rename(columns={'hemoglobin': 'hemoglobin_cbc'}, inplace=True)
-    # also drop wbc since it's a repeat 51301
-    cbc['hours_in'] = (cbc['charttime'] - cbc['icu_intime']).apply(to_hours)
-    cbc.drop(columns=['charttime', 'icu_intime', 'specimen_id', 'wbc'], inplace=True)
-    cbc = process_query_results(cbc, fill_df)
-
-    # query culture
-    culture = cached_query(raw_dir, 'culture', query_culture_mimic, client, subject_to_keep, force=force)
-    # MIMIC-IV 3.1: culture table no longer exists, query returns empty DataFrame
-    # Create placeholder with expected structure when skipped
-    if culture.empty:
-        # Create empty culture DataFrame with expected multi-level columns
-        # Use float dtype for numeric indicators so pd.get_dummies won't consume them
-        culture_cols = pd.MultiIndex.from_tuples([
-            ('specimen_culture', 'last'),
-            ('screen', 'last'),
-            ('positive_culture', 'last'),
-            ('has_sensitivity', 'last')
-        ])
-        culture = pd.DataFrame(index=fill_df.index, columns=culture_cols)
-        culture[('screen', 'last')] = culture[('screen', 'last')].astype(float)
-        culture[('positive_culture', 'last')] = culture[('positive_culture', 'last')].astype(float)
-        culture[('has_sensitivity', 'last')] = culture[('has_sensitivity', 'last')].astype(float)
-    else:
-        culture.rename(columns={'specimen': 'specimen_culture'}, inplace=True)
-        culture['hours_in'] = (culture['charttime'] - culture['icu_intime']).apply(to_hours)
-        culture.drop(columns=['charttime', 'icu_intime'], inplace=True)
-        culture = culture.groupby(ID_COLS + ['hours_in']).agg(['last'])
-        culture = culture.reindex(fill_df.index)
-
-    # query enzyme
-    enzyme = cached_query(raw_dir, 'enzyme', query_enzyme_mimic, client, subject_to_keep, force=force)
-    # also drop ck_mb since it's a repeat 50911
-    enzyme['hours_in'] = (enzyme['charttime'] - enzyme['icu_intime']).apply(to_hours)
-    enzyme.drop(columns=['charttime', 'icu_intime', 'specimen_id', 'ck_mb'], inplace=True)
-    enzyme = process_query_results(enzyme, fill_df)
-
-    # query gcs
-    gcs = cached_query(raw_dir, 'gcs', query_gcs_mimic, client, icuids_to_keep, force=force)
-    gcs['hours_in'] = (gcs['charttime'] - gcs['icu_intime']).apply(to_hours)
-    gcs.drop(columns=['charttime', 'icu_intime'], inplace=True)
-    gcs = process_query_results(gcs, fill_df)
-
-    # query inflammation
-    inflammation = cached_query(raw_dir, 'inflammation', query_inflammation_mimic, client, subject_to_keep, force=force)
-    inflammation['hours_in'] = (inflammation['charttime'] - inflammation['icu_intime']).apply(to_hours)
-    inflammation.drop(columns=['charttime', 'icu_intime'], inplace=True)
-    inflammation = process_query_results(inflammation, fill_df)
-
-    # query uo
-    uo = cached_query(raw_dir, 'uo', query_uo_mimic, client, icuids_to_keep, force=force)
-    uo['hours_in'] = (uo['charttime'] - uo['icu_intime']).apply(to_hours)
-    uo.drop(columns=['charttime', 'icu_intime'], inplace=True)
-    uo = process_query_results(uo, fill_df)
-
-    # join and save
-    # use MIMIC-Extract way to query other itemids that was present in MIMIC-Extract
-    # load resources
-    chartitems_to_keep = pd.read_excel('./resources/chartitems_to_keep_0505.xlsx')
-    lab_to_keep = pd.read_excel('./resources/labitems_to_keep_0505.xlsx')
-    var_map = pd.read_csv('./resources/Chart_makeup_0505 - var_map0505.csv')
-    chart_items = chartitems_to_keep['chartitems_to_keep'].tolist()
-    lab_items = lab_to_keep['labitems_to_keep'].tolist()
-    chart_items = set([str(i) for i in chart_items])
-    lab_items = set([str(i) for i in lab_items])
-
-    # additional chart and lab
-    chart_lab = cached_query(raw_dir, 'chart_lab', query_chart_lab_mimic, client, icuids_to_keep, chart_items, lab_items, force=force)
-    chart_lab['value'] = pd.to_numeric(chart_lab['value'], 'coerce')
-    chart_lab = chart_lab.set_index('stay_id').join(patient[['icu_intime']])
-    chart_lab['hours_in'] = (chart_lab['charttime'] - chart_lab['icu_intime']).apply(to_hours)
-    chart_lab.drop(columns=['charttime', 'icu_intime', 'valueuom'], inplace=True)  # valueuom is string, can't aggregate
-    chart_lab.set_index('itemid', append=True, inplace=True)
-    var_map.set_index('itemid', inplace=True)
-    chart_lab = chart_lab.join(var_map, on='itemid').set_index(['LEVEL1', 'LEVEL2'], append=True)
-    chart_lab.index.names = ['stay_id', chart_lab.index.names[1], chart_lab.index.names[2], chart_lab.index.names[3]]
-    group_item_cols = ['LEVEL2']
-    chart_lab = chart_lab.groupby(ID_COLS + group_item_cols + ['hours_in']).agg(['mean', 'count'])
-
-    chart_lab.columns = chart_lab.columns.droplevel(0)
-    chart_lab.columns.names = ['Aggregation Function']
-    chart_lab = chart_lab.unstack(level=group_item_cols)
-    chart_lab.columns = chart_lab.columns.reorder_levels(order=group_item_cols + ['Aggregation Function'])
-
-    chart_lab = chart_lab.reindex(fill_df.index)
-    chart_lab = chart_lab.sort_index(axis=1, level=0)
-    new_cols = chart_lab.columns.reindex(['mean', 'count'], level=1)
-    chart_lab = chart_lab.reindex(columns=new_cols[0])
-
-    # join all dataframes
-    total = bg.join(
-        [vitalsign, blood_diff, cardiac_marker, chemistry, coagulation, cbc, culture, enzyme, gcs, inflammation, uo])
-
-    # start combining and drop some columns either due to redundancy or not well-populated
-    # drop some columns (not well-populated or already dependent on existing columns )
-    columns_to_drop = ['rdwsd', 'aado2', 'pao2fio2ratio', 'carboxyhemoglobin',
-                       'methemoglobin', 'globulin', 'd_dimer', 'thrombin', 'basophils_abs', 'eosinophils_abs',
-                       'lymphocytes_abs', 'monocytes_abs', 'neutrophils_abs']
-    for c in columns_to_drop:
-        total.drop(c, axis=1, level=0, inplace=True)
-
-    idx = pd.IndexSlice
-    chart_lab.loc[:, idx[:, ['count']]] = chart_lab.loc[:, idx[:, ['count']]].fillna(0)
-    total.loc[:, idx[:, ['count']]] = total.loc[:, idx[:, ['count']]].fillna(0)
-
-    # combine columns since they were from different itemids but have the same semantics
-    names_to_combine = [
-        ['so2', 'spo2'], ['fio2', 'fio2_chartevents'], ['bicarbonate', 'bicarbonate_chem'],
-        ['hematocrit', 'hematocrit_cbc'], ['hemoglobin', 'hemoglobin_cbc'], ['chloride', 'chloride_chem'],
-        ['glucose', 'glucose_chem'], ['glucose', 'glucose_vital'],
-        ['temperature', 'temp_vital'], ['sodium', 'sodium_chem'], ['potassium', 'potassium_chem']
-    ]
-    for names in names_to_combine:
-        original = total.loc[:, idx[names[0], ['mean', 'count']]].copy(deep=True)
-        makeups = total.loc[:, idx[names[1], ['mean', 'count']]].copy(deep=True)
-        filled = combine_cols(makeups, original)
-        total.loc[:, idx[names[0], ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-        total.drop(names[1], axis=1, level=0, inplace=True)
-
-    # MIMIC-IV 3.1: Only do culture site mapping if culture data was actually extracted
-    # (culture table no longer exists in v3.1, so specimen_culture will be all NaN)
-    if not total[('specimen_culture', 'last')].isna().all():
-        with open('./json_files/mimic_culturesite_map.json') as f:
-            csite_map = json.load(f)
-        total.loc[:, idx['specimen_culture', ['last']]] = pd.Series(
-            np.squeeze(total.loc[:, idx['specimen_culture', ['last']]].values)).map(csite_map).values
-
-    # drop Eosinophils
-    chart_lab.drop('Eosinophils', axis=1, level=0, inplace=True)
-    # combine in chart_lab table
-    names = ['Phosphate', 'Phosphorous']
-    original = chart_lab.loc[:, idx[names[0], ['mean', 'count']]].copy(deep=True)
-    makeups = chart_lab.loc[:, idx[names[1], ['mean', 'count']]].copy(deep=True)
-    filled = combine_cols(makeups, original)
-    chart_lab.loc[:, idx[names[0], ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-    chart_lab.drop(names[1], axis=1, level=0, inplace=True)
-
-    names = ['Potassium', 'Potassium serum']
-    original = chart_lab.loc[:, idx[names[0], ['mean', 'count']]].copy(deep=True)
-    makeups = chart_lab.loc[:, idx[names[1], ['mean', 'count']]].copy(deep=True)
-    filled = combine_cols(makeups, original)
-    chart_lab.loc[:, idx[names[0], ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-    chart_lab.drop(names[1], axis=1, level=0, inplace=True)
-
-    # Combine between chartlab and total table
-    with open('./json_files/mimic_to_combine_1.json') as f:
-        names_list = json.load(f)
-    for names in names_list:
-        original = total.loc[:, idx[names[0], ['mean', 'count']]].copy(deep=True)
-        makeups = chart_lab.loc[:, idx[names[1], ['mean', 'count']]].copy(deep=True)
-        filled = combine_cols(makeups, original)
-        total.loc[:, idx[names[0], ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-        chart_lab.drop(names[1], axis=1, level=0, inplace=True)
-
-    # In eicu mbp contains both invasive and non-invasive, so combine them for mimic_iv
-    names_list = [['dbp', 'Diastolic blood pressure'], ['dbp_ni', 'Diastolic blood pressure'],
-                  ['mbp', 'Mean blood pressure'], ['mbp_ni', 'Mean blood pressure'],
-                  ['sbp', 'Systolic blood pressure'], ['sbp_ni', 'Systolic blood pressure']]
-    for names in names_list:
-        original = total.loc[:, idx[names[0], ['count', 'mean']]].copy(deep=True)
-        makeups = chart_lab.loc[:, idx[names[1], ['count', 'mean']]].copy(deep=True)
-        filled = combine_cols(makeups, original)
-        total.loc[:, idx[names[0], ['count', 'mean']]] = filled.loc[:, ['count', 'mean']].values
-        # Xm.drop(names[1], axis=1, level=0, inplace=True)
-    chart_lab.drop('Mean blood pressure', axis=1, level=0, inplace=True)
-    chart_lab.drop('Diastolic blood pressure', axis=1, level=0, inplace=True)
-    chart_lab.drop('Systolic blood pressure', axis=1, level=0, inplace=True)
-
-    with open('./json_files/mimic_to_drop_1.json') as f:
-        columns_to_drop = json.load(f)
-    for c in columns_to_drop:
-        chart_lab.drop(c, axis=1, level=0, inplace=True)
-    vital = total.join(chart_lab)
-    # Done dropping and combining
-
-    # screen and positive culture needs impute, they are last columns but with float data type
-    vital_encode = pd.get_dummies(vital)
-    # When culture is skipped (all NaN), pd.get_dummies creates no dummy columns
-    # and the MultiIndex is preserved.  Flatten to a regular Index of tuples so
-    # that downstream string-keyed culture-site columns can be added correctly.
-    if isinstance(vital_encode.columns, pd.MultiIndex):
-        vital_encode.columns = vital_encode.columns.to_flat_index()
-
-    # MIMIC-IV 3.1: Culture columns may be all NaN if culture table was skipped
-    # Create mask columns (will be all 0 if culture data was skipped)
-    vital_encode[('positive_culture', 'mask')] = (~vital_encode[('positive_culture', 'last')].isnull()).astype(float)
-    vital_encode[('screen', 'mask')] = (~vital_encode[('screen', 'last')].isnull()).astype(float)
-    vital_encode[('has_sensitivity', 'mask')] = (~vital_encode[('has_sensitivity', 'last')].isnull()).astype(float)
-    # X_encode.fillna(value=0, inplace=True)
-    # vital_encode.fillna(value=0, inplace=True)
-
-    col = vital_encode.columns.to_list()
-    col.insert(col.index(('screen', 'last')) + 1, ('screen', 'mask'))
-    col.insert(col.index(('positive_culture', 'last')) + 1, ('positive_culture', 'mask'))
-    col.insert(col.index(('has_sensitivity', 'last')) + 1, ('has_sensitivity', 'mask'))
-
-    vital_final = vital_encode[col[:-3]].copy()
-
-    # check if any culture site is missing and fill in empty
-    # MIMIC-IV 3.1: If culture was skipped, all 14 sites will be missing - add them all as zeros
-    col_encode = [str(c) for c in vital_final.columns.to_list()]
-    csite_col = [int(i.split('cul_site')[-1]) for i in col_encode if "cul_site" in i]
-    if len(csite_col) < 14:
-        # find out which is missing
-        missing_site = [i for i in range(14) if i not in csite_col]
-        missing_col_name = ["('specimen_culture', 'last')_cul_site" + str(i) for i in missing_site]
-        for col in missing_col_name:
-            vital_final[col] = 0
-    with open('./json_files/mimic_col_order.json') as f:
-        mimic_col_order_raw = json.load(f)
-    mimic_col_order = [tuple(c) if isinstance(c, list) else c for c in mimic_col_order_raw]
-    vital_final = vital_final[mimic_col_order]
-    print('Start querying variables in the Intervention table')
-    ####### Done vital table #######
-
-    # start query intervention
-    vent_data = cached_query(raw_dir, 'vent', query_vent_mimic, client, icuids_to_keep, force=force)
-    vent_data = compile_intervention(vent_data, 'vent', args.time_window)
-
-    ids_with = vent_data['stay_id']
-    ids_with = set(map(int, ids_with))
-    ids_all = set(map(int, icuids_to_keep))
-    ids_without = (ids_all - ids_with)
-    novent_data = patient.copy(deep=True)
-    novent_data = novent_data.reset_index()
-    novent_data = novent_data.set_index('stay_id')
-    novent_data = novent_data.iloc[novent_data.index.isin(ids_without)]
-    novent_data = novent_data.reset_index()
-    novent_data = novent_data[['subject_id', 'hadm_id', 'stay_id', 'max_hours']]
-    # novent_data['max_hours'] = novent_data['stay_id'].map(icustay_timediff)
-    novent_data = novent_data.groupby('stay_id')
-    novent_data = novent_data.apply(add_blank_indicators)
-    novent_data.rename(columns={'on': 'vent'}, inplace=True)
-    novent_data = novent_data.reset_index()
-
-    # Concatenate all the data vertically
-    intervention = pd.concat([vent_data[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'vent']],
-                              novent_data[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'vent']]],
-                             axis=0)
-
-    # query antibiotics
-    antibiotics = cached_query(raw_dir, 'antibiotics', query_antibiotics_mimic, client, icuids_to_keep, force=force)
-    antibiotics = compile_intervention(antibiotics, 'antibiotics', args.time_window)
-    intervention = intervention.merge(
-        antibiotics[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'antibiotic', 'route']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # vaso agents
-    column_names = ['dopamine', 'epinephrine', 'norepinephrine', 'phenylephrine', 'vasopressin', 'dobutamine',
-                    'milrinone']
-    for c in column_names:
-        # TOTAL VASOPRESSOR DATA
-        new_data = cached_query(raw_dir, f'vasoactive_{c}', query_vasoactive_mimic, client, icuids_to_keep, c, force=force)
-        new_data = compile_intervention(new_data, c, args.time_window)
-        intervention = intervention.merge(
-            new_data[['subject_id', 'hadm_id', 'stay_id', 'hours_in', c]],
-            on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-            how='left'
-        )
-
-    # heparin (stubbed in MIMIC-IV 3.1 -- table no longer exists)
-    heparin = cached_query(raw_dir, 'heparin', query_heparin_mimic, client, subject_to_keep, force=force)
-    if heparin.empty:
-        heparin = pd.DataFrame(columns=['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'heparin'])
-    else:
-        heparin = compile_intervention(heparin, 'heparin', args.time_window)
-    intervention = intervention.merge(
-        heparin[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'heparin']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # crrt
-    crrt = cached_query(raw_dir, 'crrt', query_crrt_mimic, client, icuids_to_keep, force=force)
-    crrt = compile_intervention(crrt, 'crrt', args.time_window)
-    intervention = intervention.merge(
-        crrt[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'crrt']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # rbc transfusion
-    rbc_trans = cached_query(raw_dir, 'rbc_trans', query_rbc_trans_mimic, client, icuids_to_keep, force=force)
-    rbc_trans = compile_intervention(rbc_trans, 'rbc_trans', args.time_window)
-    intervention = intervention.merge(
-        rbc_trans[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'rbc_trans']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # platelets transfusion
-    platelets_trans = cached_query(raw_dir, 'pll_trans', query_pll_trans_mimic, client, icuids_to_keep, force=force)
-    platelets_trans = compile_intervention(platelets_trans, 'platelets_trans', args.time_window)
-    intervention = intervention.merge(
-        platelets_trans[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'platelets_trans']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # ffp transfusion
-    ffp_trans = cached_query(raw_dir, 'ffp_trans', query_ffp_trans_mimic, client, icuids_to_keep, force=force)
-    ffp_trans = compile_intervention(ffp_trans, 'ffp_trans', args.time_window)
-    intervention = intervention.merge(
-        ffp_trans[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'ffp_trans']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # other infusion
-    colloid_bolus = cached_query(raw_dir, 'colloid', query_colloid_mimic, client, icuids_to_keep, force=force)
-    colloid_bolus = compile_intervention(colloid_bolus, 'colloid_bolus', args.time_window)
-    intervention = intervention.merge(
-        colloid_bolus[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'colloid_bolus']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left'
-    )
-
-    # other infusion
-    crystalloid_bolus = cached_query(raw_dir, 'crystalloid', query_crystalloid_mimic, client, icuids_to_keep, force=force)
-    crystalloid_bolus = compile_intervention(crystalloid_bolus, 'crystalloid_bolus', args.time_window)
-    intervention = intervention.merge(
-        crystalloid_bolus[['subject_id', 'hadm_id', 'stay_id', 'hours_in', 'crystalloid_bolus']],
-        on=['subject_id', 'hadm_id', 'stay_id', 'hours_in'],
-        how='left')
-
-    # Process the Intervention table
-    intervention.drop('route', axis=1, inplace=True) # drop route column
-    # for each column, astype to int and fill na with 0
-    intervention = intervention.fillna(0)
-    intervention.loc[:, 'antibiotic'] = intervention.loc[:, 'antibiotic'].mask(intervention.loc[:, 'antibiotic'] != 0,
-                                                                               1).values
-    for i in range(5, 20):
-        intervention.iloc[:, i] = intervention.iloc[:, i].astype(int)
-    intervention.set_index(ID_COLS + ['hours_in'], inplace=True)
-    intervention.sort_index(level=['stay_id', 'hours_in'], inplace=True)
-    # Finish processing the Intervention table
-    print('Start querying variables in the Static table')
+    Store entries are aggregated at BASE_BIN_MINUTES resolution and do not
+    depend on --time_window, so every window is rolled up from the same files.
+    *force* is passed on to *build_fn* so the raw tables are re-queried too.
+    *build_fn* may also yield the entry in slices (--memory_budget), which are
+    written one by one and never concatenated; None is returned then.
+    """
+    path = os.path.join(store_dir, f"{name}.parquet")
+    if not force and os.path.exists(path):
+        print(f"  [STORE HIT]  {name}  <-  {path}")
+        return pd.read_parquet(path)
+    print(f"  [BINNING]    {name}  into {BASE_BIN_MINUTES}-minute bins ...")
+    with report_stage(f'bin/{name}') as st:
+        df = build_fn(*args, force=force, **kwargs)
+        os.makedirs(store_dir, exist_ok=True)
+        if isinstance(df, pd.DataFrame):
+            df.to_parquet(path)
+            st.output(df)
+        else:
+            _write_slices(df, path)
+            df = None
+        st.written(path)
+    print(f"  [STORED]     {name}  ->  {path}")
+    return df
 
-    # static info
-    #  query patients anchor year and comorbidity
-    anchor_year = cached_query(raw_dir, 'anchor_year', query_anchor_year_mimic, client, icuids_to_keep, force=force)
-    comorbidity = cached_query(raw_dir, 'comorbidity', query_comorbidity_mimic, client, icuids_to_keep, force=force)
-    patient.reset_index(inplace=True)
-    patient.set_index(ID_COLS, inplace=True)
-    comorbidity.set_index(ID_COLS, inplace=True)
-    anchor_year.set_index(ID_COLS, inplace=True)
-    static = patient.join([comorbidity, anchor_year['anchor_year_group']])
-
-    if args.exit_point == 'Raw':
-        print('Exit point is after querying raw records, saving results...')
-        os.makedirs(args.output_dir, exist_ok=True)
-        vital_final.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_vital.parquet'))
-        static.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_static.parquet'))
-        intervention.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_inv.parquet'))
-        return
 
-    # remove outliers
-    total_cols = vital_final.columns.tolist()
-    mean_col = [i for i in total_cols if 'mean' in i]
-    X_mean = vital_final.loc[:, mean_col]
+# ---------------------------------------------------------------------------
+# Stage checkpoints -- every stage output is persisted under a fingerprint of
+# its inputs, parameters and the code version, so runs resume where they can
+# ---------------------------------------------------------------------------
 
-    if not args.no_removal:
-        print('Performing outlier removal')
-        with open("./json_files/mimic_outlier_high.json") as f:
-            range_dict_high  = json.load(f)
-        with open("./json_files/mimic_outlier_low.json") as f:
-            range_dict_low = json.load(f)
-        for var_to_remove in range_dict_high:
-            remove_outliers_h(vital_final, X_mean, var_to_remove, range_dict_high[var_to_remove])
-        for var_to_remove in range_dict_low:
-            remove_outliers_l(vital_final, X_mean, var_to_remove, range_dict_low[var_to_remove])
-    else:
-        print('Skipped outlier removal')
-
-    if args.exit_point == 'Outlier_removal':
-        print('Exit point is after removing outliers, saving results...')
-        os.makedirs(args.output_dir, exist_ok=True)
-        vital_final.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_vital.parquet'))
-        static.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_static.parquet'))
-        intervention.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_inv.parquet'))
-        return
+def _code_version():
+    """Hash of the extraction code and its json configs, part of every stage fingerprint."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    files = ['extract_database.py', 'extraction_utils.py', 'extract_sql.py']
+    files += sorted(os.path.join('json_files', f) for f in os.listdir(os.path.join(here, 'json_files'))
+                    if f.endswith('.json'))
+    h = hashlib.sha1()
+    for name in files:
+        with open(os.path.join(here, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def _file_digest(path):
+    """Content hash of an input file, None if it does not exist."""
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def _files_signature(paths):
+    """Name, size and modification time of the input files that exist, so a re-queried or rebuilt input
+    changes the fingerprint of the stages built from it without hashing its content."""
+    sig = []
+    for path in sorted(paths):
+        if os.path.exists(path):
+            st = os.stat(path)
+            sig.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+    return sig
+
+
+def _fingerprint(*parts):
+    """Short, stable hash of a stage's parent fingerprints and parameters."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def stage_fingerprints(args, norm_file=None, n_chunks=None, group_ids=None, inputs=None):
+    """Fingerprints of the extraction stages.
+
+    vital, intervention and static depend on the cohort, the code version,
+    their inputs and their own parameters; outlier -> norm_stats -> impute each build on the
+    one before, so sibling variants (e.g. --no_removal) share every stage
+    upstream of where they differ.  *norm_file* is an external normalization
+    statistics file (eICU normalized with MIMIC statistics).  *n_chunks* is
+    part of the chunked stages, their chunk files only match the same split.
+    *group_ids* are the stays of a patient group: up to outlier removal the
+    stages cover the whole cohort, normalization and imputation are per group.
+    *inputs* has the signatures (see _files_signature) of the 'raw' tables
+    intervention and static are built from and of the event 'store' the vital
+    table is rolled up from.
+    """
+    inputs = inputs or {}
+    cohort = {
+        'database': args.database,
+        'age_min': args.age_min,
+        'los_min': args.los_min,
+        'los_max': args.los_max,
+        'code': _code_version(),
+    }
+    fp = {
+        'static': _fingerprint('static', cohort, inputs.get('raw')),
+        'intervention': _fingerprint('intervention', cohort, args.time_window, inputs.get('raw')),
+        'vital': _fingerprint('vital', cohort, args.time_window, sorted(args.extra_stats), n_chunks,
+                              inputs.get('store')),
+    }
+    fp['outlier'] = _fingerprint('outlier', fp['vital'], args.no_removal)
+    group = _fingerprint('group', [str(i) for i in group_ids]) if group_ids is not None else None
+    fp['norm_stats'] = _fingerprint('norm_stats', fp['outlier'], *([group] if group else []))
+    fp['impute'] = _fingerprint('impute', fp['outlier'], args.impute, args.impute_max_age, args.impute_decay,
+                                _file_digest(norm_file) if norm_file else fp['norm_stats'], *([group] if group else []))
+    return fp
+
+
+def _write_frame(df, path):
+    """Write a stage output atomically; flat tuple column names are stored as their repr."""
+    if not isinstance(df.columns, pd.MultiIndex):
+        df = df.set_axis([str(c) for c in df.columns], axis=1)
+    df.to_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _read_frame(path, **kwargs):
+    """Read a stage output back with its (variable, statistic) tuple column names restored."""
+    df = pd.read_parquet(path, **kwargs)
+    if not isinstance(df.columns, pd.MultiIndex):
+        df.columns = pd.Index([ast.literal_eval(c) if c.startswith('(') and c.endswith(')') else c
+                               for c in df.columns], tupleize_cols=False)
+    return df
 
-    # normalize
-    print('Start normalization and data imputation ')
-    count_col = [i for i in total_cols if 'count' in i]
-    col_means, col_stds = vital_final.loc[:, mean_col].mean(axis=0), vital_final.loc[:, mean_col].std(axis=0)
-    # saving col_means and col_stds for eicu normalization
-    df_mean_std = col_means.to_frame('mean').join(col_stds.to_frame('std'))
-    os.makedirs(args.output_dir, exist_ok=True)
-    df_mean_std.to_parquet(os.path.join(args.output_dir, 'MIMIC_mean_std_stats.parquet'))
-    vital_final.loc[:, mean_col] = (vital_final.loc[:, mean_col] - col_means) / col_stds
-    icustay_means = vital_final.loc[:, mean_col].groupby(ID_COLS).mean()
-    # impute
-    vital_final.loc[:, mean_col] = vital_final.loc[:, mean_col].groupby(ID_COLS).fillna(method='ffill').groupby(
-        ID_COLS).fillna(
-        icustay_means).fillna(0)
-    # 0 or 1
-    vital_final.loc[:, count_col] = (vital_final.loc[:, count_col] > 0).astype(float)
-    # at this satge only 3 last columns has nan values
-    vital_final = vital_final.fillna(0)
-    # convert to int in stead of int64 which will be problematic for hdf saving
-    vital_final[('screen', 'last')] = vital_final[('screen', 'last')].astype('uint8')
-    vital_final[('positive_culture', 'last')] = vital_final[('positive_culture', 'last')].astype('uint8')
-    vital_final[('has_sensitivity', 'last')] = vital_final[('has_sensitivity', 'last')].astype('uint8')
-
-    if args.exit_point == 'Impute':
-        print('Exit point is after data imputation, saving results...')
-        os.makedirs(args.output_dir, exist_ok=True)
-        vital_final.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_vital.parquet'))
-        static.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_static.parquet'))
-        intervention.to_parquet(os.path.join(args.output_dir, 'MEEP_MIMIC_inv.parquet'))
-        return
 
-    # split data
-    stays_v = set(vital_final.index.get_level_values(2).values)
-    stays_static = set(static.index.get_level_values(2).values)
-    stays_int = set(intervention.index.get_level_values(2).values)
-    assert stays_v == stays_static, "Subject ID pools differ!"
-    assert stays_v == stays_int, "Subject ID pools differ!"
-    train_frac, dev_frac, test_frac = 0.7, 0.1, 0.2
-    SEED = 41
-    np.random.seed(SEED)
-    subjects, N = np.random.permutation(list(stays_v)), len(stays_v)
-    N_train, N_dev, N_test = int(train_frac * N), int(dev_frac * N), int(test_frac * N)
-    train_stay = list(stays_v)[:N_train]
-    dev_stay = list(stays_v)[N_train:N_train + N_dev]
-    test_stay = list(stays_v)[N_train + N_dev:]
-    def convert_dtype(df):
-        names = df.columns.to_list()
-        dtypes = df.dtypes.to_list()
-        for i, col in enumerate(df.columns.to_list()):
-            if dtypes[i] == pd.Int64Dtype():
-                df.loc[:, col] = df.loc[:, col].astype(float)
+def checkpoint(stage_dir, stage, fingerprint, build_fn, force=False):
+    """Load the output of *stage* persisted under *fingerprint*, or build it with *build_fn* and persist it."""
+    path = os.path.join(stage_dir, f"{stage}-{fingerprint}.parquet")
+    with report_stage(stage) as st:
+        if not force and os.path.exists(path):
+            print(f"  [CHECKPOINT] {stage}  <-  {path}")
+            st.status = 'cached'
+            df = _read_frame(path)
+            st.output(df)
+            return df
+        print(f"  [STAGE]      {stage} ...")
+        df = build_fn()
+        os.makedirs(stage_dir, exist_ok=True)
+        _write_frame(df, path)
+        st.output(df)
+        st.written(path)
+        print(f"  [SAVED]      {stage}  ->  {path}")
         return df
-    static = convert_dtype(static)
-
-    [(vital_train, vital_dev, vital_test), (Y_train, Y_dev, Y_test), (static_train, static_dev, static_test)] = [
-        [df[df.index.get_level_values(2).isin(s)] for s in (train_stay, dev_stay, test_stay)] \
-        for df in (vital_final, intervention, static)]
-
-    if args.exit_point == 'All':
-        print('Exit point is after all steps, including train-val-test splitting, saving results...')
-        split_dir = os.path.join(args.output_dir, 'MIMIC_split')
-        os.makedirs(split_dir, exist_ok=True)
-        vital_train.to_parquet(os.path.join(split_dir, 'vital_train.parquet'))
-        vital_dev.to_parquet(os.path.join(split_dir, 'vital_dev.parquet'))
-        vital_test.to_parquet(os.path.join(split_dir, 'vital_test.parquet'))
-        Y_train.to_parquet(os.path.join(split_dir, 'inv_train.parquet'))
-        Y_dev.to_parquet(os.path.join(split_dir, 'inv_dev.parquet'))
-        Y_test.to_parquet(os.path.join(split_dir, 'inv_test.parquet'))
-        static_train.to_parquet(os.path.join(split_dir, 'static_train.parquet'))
-        static_dev.to_parquet(os.path.join(split_dir, 'static_dev.parquet'))
-        static_test.to_parquet(os.path.join(split_dir, 'static_test.parquet'))
-    return
 
 
-def extract_eicu(args):
+def checkpoint_chunks(stage_dir, stage, fingerprint, n_chunks, build_chunk, force=False, setup=None, workers=1,
+                      collect=None):
+    """Chunked variant of checkpoint: chunk i is built by *build_chunk(i)* unless it is already persisted.
 
-    os.environ["GOOGLE_CLOUD_PROJECT"] = args.project_id
-    client = bigquery.Client(project=args.project_id)
-    ID_COLS = ['patientunitstayid']
-    # minutes to hour
-    to_hours = lambda x: int(x // (60 * args.time_window))
-    tw_in_min = 60 * args.time_window
+    *setup* runs once before any chunk is built, *workers* > 1 builds the chunks
+    in parallel (see map_workers). *build_chunk* may return a (df, info) pair,
+    the infos of the chunks built in this run are appended to *collect*.
+    Returns the chunk paths; the chunks themselves are never held together in memory.
+    """
+    chunk_dir = os.path.join(stage_dir, f"{stage}-{fingerprint}")
+    paths = [os.path.join(chunk_dir, f'chunk_{ci:03d}.parquet') for ci in range(n_chunks)]
+    todo = [ci for ci, path in enumerate(paths) if force or not os.path.exists(path)]
+    with report_stage(stage, chunks=n_chunks, chunks_built=len(todo), workers=workers) as st:
+        if not todo:
+            print(f"  [CHECKPOINT] {stage}  <-  {chunk_dir}")
+            st.status = 'cached'
+        else:
+            print(f"  [STAGE]      {stage}  ({len(todo)}/{n_chunks} chunks to build) ...")
+            if setup is not None:
+                setup()
+            os.makedirs(chunk_dir, exist_ok=True)
+
+            def build(ci):
+                out = build_chunk(ci)
+                df, info = out if isinstance(out, tuple) else (out, None)
+                _write_frame(df, paths[ci])
+                return info
+
+            infos = map_workers(build, todo, workers)
+            if collect is not None:
+                collect.extend(info for info in infos if info is not None)
+            st.written(*[paths[ci] for ci in todo])
+            print(f"  [SAVED]      {stage}  ->  {chunk_dir}")
+        _record_files(st, paths)
+    return paths
+
+
+def _record_files(st, paths):
+    """Rows and columns of parquet files (e.g. the chunks of a stage) for the run report, from their metadata."""
+    import pyarrow.parquet as pq
+    metas = [pq.ParquetFile(p).metadata for p in paths]
+    st.rows_out = sum(m.num_rows for m in metas)
+    if paths:
+        schema = pq.read_schema(paths[0])
+        st.cols_out = len(set(schema.names) - set(map(str, schema.pandas_metadata['index_columns'])))
+
+
+# function run by the pool workers of map_workers, inherited through fork
+_WORKER_FN = None
+
+
+def _worker_call(item):
+    return _WORKER_FN(item)
+
+
+def map_workers(fn, items, workers=1):
+    """Map *fn* over *items*, in a pool of *workers* processes when workers > 1.
+
+    The pool forks, so *fn* can be a closure over large in-memory state (the
+    cohort, the template) which the workers inherit instead of receiving it
+    pickled; only the results travel back. Without fork (e.g. Windows) the
+    items are processed one by one.
+    """
+    global _WORKER_FN
+    items = list(items)
+    if workers <= 1 or len(items) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [fn(item) for item in items]
+    _WORKER_FN = fn
+    try:
+        with multiprocessing.get_context('fork').Pool(min(workers, len(items))) as pool:
+            return pool.map(_worker_call, items, chunksize=1)
+    finally:
+        _WORKER_FN = None
 
-    # --- cache setup ---
-    raw_dir = os.path.join(args.cache_dir, f"eICU_{args.patient_group}", "raw")
-    force = args.force_query
-    _check_params(os.path.join(args.cache_dir, f"eICU_{args.patient_group}"), args)
-    _save_params(os.path.join(args.cache_dir, f"eICU_{args.patient_group}"), args)
 
-    # get patient group
-    patient = cached_query(raw_dir, 'patient', get_patient_group_eicu, args, client, force=force)
-    print("Patient icu info query done, start querying variables in Dynamic table")
-    patient['unitadmitoffset'] = 0
-    young_age = [str(i) for i in range(args.age_min)]
-    patient = patient.loc[~patient.loc[:, 'age'].isin(young_age)]
-    icuids_to_keep = patient['patientunitstayid']
-    icuids_to_keep = set([str(s) for s in icuids_to_keep])
-    patient.set_index('patientunitstayid', inplace=True)
-    patient['max_hours'] = (patient['unitdischargeoffset'] - patient['unitadmitoffset']).apply(to_hours)
-    missing_hours_fill = range_unnest(patient, 'max_hours', out_col_name='hours_in', reset_index=True)
-    missing_hours_fill['tmp'] = np.NaN
-    fill_df = patient.reset_index()[ID_COLS].join(missing_hours_fill.set_index('patientunitstayid'),
-                                                  on='patientunitstayid')
-    fill_df.set_index(ID_COLS + ['hours_in'], inplace=True)
+def _stats_tag(extra_stats):
+    """Suffix for cache directories whose content depends on --extra_stats, e.g. '+min+max'."""
+    return ''.join(f"+{s}" for s in EXTRA_STATS if s in extra_stats)
 
-    # ---- chunked vital processing to limit memory ----
-    import gc
-    N_CHUNKS = 20
-    all_stay_ids = sorted(fill_df.index.get_level_values('patientunitstayid').unique())
-    chunks = [all_stay_ids[i::N_CHUNKS] for i in range(N_CHUNKS)]
 
-    # Pre-load JSON config files (small, reused per chunk)
-    with open("./json_files/eicu_empty_columns.json") as f:
-        columns_to_make = json.load(f)
-    with open("./json_files/eicu_empty_culture.json") as f:
-        empty_culture = json.load(f)
-    with open("./json_files/eicu_col_order.json") as f:
-        col = json.load(f)
-    breakpoint1 = col.index('positive')
-    breakpoint2 = col.index("('culturesite', 'last')_culturesite0")
-    col_ready = []
-    for i in range(breakpoint1):
-        col_ready.append((col[i], 'mean'))
-        col_ready.append((col[i], 'count'))
-    for i in range(breakpoint1, breakpoint2):
-        col_ready.append((col[i], 'last'))
-        col_ready.append((col[i], 'mask'))
-    for i in range(breakpoint2, len(col)):
-        col_ready.append(col[i])
-
-    chunk_dir = os.path.join(raw_dir, '_vital_chunks')
-    os.makedirs(chunk_dir, exist_ok=True)
-
-    for ci, chunk_ids in enumerate(chunks):
-        chunk_path = os.path.join(chunk_dir, f'chunk_{ci:03d}.parquet')
-        if os.path.exists(chunk_path):
-            print(f'  Vital chunk {ci+1}/{N_CHUNKS} already on disk, skipping.')
-            continue
+def _stream_parquet(frames, paths):
+    """Write DataFrames to parquet as they come, without holding them all in memory.
 
-        print(f'  Processing vital chunk {ci+1}/{N_CHUNKS} ({len(chunk_ids)} stays)...')
-        chunk_set = set(chunk_ids)
-        chunk_fill = fill_df[fill_df.index.get_level_values('patientunitstayid').isin(chunk_set)]
+    *frames* yields (key, df) pairs and every key in *paths* gets its own
+    writer; the schema of a file is taken from its first frame and later
+    frames are cast to it.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writers = {}
+    try:
+        for key, df in frames:
+            table = pa.Table.from_pandas(df)
+            if key not in writers:
+                writers[key] = pq.ParquetWriter(paths[key], table.schema)
+            writers[key].write_table(table.cast(writers[key].schema))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def _write_slices(frames, path):
+    """Write DataFrames that together make up one table to a single parquet file, one at a time.
+
+    Unlike _stream_parquet the schema is not known upfront: a column that is
+    all missing in one slice (e.g. a culture site) has no type there. Every
+    slice is first written on its own, then they are cast to their unified
+    schema and appended to *path*.
+    """
+    import shutil
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    part_dir = path + '.slices'
+    os.makedirs(part_dir, exist_ok=True)
+    parts = []
+    for df in frames:
+        parts.append(os.path.join(part_dir, f'slice_{len(parts):03d}.parquet'))
+        df.to_parquet(parts[-1])
+    if parts:
+        schema = pa.unify_schemas([pq.read_schema(p) for p in parts], promote_options='default')
+        with pq.ParquetWriter(path + '.tmp', schema) as writer:
+            for p in parts:
+                writer.write_table(pq.read_table(p).cast(schema))
+        os.replace(path + '.tmp', path)
+    shutil.rmtree(part_dir)
+
+
+def _write_split_dataset(frames, root, key, n_buckets=0):
+    """Write DataFrames to a parquet dataset partitioned by split, and by stay bucket if *n_buckets*.
+
+    The split of a row is a hash of its *key* index level (assign_split), so
+    every frame is assigned and written on its own, one file per frame and
+    partition: <root>/split=train[/bucket=003]/part-000.parquet.  Readers
+    open only the partition they need, see read_split.
+    """
+    import shutil
+    shutil.rmtree(root, ignore_errors=True)
+    paths = []
+    for i, df in enumerate(frames):
+        ids = df.index.get_level_values(key)
+        parts = pd.DataFrame({'split': assign_split(ids),
+                              'bucket': stay_bucket(ids, n_buckets) if n_buckets else 0})
+        for (split, bucket), rows in parts.groupby(['split', 'bucket']).indices.items():
+            part_dir = os.path.join(root, f'split={split}', *([f'bucket={bucket:03d}'] if n_buckets else []))
+            os.makedirs(part_dir, exist_ok=True)
+            paths.append(os.path.join(part_dir, f'part-{i:03d}.parquet'))
+            df.iloc[rows].to_parquet(paths[-1])
+    return paths
+
+
+def _report_outliers(removed):
+    """Print how many entries the outlier rules removed per variable."""
+    print(f"  Removed {int(removed.sum())} outlier entries in {int((removed > 0).sum())} variables")
+    for var, n in removed[removed > 0].sort_values(ascending=False).items():
+        print(f"    {var:<30s} {n}")
 
-        def _read_and_filter(name):
-            df = pd.read_parquet(os.path.join(raw_dir, f'{name}.parquet'))
-            df = df[df['patientunitstayid'].isin(chunk_set)]
-            for c in df.columns:
-                if df[c].dtype == object and c not in ('patientunitstayid',):
-                    df[c] = pd.to_numeric(df[c], errors='coerce')
-            return df
+# ---------------------------------------------------------------------------
+# Source adapters -- everything that differs between MIMIC-IV and eICU is
+# described by a source spec, extract_source runs the same pipeline over both
+# ---------------------------------------------------------------------------
 
-        bg = fill_query(_read_and_filter('bg'), chunk_fill, tw_in_min)
-        lab = fill_query(_read_and_filter('lab'), chunk_fill, tw_in_min)
-        vital_raw = _read_and_filter('vital')
-        vital_raw.drop('entryoffset', axis=1, inplace=True)
-        vital_raw = fill_query(vital_raw, chunk_fill, tw_in_min)
+# the vital table is built and processed in at least this many chunks of whole stays
+N_CHUNKS = 20
+# working copies pandas makes of a frame while it is processed, for the --memory_budget estimates
+WORK_FACTOR = 8
+# memory binning a raw table takes per float64 cell of the table (parsed columns, bins, groupby state, aggregates)
+BIN_WORK_FACTOR = 16
 
-        microlab = _read_and_filter('microlab')
-        microlab['hours_in'] = microlab['culturetakenoffset'].floordiv(60)
-        microlab.drop(columns=['culturetakenoffset'], inplace=True)
-        microlab.reset_index(inplace=True)
-        microlab = microlab.groupby(ID_COLS + ['hours_in']).agg(['last'])
-        microlab = microlab.reindex(chunk_fill.index)
 
-        gcs = fill_query(_read_and_filter('gcs'), chunk_fill, tw_in_min)
-        uo = fill_query(_read_and_filter('uo'), chunk_fill, tw_in_min)
-        weight = fill_query(_read_and_filter('weight'), chunk_fill, tw_in_min)
+def _vital_chunk_count(rows, cols, workers, headroom):
+    """Number of stay chunks of the vital stages, so that every worker's chunk fits in *headroom* bytes.
 
-        cvp_raw = _read_and_filter('cvp')
-        cvp_raw.loc[:, 'cvp'] = cvp_raw.loc[:, 'cvp'].astype(float)
-        cvp_raw = fill_query(cvp_raw, chunk_fill, tw_in_min, time='observationoffset')
+    Every worker holds one chunk of float64 columns at a time, plus working
+    copies. The count is N_CHUNKS times a power of two, so it (and with it
+    the checkpoints of the chunked stages) does not change with small
+    differences in the memory the process holds.
+    """
+    needed = rows * cols * 8 * WORK_FACTOR * workers / headroom
+    if needed <= N_CHUNKS:
+        return N_CHUNKS
+    return N_CHUNKS * 2 ** int(np.ceil(np.log2(needed / N_CHUNKS)))
 
-        vital_c = bg.join([lab, vital_raw, gcs, uo, weight, cvp_raw, microlab])
-        del bg, lab, vital_raw, gcs, uo, weight, cvp_raw, microlab
 
-        labmakeup = fill_query(_read_and_filter('labmakeup'), chunk_fill, tw_in_min)
-        tidal_vol_obs = fill_query(_read_and_filter('tidal_vol'), chunk_fill, tw_in_min)
-        vital_c = vital_c.join([labmakeup, tidal_vol_obs])
-        del labmakeup, tidal_vol_obs
+def _headroom(budget):
+    """Part of a --memory_budget (bytes) the process does not hold yet, at least a tenth of it."""
+    return max(budget - (rss_mb() or 0) * 2 ** 20, budget / 10)
 
-        idx = pd.IndexSlice
-        vital_c.loc[:, idx[:, 'count']] = vital_c.loc[:, idx[:, 'count']].fillna(0)
-
-        original = vital_c.loc[:, idx['ibp_systolic', ['mean', 'count']]].copy(deep=True)
-        makeups = vital_c.loc[:, idx['nibp_systolic', ['mean', 'count']]].copy(deep=True)
-        filled = combine_cols(makeups, original)
-        vital_c.loc[:, idx['ibp_systolic', ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-
-        original = vital_c.loc[:, idx['ibp_diastolic', ['mean', 'count']]].copy(deep=True)
-        makeups = vital_c.loc[:, idx['nibp_diastolic', ['mean', 'count']]].copy(deep=True)
-        filled = combine_cols(makeups, original)
-        vital_c.loc[:, idx['ibp_diastolic', ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-
-        original = vital_c.loc[:, idx['ibp_mean', ['mean', 'count']]].copy(deep=True)
-        makeups = vital_c.loc[:, idx['nibp_mean', ['mean', 'count']]].copy(deep=True)
-        filled = combine_cols(makeups, original)
-        vital_c.loc[:, idx['ibp_mean', ['mean', 'count']]] = filled.loc[:, ['mean', 'count']].values
-
-        vital_c.drop('basedeficit', axis=1, level=0, inplace=True)
-        vital_c.drop('index', axis=1, level=0, inplace=True)
-        vital_c = pd.get_dummies(vital_c)
-        vital_c[('positive', 'mask')] = (~vital_c[('positive', 'last')].isnull()).astype(float)
-        vital_c[('screen', 'mask')] = (~vital_c[('screen', 'last')].isnull()).astype(float)
-        vital_c[('has_sensitivity', 'mask')] = (~vital_c[('has_sensitivity', 'last')].isnull()).astype(float)
 
-        for c_name in columns_to_make:
-            vital_c[(c_name, 'mean')] = chunk_fill.values
-            vital_c[(c_name, 'count')] = 0
-        for c_name in empty_culture:
-            vital_c[c_name] = 0
-
-        vital_c = vital_c.reindex(columns=col_ready, fill_value=0)
-        vital_c.to_parquet(chunk_path)
-        del vital_c, chunk_fill
-        gc.collect()
-        print(f'  Chunk {ci+1}/{N_CHUNKS} done -> {chunk_path}')
-
-    # vital chunks stay on disk -- reassembled lazily at save time
-    _vital_chunk_dir = chunk_dir
-    _vital_n_chunks = N_CHUNKS
+def _json(name):
+    """Load a config file from json_files."""
+    with open(os.path.join('./json_files', name)) as f:
+        return json.load(f)
+
+
+def _expand(items):
+    """Config list whose entries may also name a json file of further entries, spliced in place."""
+    out = []
+    for item in items:
+        out += _json(item) if isinstance(item, str) and item.endswith('.json') else [item]
+    return out
+
+
+def _keep_ids(patient, col):
+    """Ids of the cohort in *col* as strings, the way the queries take them."""
+    values = patient.index if col == patient.index.name else patient[col]
+    return set(str(s) for s in values)
+
+
+def _source_events(source, table, raw_dir, client, patient, aggs=('sum', 'count'), force=False, budget=None,
+                   con=None):
+    """Load a raw event table of *source* and aggregate it into fine bins (see aggregate_state for *aggs*).
+
+    With a memory *budget* (bytes) a cached raw table is read and binned in
+    slices of stays, yielded one by one (see _raw_slices). With a DuckDB
+    connection *con* (--engine duckdb) the cached table is binned in SQL.
+    """
+    path = os.path.join(raw_dir, f"{table['name']}.parquet")
+    query_args = table['query_args'](raw_dir) if 'query_args' in table else ()
+    if con is not None:
+        from duckdb_engine import bin_events
+        if force or not os.path.exists(path):
+            cached_query(raw_dir, table['name'], table['query'], client,
+                         _keep_ids(patient, table.get('ids', source['stay_col'])), *query_args, force=force)
+        print(f"  [DUCKDB]     {table['name']}  <-  {path}")
+        return _int_levels(bin_events(con, path, source, table, patient, aggs=aggs, raw_dir=raw_dir))
+    if budget is not None and not force and os.path.exists(path):
+        slices = _raw_slices(path, source['stay_col'], _headroom(budget))
+        if slices is not None:
+            print(f"  [CACHE HIT]  {table['name']}  <-  {path}  (in {len(slices)} slices)")
+            return (_bin_events(source, table, pd.read_parquet(path, filters=[(source['stay_col'], 'in', ids)]),
+                                patient, aggs, raw_dir) for ids in slices)
+    df = cached_query(raw_dir, table['name'], table['query'], client,
+                      _keep_ids(patient, table.get('ids', source['stay_col'])), *query_args, force=force)
+    return _bin_events(source, table, df, patient, aggs, raw_dir)
+
+
+def _raw_slices(path, stay_col, budget):
+    """Stays of a cached raw table, split so that binning one slice stays within *budget* bytes.
+
+    None when the table fits in one go (or is empty). All events of a stay
+    fall in the same slice, so binning the slices one by one gives the same
+    store entries as binning the whole table.
+    """
+    import pyarrow.parquet as pq
+    meta = pq.ParquetFile(path).metadata
+    size = meta.num_rows * meta.num_columns * 8 * BIN_WORK_FACTOR
+    if not meta.num_rows or size <= budget:
+        return None
+    # rows per stay, counted batch by batch
+    counts = pd.Series(dtype='int64')
+    for batch in pq.ParquetFile(path).iter_batches(columns=[stay_col]):
+        counts = counts.add(batch.column(0).to_pandas().value_counts(), fill_value=0)
+    counts = counts.sort_index()
+    return _balanced_chunks(counts, int(np.ceil(size / budget)))
+
+
+def _balanced_chunks(sizes, n_chunks):
+    """Split the index of *sizes* (stay -> rows, sorted) into at most *n_chunks* contiguous, non-empty
+    ranges of about the same number of rows."""
+    cum = np.cumsum(sizes.to_numpy())
+    bounds = np.unique(np.searchsorted(cum, np.arange(1, n_chunks) * cum[-1] / n_chunks, side='right'))
+    return [c.tolist() for c in np.split(sizes.index.to_numpy(), bounds) if len(c)]
+
+
+def _bin_events(source, table, df, patient, aggs, raw_dir=None):
+    """Aggregate raw events of *table* into fine bins.
+
+    Event times become minutes since ICU admission, from timestamps minus the
+    admission time (MIMIC) or straight from minute offsets (eICU).
+    """
+    if df.empty:
+        return df
+    if 'rename' in table:
+        df.rename(columns=table['rename'], inplace=True)
+    if 'prep' in table:
+        df = table['prep'](df, raw_dir)
+    time, anchor = table.get('time', source['time']), source['anchor']
+    if anchor is None:
+        minutes = df[time].astype(float)
+    else:
+        start = df[anchor] if anchor in df else df[source['stay_col']].map(patient[anchor])
+        minutes = (df[time] - start) / pd.Timedelta(minutes=1)
+    id_cols = source['id_cols'] + ([table['long']] if 'long' in table else [])
+    if 'long' in table:
+        df = df[id_cols + [table['value']]]
+    df = df.drop(columns=[c for c in (time, anchor) if c in df] + list(table.get('drop', [])))
+    for c in df.columns:
+        if df[c].dtype == object and c not in id_cols + list(table.get('categorical', [])):
+            df[c] = pd.to_numeric(df[c], errors='coerce')
+    df['minutes'] = minutes
+    df['bin'] = to_bins(minutes, clip=source['clip'])
+    return _int_levels(aggregate_events(df, id_cols, aggs=table.get('aggs', aggs), time_col='minutes'))
+
+
+def _int_levels(df):
+    """Ids that come back as floats (e.g. hadm_id) are stored as integers."""
+    if df.empty:
+        return df
+    df.index = df.index.set_levels([lvl.astype('int64') if lvl.dtype.kind == 'f' else lvl
+                                    for lvl in df.index.levels])
+    return df
+
+
+def _read_store(path, table, stay_col, chunk_ids, chunk_fill, factor, aggs):
+    """Roll one event-store table up to the time window, for the stays of one chunk."""
+    import pyarrow.parquet as pq
+    aggs = table.get('aggs', aggs)
+    if not pq.ParquetFile(path).metadata.num_rows:
+        # a table the source no longer has (e.g. MIMIC-IV 3.1 culture), all missing
+        columns = pd.MultiIndex.from_product([table.get('columns', []), list(aggs)])
+        return pd.DataFrame(np.nan, index=chunk_fill.index, columns=columns)
+    df = pd.read_parquet(path, filters=[(stay_col, 'in', list(chunk_ids))])
+    if 'long' not in table:
+        return rollup_events(df, factor, chunk_fill)
+    # long format, one row per variable: every chunk is unstacked into the variables of the whole store
+    variables = sorted(pq.read_table(path, columns=[table['long']]).column(0).unique().to_pylist())
+    columns = pd.MultiIndex.from_product([variables, list(aggs)])
+    if df.empty:
+        return pd.DataFrame(np.nan, index=chunk_fill.index, columns=columns)
+    df = rollup_events(df, factor)
+    df.columns = df.columns.droplevel(0)
+    df = df.unstack(level=table['long'])
+    df.columns = df.columns.reorder_levels([1, 0])
+    return df.reindex(index=chunk_fill.index, columns=columns)
+
+
+def _col_order(source, stats):
+    """Output columns of the vital table, from the col_order json of *source*.
+
+    Entries are (variable, statistic) pairs, one-hot column names, or bare
+    variable names that stand for mean and count (last and mask for flags).
+    """
+    order = []
+    for c in _json(source['col_order']):
+        if isinstance(c, list):
+            order.append(tuple(c))
+        elif c.startswith('('):
+            order.append(c)
+        elif c in source['flags']:
+            order += [(c, 'last'), (c, 'mask')]
+        else:
+            order += [(c, 'mean'), (c, 'count')]
+    # optional statistics (--extra_stats) go after the standard columns
+    order += [(c[0], s) for c in order if isinstance(c, tuple) and c[1] == 'mean' for s in stats]
+    return order
+
+
+def _mimic_cohort(args, client, raw_dir, force=False):
+    """MIMIC-IV stays of the Generic cohort and their lengths, the patient groups are filtered from it."""
+    patient = cached_query(raw_dir, 'patient', get_patient_group, args, client, force=force)
+    patient.set_index('stay_id', inplace=True)
+    return patient, patient['icu_outtime'] - patient['icu_intime']
+
+
+def _eicu_cohort(args, client, raw_dir, force=False):
+    """eICU stays of the Generic cohort and their lengths in minutes."""
+    patient = cached_query(raw_dir, 'patient', get_patient_group_eicu, args, client, force=force)
+    patient['unitadmitoffset'] = 0
+    young_age = [str(i) for i in range(args.age_min)]
+    patient = patient.loc[~patient.loc[:, 'age'].isin(young_age)]
+    patient.set_index('patientunitstayid', inplace=True)
+    return patient, patient['unitdischargeoffset'] - patient['unitadmitoffset']
+
+
+def _patient_groups(args):
+    """Patient groups to output: --patient_group ('all' is Generic and every specialty group), plus custom ids."""
+    groups = [args.patient_group] if isinstance(args.patient_group, str) else list(args.patient_group)
+    if 'all' in groups:
+        groups = ['Generic'] + PATIENT_GROUPS
+    if args.custom_id:
+        groups.append('custom')
+    return list(dict.fromkeys(groups))
+
+
+def _group_flags(args, source, client, raw_dir, patient, groups, force=False):
+    """Membership of the cohort's stays in each of *groups*, one boolean column per group indexed like *patient*.
+
+    Generic is the whole cohort, the specialty groups come from a single cached
+    query (source['groups']) or an id file (source['group_files']) and 'custom'
+    from the --customid_dir file.
+    """
+    flags = pd.DataFrame(index=patient.index)
+    group_files = source.get('group_files', {})
+    if set(groups) & set(PATIENT_GROUPS) - set(group_files):
+        queried = cached_query(raw_dir, 'group_flags', source['groups'], client, force=force)
+        queried = queried.set_index(source['stay_col']).fillna(False).astype(bool)
+    for group in groups:
+        if group == 'Generic':
+            flags[group] = True
+        elif group == 'custom':
+            custom_ids = pd.read_csv(args.customid_dir)['stay_id'].astype(str)
+            flags[group] = patient.index.astype(str).isin(custom_ids)
+        elif group in group_files:
+            path = group_files[group]
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"patient group {group} of {source['name']} needs the stay id file {path}, "
+                                        f"see resources/README.md")
+            flags[group] = patient.index.isin(pd.read_csv(path)[source['stay_col']])
+        else:
+            flags[group] = patient.index.isin(queried.index[queried[group]])
+    return flags
+
+
+# parsed resource files of this process, by source file and digest
+_RESOURCES = {}
+
+
+def _resource(name, build, cache_dir=None):
+    """Resource file *name* parsed by *build*, compiled once into json under <cache_dir>/resources.
+
+    The compiled file keeps the digest of its source and is rebuilt when the
+    source changes, so runs skip the slow parsers (e.g. Excel through openpyxl).
+    Without *cache_dir* the file is only parsed once per process.
+    """
+    source = os.path.join('./resources', name)
+    digest = _file_digest(source)
+    if (source, digest) in _RESOURCES:
+        return _RESOURCES[source, digest]
+    path = None if cache_dir is None else os.path.join(cache_dir, 'resources', os.path.splitext(name)[0] + '.json')
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            compiled = json.load(f)
+        if compiled['source_digest'] == digest:
+            _RESOURCES[source, digest] = compiled['data']
+            return compiled['data']
+    data = build(source)
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'source': name, 'source_digest': digest, 'data': data}, f, indent=1)
+    _RESOURCES[source, digest] = data
+    return data
+
+
+def _chart_lab_items(raw_dir=None):
+    """Itemids of the chart and lab items that were present in MIMIC-Extract."""
+    # use MIMIC-Extract way to query other itemids that was present in MIMIC-Extract
+    chart_items = _resource('chartitems_to_keep_0505.xlsx',
+                            lambda f: [str(i) for i in pd.read_excel(f)['chartitems_to_keep'].tolist()], raw_dir)
+    lab_items = _resource('labitems_to_keep_0505.xlsx',
+                          lambda f: [str(i) for i in pd.read_excel(f)['labitems_to_keep'].tolist()], raw_dir)
+    return set(chart_items), set(lab_items)
+
+
+def _chart_lab_level2(chart_lab, raw_dir=None):
+    """Name the MIMIC-Extract chart/lab items by their LEVEL2 variable."""
+    var_map = _resource('Chart_makeup_0505 - var_map0505.csv',
+                        lambda f: pd.read_csv(f).dropna(subset=['LEVEL2']).set_index('itemid')['LEVEL2'].to_dict(),
+                        raw_dir)
+    var_map = pd.Series(var_map)
+    # json keys are strings
+    var_map.index = var_map.index.astype('int64')
+    # items missing from var_map get a NaN LEVEL2 and are dropped by the groupby
+    chart_lab['LEVEL2'] = chart_lab['itemid'].map(var_map)
+    return chart_lab
+
+
+def _mimic_intervention(args, client, raw_dir, patient, fill_df, force=False):
+    """MIMIC-IV intervention indicators per stay and time window."""
+    icuids_to_keep = _keep_ids(patient, 'stay_id')
+    subject_to_keep = _keep_ids(patient, 'subject_id')
     print('Start querying variables in the Intervention table')
+    # (column, cache name, query, extra query args) of every intervention source
+    vaso = ['dopamine', 'epinephrine', 'norepinephrine', 'phenylephrine', 'vasopressin', 'dobutamine', 'milrinone']
+    sources = [('vent', 'vent', query_vent_mimic, ()), ('antibiotic', 'antibiotics', query_antibiotics_mimic, ())]
+    sources += [(c, f'vasoactive_{c}', query_vasoactive_mimic, (c,)) for c in vaso]
+    sources += [
+        # heparin (stubbed in MIMIC-IV 3.1 -- table no longer exists)
+        ('heparin', 'heparin', query_heparin_mimic, ()),
+        ('crrt', 'crrt', query_crrt_mimic, ()),
+        ('rbc_trans', 'rbc_trans', query_rbc_trans_mimic, ()),
+        ('platelets_trans', 'pll_trans', query_pll_trans_mimic, ()),
+        ('ffp_trans', 'ffp_trans', query_ffp_trans_mimic, ()),
+        ('colloid_bolus', 'colloid', query_colloid_mimic, ()),
+        ('crystalloid_bolus', 'crystalloid', query_crystalloid_mimic, ()),
+    ]
+    intervals = {}
+    for c, name, query, query_args in sources:
+        ids = subject_to_keep if c == 'heparin' else icuids_to_keep
+        df = cached_query(raw_dir, name, query, client, ids, *query_args, force=force)
+        if c == 'antibiotic':
+            # hours with a named antibiotic
+            df = df[df['antibiotic'].notna()]
+        intervals[c] = df if df.empty else interval_hours(df, args.time_window)
+    # one uint8 column per source over the hours of the template, stays without any interval stay 0
+    index = fill_df.sort_index(level=['stay_id', 'hours_in']).index
+    return assemble_indicators(index, 'stay_id', intervals)
+
+
+def _mimic_static(args, client, raw_dir, patient, fill_df, force=False):
+    """MIMIC-IV static table: demographics, comorbidities and anchor year group."""
+    ID_COLS = ['subject_id', 'hadm_id', 'stay_id']
+    icuids_to_keep = _keep_ids(patient, 'stay_id')
+    print('Start querying variables in the Static table')
+    # static info
+    #  query patients anchor year and comorbidity
+    anchor_year = cached_query(raw_dir, 'anchor_year', query_anchor_year_mimic, client, icuids_to_keep, force=force)
+    comorbidity = cached_query(raw_dir, 'comorbidity', query_comorbidity_mimic, client, icuids_to_keep, force=force)
+    static = patient.reset_index().set_index(ID_COLS)
+    comorbidity.set_index(ID_COLS, inplace=True)
+    anchor_year.set_index(ID_COLS, inplace=True)
+    static = compact_static(static.join([comorbidity, anchor_year['anchor_year_group']]))
+    return static
+
 
-    # Intervention table
-    # ventilation
-    vent = cached_query(raw_dir, 'vent', query_vent_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    vent_data = process_inv(vent, 'vent')
-    ids_with = vent_data['patientunitstayid']
-    ids_with = set(map(int, ids_with))
-    ids_all = set(map(int, icuids_to_keep))
-    ids_without = (ids_all - ids_with)
-
-    # patient.set_index('patientunitstayid', inplace=True)
-    icustay_timediff_tmp = patient['unitdischargeoffset'] - patient['unitadmitoffset']
-    icustay_timediff = pd.Series([timediff // tw_in_min
-                                  for timediff in icustay_timediff_tmp], index=patient.index.values)
-    # Create a new fake dataframe with blanks on all vent entries
-    out_data = fill_df.copy(deep=True)
-    out_data = out_data.reset_index()
-    out_data = out_data.set_index('patientunitstayid')
-    out_data = out_data.iloc[out_data.index.isin(ids_without)]
-    out_data = out_data.reset_index()
-    out_data = out_data[['patientunitstayid']]
-    out_data['max_hours'] = out_data['patientunitstayid'].map(icustay_timediff)
-
-    # Create all 0 column for vent
-    out_data = out_data.groupby('patientunitstayid')
-    out_data = out_data.apply(add_blank_indicators_e)
-    out_data.rename(columns={'on': 'vent'}, inplace=True)
-
-    out_data = out_data.reset_index()
-    intervention = pd.concat([vent_data[['patientunitstayid', 'hours_in', 'vent']],
-                              out_data[['patientunitstayid', 'hours_in', 'vent']]],
-                             axis=0)
-
-    # vasoactive drugs
-    column_names = ['dopamine', 'epinephrine', 'norepinephrine', 'phenylephrine', 'vasopressin', 'dobutamine',
-                    'milrinone', 'heparin']
-
-    for c in column_names:
-        med = cached_query(raw_dir, f'med_{c}', query_med_eicu, client, icuids_to_keep, c, tw_in_min, force=force)
-        # 'epinephrine',  'dopamine', 'norepinephrine', 'phenylephrine', \
-        #    'vasopressin', 'dobutamine', 'milrinone',  'heparin',
-        med = process_inv(med, c)
-        intervention = intervention.merge(
-            med[['patientunitstayid', 'hours_in', c]],
-            on=['patientunitstayid', 'hours_in'],
-            how='left'
-        )
-
-    # antibiotics
-    anti = cached_query(raw_dir, 'antibiotics', query_anti_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    anti = process_inv(anti, 'antib')
-    intervention = intervention.merge(
-        anti[['patientunitstayid', 'hours_in', 'antib']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    # crrt
-    crrt = cached_query(raw_dir, 'crrt', query_crrt_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    crrt = process_inv(crrt, 'crrt')
-    intervention = intervention.merge(
-        crrt[['patientunitstayid', 'hours_in', 'crrt']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    # rbc transfusion
-    rbc = cached_query(raw_dir, 'rbc_trans', query_rbc_trans_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    rbc = process_inv(rbc, 'rbc')
-    intervention = intervention.merge(
-        rbc[['patientunitstayid', 'hours_in', 'rbc']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    # ffp transfusion
-    ffp = cached_query(raw_dir, 'ffp_trans', query_ffp_trans_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    ffp = process_inv(ffp, 'ffp')
-    intervention = intervention.merge(
-        ffp[['patientunitstayid', 'hours_in', 'ffp']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    # platelets transfusion
-    platelets = cached_query(raw_dir, 'pll_trans', query_pll_trans_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    platelets = process_inv(platelets, 'platelets')
-    intervention = intervention.merge(
-        platelets[['patientunitstayid', 'hours_in', 'platelets']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    #colloid
-    colloid = cached_query(raw_dir, 'colloid', query_colloid_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    colloid = process_inv(colloid, 'colloid')
-    intervention = intervention.merge(
-        colloid[['patientunitstayid', 'hours_in', 'colloid']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    #crystalloid
-    crystalloid = cached_query(raw_dir, 'crystalloid', query_crystalloid_eicu, client, icuids_to_keep, tw_in_min, force=force)
-    crystalloid = process_inv(crystalloid, 'crystalloid')
-    intervention = intervention.merge(
-        crystalloid[['patientunitstayid', 'hours_in', 'crystalloid']],
-        on=['patientunitstayid', 'hours_in'],
-        how='left'
-    )
-
-    # for each column, astype to int and fill na with 0
-    intervention = intervention.fillna(0)
-    for i in range(3, 18):
-        intervention.iloc[:, i] = intervention.iloc[:, i].astype(int)
-
-    intervention.set_index(ID_COLS + ['hours_in'], inplace=True)
-    intervention.sort_index(level=['patientunitstayid', 'hours_in'], inplace=True)
+def _eicu_intervention(args, client, raw_dir, patient, fill_df, force=False):
+    """eICU intervention indicators per stay and time window."""
+    icuids_to_keep = _keep_ids(patient, 'patientunitstayid')
+    tw_in_min = 60 * args.time_window
+    print('Start querying variables in the Intervention table')
+    # (column, cache name, query, extra query args) of every intervention source
+    meds = ['dopamine', 'epinephrine', 'norepinephrine', 'phenylephrine', 'vasopressin', 'dobutamine', 'milrinone',
+            'heparin']
+    sources = [('vent', 'vent_min', query_vent_eicu, ())]
+    sources += [(c, f'med_{c}_min', query_med_eicu, (c,)) for c in meds]
+    sources += [
+        ('antib', 'antibiotics_min', query_anti_eicu, ()),
+        ('crrt', 'crrt_min', query_crrt_eicu, ()),
+        ('rbc', 'rbc_trans_min', query_rbc_trans_eicu, ()),
+        ('ffp', 'ffp_trans_min', query_ffp_trans_eicu, ()),
+        ('platelets', 'pll_trans_min', query_pll_trans_eicu, ()),
+        ('colloid', 'colloid_min', query_colloid_eicu, ()),
+        ('crystalloid', 'crystalloid_min', query_crystalloid_eicu, ()),
+    ]
+    # intervals are queried once in minutes and coarsened locally, so no time window is baked into the cache
+    intervals = {c: rollup_intervals(cached_query(raw_dir, name, query, client, icuids_to_keep, *query_args, 1,
+                                                  force=force), tw_in_min)
+                 for c, name, query, query_args in sources}
+    # one uint8 column per source over the hours of the template, stays without any interval stay 0
+    index = fill_df.sort_index(level=['patientunitstayid', 'hours_in']).index
+    intervention = assemble_indicators(index, 'patientunitstayid', intervals)
 
     # reorder intervention columns
     with open("./json_files/eicu_inv_col_order.json") as f:
         new_col = json.load(f)
     intervention = intervention.loc[:, new_col]
-    print('Start querying variables in the Static table')
+    return intervention
+
 
+def _eicu_static(args, client, raw_dir, patient, fill_df, force=False):
+    """eICU static table: demographics and comorbidities, hospital id last."""
+    icuids_to_keep = _keep_ids(patient, 'patientunitstayid')
+    print('Start querying variables in the Static table')
     # static query
     # commo
     commo = cached_query(raw_dir, 'comorbidity', query_comorbidity_eicu, client, icuids_to_keep, force=force)
     commo.set_index('patientunitstayid', inplace=True)
-    static = patient.join(commo)
+    static = compact_static(patient.join(commo))
     static_col = static.columns.tolist()
     static_col.remove('hospitalid')
     static_col.append('hospitalid')
     static = static[static_col]
+    return static
+
+
+# A source spec names, per database:
+#   id_cols / stay_col      index of the vital table and the level that identifies a stay
+#   cohort                  fn(args, client, raw_dir, force) -> patient indexed by stay_col, stay lengths
+#   groups                  fn(client) -> stay_col and a boolean column per PATIENT_GROUPS entry
+#   group_files             optional, PATIENT_GROUPS entries read from a csv of stay_col ids instead
+#   time / anchor / clip    event time column; admission time it counts from (None for minute offsets);
+#                           whether events charted before admission go into the first bin
+#   tables                  event tables, binned once into the event store: name, query, ids the query
+#                           takes (default stay_col), and optionally time, rename, drop, prep, query_args,
+#                           aggs/categorical (categories keep their last value), long/value (one row per
+#                           variable), columns (when the table may come back empty); prep(df, raw_dir) and
+#                           query_args(raw_dir) get the raw cache to keep their compiled resource files in
+#   drop / combine          variables dropped, [target, makeup] pairs merged (json files are spliced in)
+#   keep_combined           whether makeup variables are kept after merging
+#   category_maps / flags   value maps of categorical variables; last-value flags that get a mask
+#   empty_columns / col_order / outliers   json files
+#   intervention / static   fn(args, client, raw_dir, patient, fill_df, force) -> table
+#   norm_arg                argument naming the source whose statistics normalize this one
+MIMIC_SOURCE = {
+    'name': 'MIMIC',
+    'id_cols': ['subject_id', 'hadm_id', 'stay_id'],
+    'stay_col': 'stay_id',
+    'patient_col': 'subject_id',
+    'cohort': _mimic_cohort,
+    'groups': get_group_id,
+    'time': 'charttime', 'anchor': 'icu_intime', 'clip': True,
+    'tables': [
+        # start with mimic_derived_data, aado2_calc, specimen not used
+        {'name': 'bg', 'query': query_bg_mimic, 'ids': 'subject_id', 'drop': ['aado2_calc', 'specimen']},
+        # temperature/glucose is a repeat name but different itemid, rename for now and combine later
+        # temperature_site is not used
+        {'name': 'vitalsign', 'query': query_vitals_mimic, 'drop': ['temperature_site'],
+         'rename': {'temperature': 'temp_vital', 'glucose': 'glucose_vital'}},
+        {'name': 'blood_diff', 'query': query_blood_diff_mimic, 'ids': 'subject_id', 'drop': ['specimen_id']},
+        {'name': 'cardiac_marker', 'query': query_cardiac_marker_mimic, 'ids': 'subject_id',
+         'drop': ['specimen_id']},
+        # rename glucose into glucose_chem and others
+        {'name': 'chemistry', 'query': query_chemistry_mimic, 'ids': 'subject_id', 'drop': ['specimen_id'],
+         'rename': {'glucose': 'glucose_chem', 'bicarbonate': 'bicarbonate_chem', 'chloride': 'chloride_chem',
+                    'calcium': 'calcium_chem', 'potassium': 'potassium_chem', 'sodium': 'sodium_chem'}},
+        {'name': 'coagulation', 'query': query_coagulation_mimic, 'ids': 'subject_id', 'drop': ['specimen_id']},
+        # also drop wbc since it's a repeat 51301
+        {'name': 'cbc', 'query': query_cbc_mimic, 'ids': 'subject_id', 'drop': ['specimen_id', 'wbc'],
+         'rename': {'hematocrit': 'hematocrit_cbc', 'hemoglobin': 'hemoglobin_cbc'}},
+        # MIMIC-IV 3.1: culture table no longer exists, query returns empty DataFrame
+        {'name': 'culture', 'query': query_culture_mimic, 'ids': 'subject_id',
+         'rename': {'specimen': 'specimen_culture'}, 'aggs': ('last',), 'categorical': ['specimen_culture'],
+         'columns': ['specimen_culture', 'screen', 'positive_culture', 'has_sensitivity']},
+        # also drop ck_mb since it's a repeat 50911
+        {'name': 'enzyme', 'query': query_enzyme_mimic, 'ids': 'subject_id', 'drop': ['specimen_id', 'ck_mb']},
+        {'name': 'gcs', 'query': query_gcs_mimic},
+        {'name': 'inflammation', 'query': query_inflammation_mimic, 'ids': 'subject_id'},
+        {'name': 'uo', 'query': query_uo_mimic},
+        # additional chart and lab items from MIMIC-Extract, aggregated per LEVEL2 name
+        {'name': 'chart_lab', 'query': query_chart_lab_mimic, 'query_args': _chart_lab_items,
+         'prep': _chart_lab_level2, 'long': 'LEVEL2', 'value': 'value'},
+    ],
+    # not well-populated or already dependent on existing columns
+    'drop': ['rdwsd', 'aado2', 'pao2fio2ratio', 'carboxyhemoglobin', 'methemoglobin', 'globulin', 'd_dimer',
+             'thrombin', 'basophils_abs', 'eosinophils_abs', 'lymphocytes_abs', 'monocytes_abs', 'neutrophils_abs',
+             'Eosinophils', 'mimic_to_drop_1.json'],
+    # from different itemids but with the same semantics
+    'combine': [
+        ['so2', 'spo2'], ['fio2', 'fio2_chartevents'], ['bicarbonate', 'bicarbonate_chem'],
+        ['hematocrit', 'hematocrit_cbc'], ['hemoglobin', 'hemoglobin_cbc'], ['chloride', 'chloride_chem'],
+        ['glucose', 'glucose_chem'], ['glucose', 'glucose_vital'],
+        ['temperature', 'temp_vital'], ['sodium', 'sodium_chem'], ['potassium', 'potassium_chem'],
+        # within the chart_lab items
+        ['Phosphate', 'Phosphorous'], ['Potassium', 'Potassium serum'],
+        # between the chart_lab items and the derived tables
+        'mimic_to_combine_1.json',
+        # In eicu mbp contains both invasive and non-invasive, so combine them for mimic_iv
+        ['dbp', 'Diastolic blood pressure'], ['dbp_ni', 'Diastolic blood pressure'],
+        ['mbp', 'Mean blood pressure'], ['mbp_ni', 'Mean blood pressure'],
+        ['sbp', 'Systolic blood pressure'], ['sbp_ni', 'Systolic blood pressure'],
+    ],
+    'keep_combined': False,
+    'category_maps': {'specimen_culture': 'mimic_culturesite_map.json'},
+    'flags': ['screen', 'positive_culture', 'has_sensitivity'],
+    'empty_columns': None,
+    'col_order': 'mimic_col_order.json',
+    'outliers': ('mimic_outlier_low.json', 'mimic_outlier_high.json'),
+    'intervention': _mimic_intervention,
+    'static': _mimic_static,
+}
+
+EICU_SOURCE = {
+    'name': 'eICU',
+    'id_cols': ['patientunitstayid'],
+    'stay_col': 'patientunitstayid',
+    # patient ids (uniquepid) are not queried, stays are split on their own
+    'patient_col': None,
+    'cohort': _eicu_cohort,
+    'groups': get_group_id_eicu,
+    # not in the repo (patient identifiers), only read when the group is extracted
+    'group_files': {'sepsis_3': './resources/eicu_sepsis_3_id.csv'},
+    # offsets before admission stay negative and fall outside the template
+    'time': 'chartoffset', 'anchor': None, 'clip': False,
+    'tables': [
+        {'name': 'bg', 'query': query_bg_eicu},
+        {'name': 'lab', 'query': query_lab_eicu},
+        {'name': 'vital', 'query': query_vital_eicu, 'drop': ['entryoffset']},
+        {'name': 'gcs', 'query': query_gcs_eicu},
+        {'name': 'uo', 'query': query_uo_eicu},
+        {'name': 'weight', 'query': query_weight_eicu},
+        {'name': 'cvp', 'query': query_cvp_eicu, 'time': 'observationoffset'},
+        {'name': 'labmakeup', 'query': query_labmakeup_eicu},
+        {'name': 'tidal_vol', 'query': query_tidalvol_eicu},
+        # culture site stays a string so it can be one-hot encoded
+        {'name': 'microlab', 'query': query_microlab_eicu, 'time': 'culturetakenoffset', 'aggs': ('last',),
+         'categorical': ['culturesite']},
+    ],
+    'drop': ['basedeficit'],
+    # non-invasive blood pressure is merged into the invasive columns but also kept on its own
+    'combine': [['ibp_systolic', 'nibp_systolic'], ['ibp_diastolic', 'nibp_diastolic'], ['ibp_mean', 'nibp_mean']],
+    'keep_combined': True,
+    'category_maps': {},
+    'flags': ['positive', 'screen', 'has_sensitivity'],
+    'empty_columns': 'eicu_empty_columns.json',
+    'col_order': 'eicu_col_order.json',
+    'outliers': ('eicu_outlier_low.json', 'eicu_outlier_high.json'),
+    'intervention': _eicu_intervention,
+    'static': _eicu_static,
+    'norm_arg': 'norm_eicu',
+}
+
+SOURCES = {'MIMIC': MIMIC_SOURCE, 'eICU': EICU_SOURCE}
+
+
+def _time_windows(args):
+    """Time windows to output, --time_window is one number of hours or several, e.g. [1, 2, 4]."""
+    windows = [args.time_window] if isinstance(args.time_window, int) else list(args.time_window)
+    return list(dict.fromkeys(windows))
+
+
+def extract_source(args, source):
+    """Run the extraction pipeline over the database described by *source* (see SOURCES).
+
+    Every stage is timed and measured, the run report is written to <output_dir>/reports.
+    Several time windows come out of one run: the cohort, the raw tables and
+    the event store are shared, everything from the roll-up on is per window,
+    each in <output_dir>/tw_<hours>h.
+    """
+    windows = _time_windows(args)
+    with RunReport(f"{source['name']}_{'+'.join(_patient_groups(args))}", os.path.join(args.output_dir, 'reports'),
+                   exit_point=args.exit_point, time_window=windows, workers=getattr(args, 'workers', 1)):
+        client = _client(args)
+        if len(windows) == 1:
+            return _extract_source(copy.copy(args), source, client, windows[0])
+        for time_window in windows:
+            print(f'===== Time window {time_window}h =====')
+            window_args = copy.copy(args)
+            window_args.output_dir = os.path.join(args.output_dir, f'tw_{time_window}h')
+            with report_stage(f'window/{time_window}h'):
+                _extract_source(window_args, source, client, time_window)
+
+
+def _extract_source(args, source, client, time_window):
+    args.time_window = time_window
+    name, stay_col = source['name'], source['stay_col']
+    ID_COLS = source['id_cols']
+    # index level whose hash decides the split of a row
+    split_key = stay_col if args.split_by == 'stay' else source['patient_col']
+    if split_key is None:
+        raise ValueError(f'{name} has no patient id in its index, split it with --split_by stay')
+    # number of fine store bins per time window
+    factor = window_factor(args.time_window)
+    # aggregate state kept per bin and the optional statistics it turns into
+    aggs, stats = aggregate_state(args.extra_stats), output_stats(args.extra_stats)
 
-    if args.exit_point == 'Raw':
-        print('Exit point is after querying raw records, saving results...')
-        os.makedirs(args.output_dir, exist_ok=True)
-        intervention.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_inv.parquet'))
-        static.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_static.parquet'))
-        # Stream vital chunks to output without loading all into memory
-        import pyarrow as pa
-        import pyarrow.parquet as pq
-        vital_out = os.path.join(args.output_dir, 'MEEP_eICU_vital.parquet')
-        # Read first chunk to establish the canonical schema
-        schema = pq.read_schema(os.path.join(_vital_chunk_dir, 'chunk_000.parquet'))
-        writer = pq.ParquetWriter(vital_out, schema)
-        for i in range(_vital_n_chunks):
-            tbl = pq.read_table(os.path.join(_vital_chunk_dir, f'chunk_{i:03d}.parquet'))
-            tbl = tbl.cast(schema)
-            writer.write_table(tbl)
-            del tbl
-        writer.close()
-        print(f'  Vital written from {_vital_n_chunks} chunks -> {vital_out}')
-        return
+    # --- cache setup ---
+    # one cache for the Generic cohort, the patient groups are subsets of it
+    cache_root = os.path.join(args.cache_dir, f"{name}_Generic")
+    raw_dir = os.path.join(cache_root, "raw")
+    # binned by this code version, a store built by another one is not reused
+    store_dir = os.path.join(cache_root, f"store_{BASE_BIN_MINUTES}min" + _stats_tag(args.extra_stats),
+                             _code_version())
+    force = args.force_query
+    _check_params(cache_root, args)
+    _save_params(cache_root, args)
 
-    # For later exit points, we need vital in memory
-    vital = pd.concat([pd.read_parquet(os.path.join(_vital_chunk_dir, f'chunk_{i:03d}.parquet'))
-                        for i in range(_vital_n_chunks)])
-    vital.sort_index(inplace=True)
+    patient, stay_length = source['cohort'](args, client, raw_dir, force=force)
+    print("Patient icu info query done, start querying variables in Dynamic table")
+    with report_stage('template') as st:
+        # create template fill_df with time window for each stay based on icu in/out time
+        patient['max_hours'] = (to_bins(stay_length, clip=source['clip']) // factor).astype(int)
+        missing_hours_fill = range_unnest(patient, 'max_hours', out_col_name='hours_in', reset_index=True)
+        missing_hours_fill['tmp'] = np.NaN
+        fill_df = patient.reset_index()[ID_COLS].join(missing_hours_fill.set_index(stay_col), on=stay_col)
+        fill_df.set_index(ID_COLS + ['hours_in'], inplace=True)
+        st.input(patient)
+        st.output(fill_df)
 
-    total_cols = vital.columns.tolist()
-    mean_col = [i for i in total_cols if 'mean' in i]
-    X_mean = vital.loc[:, mean_col]
+    # Pre-load JSON config files (small, reused per chunk)
+    vocab = {(c, 'last'): categories for c, categories in _json('categorical_vocab.json')[name].items()}
+    category_maps = {c: _json(f) for c, f in source['category_maps'].items()}
+    to_drop, to_combine = _expand(source['drop']), _expand(source['combine'])
+    columns_to_make = _json(source['empty_columns']) if source['empty_columns'] else []
+    col_order = _col_order(source, stats)
+    mean_col = [i for i in col_order if 'mean' in i]
+    count_col = [i for i in col_order if 'count' in i]
 
-    if not args.no_removal:
-        print('Performing outlier removal')
-        with open("./json_files/eicu_outlier_high.json") as f:
-            range_dict_high = json.load(f)
-        with open("./json_files/eicu_outlier_low.json") as f:
-            range_dict_low = json.load(f)
-        for var_to_remove in range_dict_high:
-            remove_outliers_h(vital, X_mean, var_to_remove, range_dict_high[var_to_remove])
-        for var_to_remove in range_dict_low:
-            remove_outliers_l(vital, X_mean, var_to_remove, range_dict_low[var_to_remove])
-    else:
-        print('Skipped outlier removal')
-    del X_mean
-
-    if args.exit_point == 'Outlier_removal':
-        print('Exit point is after removing outliers, saving results...')
-        os.makedirs(args.output_dir, exist_ok=True)
-        intervention.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_inv.parquet'))
-        static.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_static.parquet'))
-        vital.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_vital.parquet'))
-        return
+    # ---- chunked vital processing to limit memory ----
+    workers = getattr(args, 'workers', 1)
+    budget = getattr(args, 'memory_budget', None)
+    budget = budget * 2 ** 30 if budget else None
+    # fine-grained event store: each raw table is binned once and shared by every time window
+    def build_store():
+        todo = []
+        for table in source['tables']:
+            path = os.path.join(store_dir, f"{table['name']}.parquet")
+            raw_path = os.path.join(raw_dir, f"{table['name']}.parquet")
+            if os.path.exists(path) and os.path.exists(raw_path) and \
+                    os.path.getmtime(raw_path) > os.path.getmtime(path):
+                # the raw table was queried again or replaced since it was binned
+                print(f"  [STALE]      {table['name']}  <-  {path}")
+                os.remove(path)
+            if force or not os.path.exists(path):
+                todo.append(table)
+        con = None
+        if todo and getattr(args, 'engine', 'pandas') == 'duckdb':
+            from duckdb_engine import connect
+            # DuckDB spills to disk past the memory budget
+            con = connect(memory_limit=budget, temp_dir=os.path.join(cache_root, 'duckdb_tmp'))
+        for table in todo:
+            cached_store(store_dir, table['name'], _source_events, source, table, raw_dir, client, patient,
+                         aggs=aggs, force=force, budget=budget, con=con)
+        if con is not None:
+            con.close()
+
+    def build_vital_chunk(ci):
+        chunk_ids = chunks[ci]
+        print(f'  Processing vital chunk {ci+1}/{n_chunks} ({len(chunk_ids)} stays)...')
+        chunk_fill = fill_df[fill_df.index.get_level_values(stay_col).isin(chunk_ids)]
+        vital_c = [_read_store(os.path.join(store_dir, f"{table['name']}.parquet"), table, stay_col, chunk_ids,
+                               chunk_fill, factor, aggs) for table in source['tables']]
+        vital_c = vital_c[0].join(vital_c[1:])
 
-    # read_mimic col means col stds
-    print('Start normalization and data imputation ')
-    # normalize
-    count_col = [i for i in total_cols if 'count' in i]
-    # # fix fio2 column by x100
-    # vital.loc[:, [('fio2', 'mean')]] = vital.loc[:, [('fio2', 'mean')]] * 100
-    # col_means, col_stds = vital.loc[:, mean_col].mean(axis=0), vital.loc[:, mean_col].std(axis=0)
-    # first use mimic mean to normorlize
-    if args.norm_eicu == 'MIMIC':
-        mimic_mean_std = pd.read_parquet(os.path.join(args.output_dir, 'MIMIC_mean_std_stats.parquet'))
-        col_means, col_stds = mimic_mean_std.loc[:, 'mean'], mimic_mean_std.loc[:, 'std']
-        col_means.index = mean_col
-        col_stds.index = mean_col
-    else:
-        col_means, col_stds = vital.loc[:, mean_col].mean(axis=0), vital.loc[:, mean_col].std(axis=0)
-    vital.loc[:, mean_col] = (vital.loc[:, mean_col] - col_means) / col_stds
-    icustay_means = vital.loc[:, mean_col].groupby(ID_COLS).mean()
-    # impute
-    vital.loc[:, mean_col] = vital.loc[:, mean_col].groupby(ID_COLS).fillna(method='ffill').groupby(ID_COLS).fillna(
-        icustay_means).fillna(0)
-    # 0 or 1
-    vital.loc[:, count_col] = (vital.loc[:, count_col] > 0).astype(float)
-    # at this satge only 3 last columns has nan values
-    vital = vital.fillna(0)
-    vital[('screen', 'last')] = vital[('screen', 'last')].astype('uint8')
-    vital[('positive', 'last')] = vital[('positive', 'last')].astype('uint8')
-    vital[('has_sensitivity', 'last')] = vital[('has_sensitivity', 'last')].astype('uint8')
-
-    if args.exit_point == 'Impute':
-        print('Exit point is after data imputation, saving results...')
-        os.makedirs(args.output_dir, exist_ok=True)
-        intervention.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_inv.parquet'))
-        static.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_static.parquet'))
-        vital.to_parquet(os.path.join(args.output_dir, 'MEEP_eICU_vital.parquet'))
-        return
+        idx = pd.IndexSlice
+        vital_c.loc[:, idx[:, ['sum', 'count']]] = vital_c.loc[:, idx[:, ['sum', 'count']]].fillna(0)
+        vital_c.drop(columns=to_drop, level=0, inplace=True, errors='ignore')
+        vital_c = combine_aggregates(vital_c, to_combine, drop=not source['keep_combined'])
+        # means (and std) are only computed once every merge is done
+        vital_c = finalize_aggregates(vital_c)
+        for c, mapping in category_maps.items():
+            vital_c[(c, 'last')] = vital_c[(c, 'last')].map(mapping)
+
+        # fixed vocabulary: every chunk gets the same one-hot columns, including categories that never occur
+        vital_c = encode_categories(vital_c, vocab)
+        # flags are last values with a float dtype, the mask tells charted from missing
+        for c in source['flags']:
+            vital_c[(c, 'mask')] = (~vital_c[(c, 'last')].isnull()).astype('uint8')
+        # variables the source does not chart
+        for c_name in columns_to_make:
+            vital_c[(c_name, 'mean')] = np.nan
+            vital_c[(c_name, 'count')] = 0
+            for s in stats:
+                vital_c[(c_name, s)] = np.nan
+
+        # compact dtypes right away: float32 statistics, uint8 masks and one-hot columns
+        return compact_vital(vital_c.reindex(columns=col_order, fill_value=0).sort_index())
+
+    def build_intervention():
+        return source['intervention'](args, client, raw_dir, patient, fill_df, force=force)
+
+    def build_static():
+        return source['static'](args, client, raw_dir, patient, fill_df, force=force)
+
+    # --- stages: each output is checkpointed under its fingerprint and only built when a later stage needs it ---
+    stage_dir = os.path.join(cache_root, "stages")
+    # normalization statistics are the source's own, or those of the source named by its norm argument
+    norm_from = getattr(args, source['norm_arg']) if 'norm_arg' in source else name
+    # the store is brought up to date first, the stages are keyed by the files they are built from
+    build_store()
+    stay_rows = fill_df.groupby(level=stay_col).size().sort_index()
+    all_stay_ids = stay_rows.index.tolist()
+    n_chunks = N_CHUNKS
+    if budget is not None:
+        # sized with the memory left once the store is built
+        n_chunks = _vital_chunk_count(len(fill_df), len(col_order), workers, _headroom(budget))
+    # contiguous ranges of stays with about the same number of rows, every stay lives in exactly one chunk;
+    # they are also the unit of work of the process pool
+    chunks = _balanced_chunks(stay_rows, min(n_chunks, len(all_stay_ids)))
+    n_chunks = len(chunks)
+    store_files = [os.path.join(store_dir, f"{table['name']}.parquet") for table in source['tables']]
+    event_tables = {f"{table['name']}.parquet" for table in source['tables']}
+    # every other raw table (cohort, intervention and static queries); group flags only select stays
+    raw_files = [os.path.join(raw_dir, f) for f in (os.listdir(raw_dir) if os.path.isdir(raw_dir) else [])
+                 if f.endswith('.parquet') and f not in event_tables and f != 'group_flags.parquet']
+    inputs = {'raw': _files_signature(raw_files), 'store': _files_signature(store_files)}
+    fp = stage_fingerprints(args, n_chunks=n_chunks, inputs=inputs)
+
+    # the vital table is never concatenated: every stage goes over the chunks, which hold whole stays
+    def vital_stage():
+        return checkpoint_chunks(stage_dir, 'vital', fp['vital'], n_chunks, build_vital_chunk, force=force,
+                                 workers=workers)
+
+    def outlier_stage():
+        if args.no_removal:
+            print('Skipped outlier removal')
+            return vital_stage()
+        vital_paths = vital_stage()
+        range_dict_low, range_dict_high = (_json(f) for f in source['outliers'])
+        low, high = compile_outlier_bounds(mean_col, range_dict_low, range_dict_high)
+        removed_total = []
+
+        def build_outlier_chunk(ci):
+            vital_c = _read_frame(vital_paths[ci])
+            return vital_c, remove_outliers(vital_c, mean_col, low, high)
 
-    # split data
-    stays_v = set(vital.index.get_level_values(0).values)
-    stays_static = set(static.index.get_level_values(0).values)
-    stays_int = set(intervention.index.get_level_values(0).values)
-    assert stays_v == stays_static, "Stay ID pools differ!"
-    assert stays_v == stays_int, "Stay ID pools differ!"
-    train_frac, dev_frac, test_frac = 0.7, 0.1, 0.2
-    SEED = 41
-    np.random.seed(SEED)
-    subjects, N = np.random.permutation(list(stays_v)), len(stays_v)
-    N_train, N_dev, N_test = int(train_frac * N), int(dev_frac * N), int(test_frac * N)
-    train_stay = list(stays_v)[:N_train]
-    dev_stay = list(stays_v)[N_train:N_train + N_dev]
-    test_stay = list(stays_v)[N_train + N_dev:]
-    def convert_dtype(df):
-        names = df.columns.to_list()
-        dtypes = df.dtypes.to_list()
-        for i, col in enumerate(df.columns.to_list()):
-            if dtypes[i] == pd.Int64Dtype():
-                df.loc[:, col] = df.loc[:, col].astype(float)
-        return df
-    static = convert_dtype(static)
-
-    [(vital_train, vital_dev, vital_test), (Y_train, Y_dev, Y_test), (static_train, static_dev, static_test)] = [
-        [df[df.index.get_level_values(0).isin(s)] for s in (train_stay, dev_stay, test_stay)] \
-        for df in (vital, intervention, static)]
-
-    if args.exit_point == 'All':
-        print('Exit point is after all steps, including train-val-test splitting, saving results...')
-        split_dir = os.path.join(args.output_dir, 'eICU_split')
-        os.makedirs(split_dir, exist_ok=True)
-        vital_train.to_parquet(os.path.join(split_dir, 'vital_train.parquet'))
-        vital_dev.to_parquet(os.path.join(split_dir, 'vital_dev.parquet'))
-        vital_test.to_parquet(os.path.join(split_dir, 'vital_test.parquet'))
-        Y_train.to_parquet(os.path.join(split_dir, 'inv_train.parquet'))
-        Y_dev.to_parquet(os.path.join(split_dir, 'inv_dev.parquet'))
-        Y_test.to_parquet(os.path.join(split_dir, 'inv_test.parquet'))
-        static_train.to_parquet(os.path.join(split_dir, 'static_train.parquet'))
-        static_dev.to_parquet(os.path.join(split_dir, 'static_dev.parquet'))
-        static_test.to_parquet(os.path.join(split_dir, 'static_test.parquet'))
+        print('Performing outlier removal')
+        paths = checkpoint_chunks(stage_dir, 'outlier', fp['outlier'], n_chunks, build_outlier_chunk, force=force,
+                                  workers=workers, collect=removed_total)
+        if removed_total:
+            _report_outliers(sum(removed_total[1:], removed_total[0]))
+        return paths
+
+    intervention = checkpoint(stage_dir, 'intervention', fp['intervention'], build_intervention, force=force)
+    static = checkpoint(stage_dir, 'static', fp['static'], build_static, force=force)
+    static['split'] = assign_split(static.index.get_level_values(split_key))
+
+    def write_group(group, stays, out_dir):
+        """Outputs of one patient group: its rows of the shared stages, normalized and imputed on their own."""
+        if stays is None:
+            group_chunks, select = list(range(n_chunks)), (lambda df: df)
+        else:
+            # only the chunks holding stays of the group are read
+            stays = set(stays)
+            group_chunks = [ci for ci, ids in enumerate(chunks) if not stays.isdisjoint(ids)]
+            select = lambda df: df[df.index.get_level_values(stay_col).isin(stays)]
+        norm_file = os.path.join(out_dir, f'{norm_from}_mean_std_stats.parquet')
+        gfp = stage_fingerprints(args, norm_file=norm_file if norm_from != name else None, n_chunks=n_chunks,
+                                 group_ids=None if stays is None else sorted(stays), inputs=inputs)
+        group_inv, group_static = select(intervention), select(static)
+        os.makedirs(out_dir, exist_ok=True)
+
+        def write_tables(vital_paths):
+            with report_stage('write') as st:
+                group_inv.to_parquet(os.path.join(out_dir, f'MEEP_{name}_inv.parquet'))
+                group_static.to_parquet(os.path.join(out_dir, f'MEEP_{name}_static.parquet'))
+                # Stream vital chunks to output without loading all into memory
+                vital_out = os.path.join(out_dir, f'MEEP_{name}_vital.parquet')
+                _stream_parquet(((None, select(_read_frame(p))) for p in vital_paths), {None: vital_out})
+                _record_files(st, [vital_out])
+                st.written(*(os.path.join(out_dir, f'MEEP_{name}_{t}.parquet') for t in ('inv', 'static', 'vital')))
+            print(f'  Vital written from {len(vital_paths)} chunks -> {vital_out}')
+
+        if args.exit_point in ('Raw', 'Outlier_removal'):
+            if args.exit_point == 'Raw':
+                print('Exit point is after querying raw records, saving results...')
+                vital_paths = vital_stage()
+            else:
+                print('Exit point is after removing outliers, saving results...')
+                vital_paths = outlier_stage()
+            write_tables([vital_paths[ci] for ci in group_chunks])
+            return
+
+        clean_paths = outlier_stage()
+
+        def build_norm_stats():
+            # moments are computed per chunk (in the workers) and merged here
+            mean_names = [str(c) for c in mean_col]
+            moments = None
+            for chunk_moments in map_workers(lambda ci: moment_stats(select(_read_frame(clean_paths[ci],
+                                                                                       columns=mean_names))),
+                                             group_chunks, workers):
+                moments = merge_moments(moments, chunk_moments)
+            col_means, col_stds = finalize_moments(moments)
+            return col_means.to_frame('mean').join(col_stds.to_frame('std'))
+
+        # saved next to the outputs, e.g. MIMIC statistics are used to normalize eICU
+        df_mean_std = checkpoint(stage_dir, 'norm_stats', gfp['norm_stats'], build_norm_stats, force=force)
+        df_mean_std.to_parquet(os.path.join(out_dir, f'{name}_mean_std_stats.parquet'))
+
+        mean_std = df_mean_std if norm_from == name else pd.read_parquet(norm_file)
+        # statistics are applied by position, they follow the order of the mean columns
+        col_means, col_stds = mean_std['mean'].to_numpy(), mean_std['std'].to_numpy()
+
+        def build_impute_chunk(k):
+            vital_c = select(_read_frame(clean_paths[group_chunks[k]]))
+            vital_c.loc[:, mean_col] = ((vital_c.loc[:, mean_col] - col_means) / col_stds).astype(np.float32)
+            # impute within each stay (default: forward fill), then the stay mean, then 0 for never observed variables
+            impute_columns(vital_c, mean_col, stay_col, strategy=args.impute, max_age=args.impute_max_age,
+                           decay=args.impute_decay)
+            # 0 or 1
+            vital_c[count_col] = (vital_c[count_col] > 0).astype('uint8')
+            # flags not charted are 0, their mask tells them apart; the optional statistics stay NaN where the
+            # variable is not observed (its count column is their mask)
+            for c in source['flags']:
+                vital_c[(c, 'last')] = vital_c[(c, 'last')].fillna(0).astype('uint8')
+            return vital_c
+
+        print('Start normalization and data imputation ')
+        impute_paths = checkpoint_chunks(stage_dir, 'impute', gfp['impute'], len(group_chunks), build_impute_chunk,
+                                         force=force, workers=workers)
+
+        if args.exit_point == 'Impute':
+            print('Exit point is after data imputation, saving results...')
+            write_tables(impute_paths)
+            return
+
+        # split data
+        stays_v = set(all_stay_ids) if stays is None else stays & set(all_stay_ids)
+        stays_static = set(group_static.index.get_level_values(stay_col).values)
+        stays_int = set(group_inv.index.get_level_values(stay_col).values)
+        assert stays_v == stays_static, "Stay ID pools differ!"
+        assert stays_v == stays_int, "Stay ID pools differ!"
+        def convert_dtype(df):
+            names = df.columns.to_list()
+            dtypes = df.dtypes.to_list()
+            for i, col in enumerate(df.columns.to_list()):
+                if dtypes[i] == pd.Int64Dtype():
+                    # replace the column, .loc can cast the values back into the Int64 column
+                    df[col] = df[col].astype(float)
+            return df
+        group_static = convert_dtype(group_static.copy())
+
+        if args.exit_point == 'All':
+            print('Exit point is after all steps, including train-val-test splitting, saving results...')
+            split_dir = os.path.join(out_dir, f'{name}_split')
+            with report_stage('write') as st:
+                # vital is split chunk by chunk as it is read, the splits never need the whole table
+                vital_paths = _write_split_dataset((_read_frame(p) for p in impute_paths),
+                                                   os.path.join(split_dir, 'vital'), split_key, args.split_buckets)
+                other_paths = [path for table, df in (('inv', group_inv), ('static', group_static))
+                               for path in _write_split_dataset([df], os.path.join(split_dir, table), split_key,
+                                                                args.split_buckets)]
+                _record_files(st, vital_paths)
+                st.written(*vital_paths, *other_paths)
+            counts = group_static['split'].value_counts()
+            print(f"  Stays per split by {split_key} hash: " +
+                  ', '.join(f'{split} {counts.get(split, 0)}' for split, _ in SPLITS) + f' -> {split_dir}')
+
+    # every patient group is a subset of the cohort: the shared stages are filtered, nothing is queried again
+    groups = _patient_groups(args)
+    flags = _group_flags(args, source, client, raw_dir, patient, groups, force=force)
+    for group in groups:
+        n_stays = int(flags[group].sum())
+        # the Generic cohort keeps the top level output directory
+        out_dir = args.output_dir if group == 'Generic' else os.path.join(args.output_dir, group)
+        if not n_stays:
+            print(f'Patient group {group} has no stays in the cohort, skipped')
+            continue
+        print(f'Patient group {group}: {n_stays} stays -> {out_dir}')
+        with report_stage(f'group/{group}', stays=n_stays):
+            write_group(group, None if group == 'Generic' else flags.index[flags[group]], out_dir)
     return
 
+
+def extract_mimic(args):
+    return extract_source(args, MIMIC_SOURCE)
+
+
+def extract_eicu(args):
+    return extract_source(args, EICU_SOURCE)
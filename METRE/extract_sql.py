@@ -10,24 +10,23 @@ def gcp2df(client, sql, job_config=None):
     return results.to_dataframe()
 
 
-def get_group_id(args, client):
-    if args.patient_group == 'sepsis_3':
-        query = \
-            """
-            SELECT  stay_id
-            FROM physionet-data.mimiciv_3_1_derived.sepsis3
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['stay_id']])
-    elif args.patient_group == 'ARF':
+# specialty cohorts, each a subset of the Generic cohort
+PATIENT_GROUPS = ['sepsis_3', 'ARF', 'shock', 'COPD', 'CHF']
+
 
-        query = \
-            """
+def get_group_id(client):
+    # membership of every icu stay in each patient group, one query with a boolean column per group
+    query = \
+        """
+        WITH sepsis_3 AS (
+            SELECT DISTINCT stay_id
+            FROM physionet-data.mimiciv_3_1_derived.sepsis3
+        ), ARF AS (
             SELECT DISTINCT stay_id
             FROM physionet-data.mimiciv_3_1_icu.chartevents
             WHERE itemid = 224700 or  itemid = 220339
 
-            UNION ALL
+            UNION DISTINCT
 
             SELECT i.stay_id
             FROM physionet-data.mimiciv_3_1_hosp.labevents l
@@ -35,16 +34,11 @@ def get_group_id(args, client):
             WHERE l.itemid = 50819 
             AND l.charttime between i.intime and i.outtime 
 
-            UNION ALL 
+            UNION DISTINCT 
 
             SELECT DISTINCT v.stay_id 
             FROM physionet-data.mimiciv_3_1_derived.ventilation v
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['stay_id']])
-    elif args.patient_group == 'Shock':
-        query = \
-            """
+        ), shock AS (
             SELECT DISTINCT stay_id
             FROM physionet-data.mimiciv_3_1_derived.vasoactive_agent
             WHERE norepinephrine is not null 
@@ -52,132 +46,76 @@ def get_group_id(args, client):
             OR dopamine is not null 
             OR vasopressin is not null 
             OR phenylephrine  is not null 
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['stay_id']])
-    elif args.patient_group == 'CHF':
-        query = \
-            """
+        ), CHF AS (
             SELECT DISTINCT i.stay_id
             FROM physionet-data.mimiciv_3_1_derived.charlson c
             LEFT JOIN physionet-data.mimiciv_3_1_icu.icustays i on c.hadm_id = i.hadm_id 
             WHERE c.congestive_heart_failure = 1 and i.stay_id is not null
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['stay_id']])
-    elif args.patient_group == 'COPD':
-        query = \
-            """
+        ), COPD AS (
             SELECT DISTINCT i.stay_id
             FROM physionet-data.mimiciv_3_1_derived.charlson c
             LEFT JOIN physionet-data.mimiciv_3_1_icu.icustays i on c.hadm_id = i.hadm_id 
             WHERE c.chronic_pulmonary_disease = 1 and i.stay_id is not null
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['stay_id']])
-    elif args.custom_id == True:
-        custom_ids = pd.read_csv(args.customid_dir)
-        group_stay_ids = set([str(s) for s in custom_ids['stay_id']])
-
-    return group_stay_ids
+        )
+        SELECT s.stay_id,
+            s.stay_id IN (SELECT stay_id FROM sepsis_3) AS sepsis_3,
+            s.stay_id IN (SELECT stay_id FROM ARF) AS ARF,
+            s.stay_id IN (SELECT stay_id FROM shock) AS shock,
+            s.stay_id IN (SELECT stay_id FROM COPD) AS COPD,
+            s.stay_id IN (SELECT stay_id FROM CHF) AS CHF
+        FROM physionet-data.mimiciv_3_1_icu.icustays s
+        """
+    return gcp2df(client, query)
 
 
 def get_patient_group(args, client):
-    # define our patient cohort by age, icu stay time
-    if args.patient_group != 'Generic':
-        query = \
-            """
-            SELECT DISTINCT
-                i.subject_id,
-                i.hadm_id,
-                i.stay_id,
-                i.gender,
-                i.admission_age as age,
-                i.race,
-                i.hospital_expire_flag,
-                i.hospstay_seq,
-                i.los_icu,
-                i.admittime,
-                i.dischtime,
-                i.icu_intime,
-                i.icu_outtime,
-                a.admission_type,
-                a.insurance,
-                a.deathtime,
-                a.discharge_location,
-                CASE when a.deathtime between i.icu_intime and i.icu_outtime THEN 1 ELSE 0 END AS mort_icu,
-                CASE when a.deathtime between i.admittime and i.dischtime THEN 1 ELSE 0 END AS mort_hosp,
-                COALESCE(f.readmission_30, 0) AS readmission_30
-            FROM physionet-data.mimiciv_3_1_derived.icustay_detail i
-                INNER JOIN physionet-data.mimiciv_3_1_hosp.admissions a ON i.hadm_id = a.hadm_id
-                INNER JOIN physionet-data.mimiciv_3_1_icu.icustays s ON i.stay_id = s.stay_id
-                LEFT OUTER JOIN (SELECT d.stay_id, 1 as readmission_30
-                            FROM physionet-data.mimiciv_3_1_icu.icustays c, physionet-data.mimiciv_3_1_icu.icustays d
-                            WHERE c.subject_id=d.subject_id
-                            AND c.stay_id > d.stay_id
-                            AND c.intime - d.outtime <= INTERVAL 30 DAY
-                            AND c.outtime = (SELECT MIN(e.outtime) from physionet-data.mimiciv_3_1_icu.icustays e 
-                                            WHERE e.subject_id=c.subject_id
-                                            AND e.intime>d.outtime) ) f
-                            ON i.stay_id=f.stay_id
-            WHERE i.hadm_id is not null and i.stay_id is not null and i.stay_id in ({group_icuids})
-                and i.hospstay_seq = 1
-                and i.icustay_seq = 1
-                and i.admission_age >= {min_age}
-                and (i.icu_outtime >= (i.icu_intime + INTERVAL {min_los} Hour))
-                and (i.icu_outtime <= (i.icu_intime + INTERVAL {max_los} Hour))
-            ORDER BY subject_id
-            ;
-            """.format(group_icuids=','.join(get_group_id(args, client)), min_age=args.age_min, min_los=args.los_min,
-                       max_los=args.los_max)
-        patient = gcp2df(client, query)
-    else:
-        query = \
-            """
-            SELECT DISTINCT
-                i.subject_id,
-                i.hadm_id,
-                i.stay_id,
-                i.gender,
-                i.admission_age as age,
-                i.race,
-                i.hospital_expire_flag,
-                i.hospstay_seq,
-                i.los_icu,
-                i.admittime,
-                i.dischtime,
-                i.icu_intime,
-                i.icu_outtime,
-                a.admission_type,
-                a.insurance,
-                a.deathtime,
-                a.discharge_location,
-                CASE when a.deathtime between i.icu_intime and i.icu_outtime THEN 1 ELSE 0 END AS mort_icu,
-                CASE when a.deathtime between i.admittime and i.dischtime THEN 1 ELSE 0 END AS mort_hosp,
-                COALESCE(f.readmission_30, 0) AS readmission_30
-            FROM physionet-data.mimiciv_3_1_derived.icustay_detail i
-                INNER JOIN physionet-data.mimiciv_3_1_hosp.admissions a ON i.hadm_id = a.hadm_id
-                INNER JOIN physionet-data.mimiciv_3_1_icu.icustays s ON i.stay_id = s.stay_id
-                LEFT OUTER JOIN (SELECT d.stay_id, 1 as readmission_30
-                            FROM physionet-data.mimiciv_3_1_icu.icustays c, physionet-data.mimiciv_3_1_icu.icustays d
-                            WHERE c.subject_id=d.subject_id
-                            AND c.stay_id > d.stay_id
-                            AND c.intime - d.outtime <= INTERVAL 30 DAY
-                            AND c.outtime = (SELECT MIN(e.outtime) from physionet-data.mimiciv_3_1_icu.icustays e 
-                                            WHERE e.subject_id=c.subject_id
-                                            AND e.intime>d.outtime) ) f
-                            ON i.stay_id=f.stay_id
-            WHERE i.hadm_id is not null and i.stay_id is not null
-                and i.hospstay_seq = 1
-                and i.icustay_seq = 1
-                and i.admission_age >= {min_age}
-                and (i.icu_outtime >= (i.icu_intime + INTERVAL {min_los} Hour))
-                and (i.icu_outtime <= (i.icu_intime + INTERVAL {max_los} Hour))
-            ORDER BY subject_id
-            ;
-            """.format(min_age=args.age_min, min_los=args.los_min, max_los=args.los_max)
+    # define our patient cohort by age, icu stay time; the patient groups are subsets of it, see get_group_id
+    query = \
+        """
+        SELECT DISTINCT
+            i.subject_id,
+            i.hadm_id,
+            i.stay_id,
+            i.gender,
+            i.admission_age as age,
+            i.race,
+            i.hospital_expire_flag,
+            i.hospstay_seq,
+            i.los_icu,
+            i.admittime,
+            i.dischtime,
+            i.icu_intime,
+            i.icu_outtime,
+            a.admission_type,
+            a.insurance,
+            a.deathtime,
+            a.discharge_location,
+            CASE when a.deathtime between i.icu_intime and i.icu_outtime THEN 1 ELSE 0 END AS mort_icu,
+            CASE when a.deathtime between i.admittime and i.dischtime THEN 1 ELSE 0 END AS mort_hosp,
+            COALESCE(f.readmission_30, 0) AS readmission_30
+        FROM physionet-data.mimiciv_3_1_derived.icustay_detail i
+            INNER JOIN physionet-data.mimiciv_3_1_hosp.admissions a ON i.hadm_id = a.hadm_id
+            INNER JOIN physionet-data.mimiciv_3_1_icu.icustays s ON i.stay_id = s.stay_id
+            LEFT OUTER JOIN (SELECT d.stay_id, 1 as readmission_30
+                        FROM physionet-data.mimiciv_3_1_icu.icustays c, physionet-data.mimiciv_3_1_icu.icustays d
+                        WHERE c.subject_id=d.subject_id
+                        AND c.stay_id > d.stay_id
+                        AND c.intime - d.outtime <= INTERVAL 30 DAY
+                        AND c.outtime = (SELECT MIN(e.outtime) from physionet-data.mimiciv_3_1_icu.icustays e 
+                                        WHERE e.subject_id=c.subject_id
+                                        AND e.intime>d.outtime) ) f
+                        ON i.stay_id=f.stay_id
+        WHERE i.hadm_id is not null and i.stay_id is not null
+            and i.hospstay_seq = 1
+            and i.icustay_seq = 1
+            and i.admission_age >= {min_age}
+            and (i.icu_outtime >= (i.icu_intime + INTERVAL {min_los} Hour))
+            and (i.icu_outtime <= (i.icu_intime + INTERVAL {max_los} Hour))
+        ORDER BY subject_id
+        ;
+        """.format(min_age=args.age_min, min_los=args.los_min, max_los=args.los_max)
 
-        patient = gcp2df(client, query)
+    patient = gcp2df(client, query)
 
     return patient
 
@@ -819,20 +757,18 @@ def query_comorbidity_mimic(client, icuids_to_keep):
     return comorbidity
 
 
-def get_group_id_eicu(args, client):
-    if args.patient_group == 'sepsis_3':
-        sepsis3_ids = pd.read_csv('./resources/eicu_sepsis_3_id.csv')
-        group_stay_ids = set([str(s) for s in sepsis3_ids['patientunitstayid']])
-    elif args.patient_group == 'ARF':
-        query = \
-            """
+def get_group_id_eicu(client):
+    # membership of every unit stay in each patient group, one query with a boolean column per group
+    query = \
+        """
+        WITH ARF AS (
             SELECT DISTINCT l.patientunitstayid
             FROM physionet-data.eicu_crd.lab l
             WHERE l.labname = 'PEEP' 
             and l.labresult >= 0 
             and l.labresult <= 30
 
-            UNION ALL
+            UNION DISTINCT
 
             SELECT DISTINCT vt.patientunitstayid 
             FROM (
@@ -845,12 +781,7 @@ def get_group_id_eicu(args, client):
             WHERE  vt.priorventstartoffset is not null 
             AND vt.priorventendoffset is not null
             AND FLOOR(LEAST(vt.priorventendoffset, i.unitdischargeoffset)/60) > FLOOR(GREATEST(vt.priorventstartoffset, 0)/60)
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['patientunitstayid']])
-    elif args.patient_group == 'Shock':
-        query = \
-            """
+        ), shock AS (
             SELECT DISTINCT pm.patientunitstayid
             FROM physionet-data.eicu_crd_derived.pivoted_med pm
             INNER JOIN physionet-data.eicu_crd_derived.icustay_detail i ON i.patientunitstayid = pm.patientunitstayid
@@ -858,74 +789,48 @@ def get_group_id_eicu(args, client):
             AND pm.drugorderoffset is not null 
             AND pm.drugstopoffset is not null
             AND FLOOR(LEAST(pm.drugstopoffset, i.unitdischargeoffset)/60) > FLOOR(GREATEST(pm.drugorderoffset, 0)/60)
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['patientunitstayid']])
-    elif args.patient_group == 'CHF':
-        query = \
-            """
+        ), CHF AS (
             SELECT DISTINCT ad.patientunitstayid
             FROM physionet-data.eicu_crd.diagnosis ad
             WHERE SUBSTR(ad.icd9code, 1, 3) = '428'
             OR SUBSTR(ad.icd9code, 1, 6) IN ('398.91','402.01','402.11','402.91','404.01','404.03',
                                     '404.11','404.13','404.91','404.93')
             OR SUBSTR(ad.icd9code, 1, 5) BETWEEN '425.4' AND '425.9'
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['patientunitstayid']])
-    elif args.patient_group == 'COPD':
-        query = \
-            """
+        ), COPD AS (
             SELECT DISTINCT ad.patientunitstayid
             FROM physionet-data.eicu_crd.diagnosis ad
             WHERE SUBSTR(ad.icd9code, 1, 3) BETWEEN '490' AND '505'
             OR SUBSTR(ad.icd9code, 1, 5) IN ('416.8','416.9','506.4','508.1','508.8')
-            """
-        id_df = gcp2df(client, query)
-        group_stay_ids = set([str(s) for s in id_df['patientunitstayid']])
-    elif args.custom_id:
-        custom_ids = pd.read_csv(args.customid_dir)
-        group_stay_ids = set([str(s) for s in custom_ids['stay_id']])
-
-    return group_stay_ids
+        )
+        SELECT p.patientunitstayid,
+            p.patientunitstayid IN (SELECT patientunitstayid FROM ARF) AS ARF,
+            p.patientunitstayid IN (SELECT patientunitstayid FROM shock) AS shock,
+            p.patientunitstayid IN (SELECT patientunitstayid FROM COPD) AS COPD,
+            p.patientunitstayid IN (SELECT patientunitstayid FROM CHF) AS CHF
+        FROM physionet-data.eicu_crd.patient p
+        """
+    # sepsis-3 stays are not queried, they come from an id file (EICU_SOURCE['group_files'])
+    flags = gcp2df(client, query)
+    return flags
 
 
 def get_patient_group_eicu(args, client):
-    if args.patient_group != 'Generic':
-        query = \
-            """
-            SELECT i.patientunitstayid, i.gender, i.age, i.ethnicity,  
-                    CASE WHEN lower(i.hospitaldischargestatus) like '%alive%' THEN 0
-                        WHEN lower(i.hospitaldischargestatus) like '%expired%' THEN 1
-                        ELSE NULL END AS hosp_mort,
-                    ROUND(i.unitdischargeoffset/60) AS icu_los_hours, i.hospitaladmitoffset, i.hospitaldischargeoffset,
-                   i.unitdischargeoffset, i.hospitaladmitsource, i.unitdischargelocation, 
-                   CASE WHEN lower(i.unitdischargestatus) like '%alive%' THEN 0
-                        WHEN lower(i.unitdischargestatus) like '%expired%' THEN 1
-                        ELSE NULL END AS icu_mort, i.hospitaldischargeyear, i.hospitalid      
-            From physionet-data.eicu_crd.patient i
-            WHERE ROUND(i.unitdischargeoffset/60) Between {min_los} and {max_los} 
-            AND patientunitstayid in ({group_icuids})
-            """.format(group_icuids=','.join(get_group_id_eicu(args, client)), min_los=args.los_min,
-                       max_los=args.los_max)
-        patient = gcp2df(client, query)
-
-    else:
-        query = \
-            """
-            SELECT i.patientunitstayid, i.gender, i.age, i.ethnicity,  
-                    CASE WHEN lower(i.hospitaldischargestatus) like '%alive%' THEN 0
-                        WHEN lower(i.hospitaldischargestatus) like '%expired%' THEN 1
-                        ELSE NULL END AS hosp_mort,
-                    ROUND(i.unitdischargeoffset/60) AS icu_los_hours, i.hospitaladmitoffset, i.hospitaldischargeoffset,
-                   i.unitdischargeoffset, i.hospitaladmitsource, i.unitdischargelocation, 
-                   CASE WHEN lower(i.unitdischargestatus) like '%alive%' THEN 0
-                        WHEN lower(i.unitdischargestatus) like '%expired%' THEN 1
-                        ELSE NULL END AS icu_mort, i.hospitaldischargeyear, i.hospitalid      
-            From physionet-data.eicu_crd.patient i
-            WHERE ROUND(i.unitdischargeoffset/60) Between {min_los} and {max_los} 
-            """.format(min_los=args.los_min, max_los=args.los_max)
-        patient = gcp2df(client, query)
+    # unit stays by length; the patient groups are subsets of them, see get_group_id_eicu
+    query = \
+        """
+        SELECT i.patientunitstayid, i.gender, i.age, i.ethnicity,  
+                CASE WHEN lower(i.hospitaldischargestatus) like '%alive%' THEN 0
+                    WHEN lower(i.hospitaldischargestatus) like '%expired%' THEN 1
+                    ELSE NULL END AS hosp_mort,
+                ROUND(i.unitdischargeoffset/60) AS icu_los_hours, i.hospitaladmitoffset, i.hospitaldischargeoffset,
+               i.unitdischargeoffset, i.hospitaladmitsource, i.unitdischargelocation, 
+               CASE WHEN lower(i.unitdischargestatus) like '%alive%' THEN 0
+                    WHEN lower(i.unitdischargestatus) like '%expired%' THEN 1
+                    ELSE NULL END AS icu_mort, i.hospitaldischargeyear, i.hospitalid      
+        From physionet-data.eicu_crd.patient i
+        WHERE ROUND(i.unitdischargeoffset/60) Between {min_los} and {max_los} 
+        """.format(min_los=args.los_min, max_los=args.los_max)
+    patient = gcp2df(client, query)
 
     return patient
 
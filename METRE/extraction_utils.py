@@ -1,3 +1,6 @@
+import glob
+import os
+import warnings
 import pandas as pd
 import numpy as np
 '''
@@ -8,40 +11,163 @@ Pipeline for MIMIC-III. arXiv:1907.08322.
 '''
 ID_COLS = ['subject_id', 'hadm_id', 'stay_id']
 ITEM_COLS = ['itemid', 'label', 'LEVEL1', 'LEVEL2']
+# width of the fine bins in the cached event store, any time_window (in hours) is rolled up from these
+BASE_BIN_MINUTES = 15
+# optional statistics on top of mean and count, see aggregate_state
+EXTRA_STATS = ['min', 'max', 'last', 'std', 'time']
+# how each piece of aggregate state merges across bins (rollup) or across itemids (combine)
+STATE_REDUCERS = {'sum': 'sum', 'count': 'sum', 'sumsq': 'sum', 'min': 'min', 'max': 'max',
+                  't_first': 'min', 't_last': 'max', 'last': 'last'}
 
 
-def combine_cols(col_1, col_2):
+def aggregate_state(extra_stats=()):
     """
-    Combine columns from different itemids but same measurement
-    :param col_1: columns to be removed after merging
-    :param col_2: columns to be kept after merging
-    :return: col_2:
+    Aggregate state kept in the event store for the requested extra statistics
+    :param extra_stats: list, any of EXTRA_STATS, e.g. ['min', 'max', 'std']
+    :return: aggs: tuple, e.g. ('sum', 'count', 'min', 'max', 'sumsq')
     """
-    col_2.columns.names = ['LEVEL2', 'Aggregation Function']
-    col_1 = col_1.droplevel(level=0, axis=1)
-    col_2 = col_2.droplevel(level=0, axis=1)
-
-    # or_filled = len(b) - b.loc[:, 'mean'].isnull().sum()
-    # or_mean = b.loc[:, 'mean'].dropna().mean()
-
-    row_mask = (col_1.loc[:, 'count'] > 0).values
-    mask = (col_2.loc[:, 'count'] > 0).values
+    state = {'min': ['min'], 'max': ['max'], 'last': ['last'], 'std': ['sumsq'], 'time': ['t_first', 't_last']}
+    aggs = ['sum', 'count']
+    for s in EXTRA_STATS:
+        if s in extra_stats:
+            aggs += state[s]
+    return tuple(aggs)
+
+def output_stats(extra_stats=()):
+    """
+    Level-1 names of the optional column groups in the vital output, in a fixed order
+    :param extra_stats: list, any of EXTRA_STATS
+    :return: list, e.g. ['min', 'max', 'std', 't_first', 't_last']
+    """
+    names = {'min': ['min'], 'max': ['max'], 'last': ['last'], 'std': ['std'], 'time': ['t_first', 't_last']}
+    return [n for s in EXTRA_STATS if s in extra_stats for n in names[s]]
 
-    c = col_2.loc[row_mask * mask, 'count'].mul(col_2.loc[row_mask * mask, 'mean'].values) + \
-        col_1.loc[row_mask * mask, 'count'].mul(col_1.loc[row_mask * mask, 'mean'].values)
-    d = col_2.loc[row_mask * mask, 'count'] + col_1.loc[row_mask * mask, 'count']
+def combine_aggregates(df, pairs, drop=True):
+    """
+    Combine columns from different itemids but same measurement, in one batched pass.
+    Aggregates are kept as mergeable state (sum, count and optionally sumsq, min, max, last, t_first, t_last),
+    so merging a makeup column into its target is an add / min / max, see STATE_REDUCERS.
+    Pairs are applied in list order, i.e. a column that was itself filled earlier in the list
+    (e.g. 'Potassium' <- 'Potassium serum', then 'potassium' <- 'Potassium') carries its makeups along.
+    'last' takes the value from the source charted last when t_last is kept, otherwise the target wins.
+    :param df: pd.DataFrame, columns are a multiindex, level 0: variable name, level 1: sum, count (and others)
+    :param pairs: list, [target, makeup] pairs, e.g. [['so2', 'spo2'], ['fio2', 'fio2_chartevents']]
+    :param drop: bool, whether to drop the makeup columns after merging
+    :return: df: pd.DataFrame, same row index, target columns hold the merged aggregate state
+    """
+    # resolve the pair list into target -> all original columns that flow into it
+    sources = {}
+    for target, makeup in pairs:
+        sources[target] = sources.get(target, [target]) + sources.get(makeup, [makeup])
+
+    # read every merged column from the original state before writing any of them back
+    merged = {}
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for target, names in sources.items():
+            state = [a for a in STATE_REDUCERS if (target, a) in df.columns]
+            for agg in state:
+                loc = [df.columns.get_loc((n, agg)) for n in names]
+                values = df.iloc[:, loc].to_numpy(dtype=float)
+                reducer = STATE_REDUCERS[agg]
+                if reducer == 'sum':
+                    merged[(target, agg)] = np.nansum(values, axis=1)
+                elif reducer == 'min':
+                    merged[(target, agg)] = np.nanmin(values, axis=1)
+                elif reducer == 'max':
+                    merged[(target, agg)] = np.nanmax(values, axis=1)
+                else:
+                    if 't_last' in state:
+                        t_loc = [df.columns.get_loc((n, 't_last')) for n in names]
+                        order = np.nan_to_num(df.iloc[:, t_loc].to_numpy(dtype=float), nan=-np.inf)
+                    else:
+                        order = -np.arange(len(names), dtype=float)[None, :].repeat(len(values), axis=0)
+                    order = np.where(np.isnan(values), -np.inf, order)
+                    merged[(target, agg)] = np.take_along_axis(values, order.argmax(axis=1)[:, None], axis=1)[:, 0]
+    for c, values in merged.items():
+        df[c] = values
+
+    if drop:
+        makeups = list(dict.fromkeys(m for _, m in pairs))
+        df.drop(columns=makeups, level=0, inplace=True)
+    return df
 
-    col_2.loc[row_mask * mask, 'mean'] = c / d
-    col_2.loc[:, 'count'] = col_2.loc[:, 'count'] + col_1.loc[:, 'count']
+def finalize_aggregates(df):
+    """
+    Turn the aggregate state into output statistics, once all merges are done:
+    'sum' becomes 'mean' (NaN where count is 0) and 'sumsq' becomes the sample 'std' (NaN where count < 2)
+    :param df: pd.DataFrame, columns are a multiindex, level 0: variable name, level 1: sum, count (and others)
+    :return: df: pd.DataFrame, 'sum' columns replaced by 'mean', 'sumsq' columns by 'std'
+    """
+    sum_cols = [c for c in df.columns if c[1] == 'sum']
+    count_cols = [(c[0], 'count') for c in sum_cols]
+    sums = df.loc[:, sum_cols].to_numpy(dtype=float)
+    counts = df.loc[:, count_cols].to_numpy(dtype=float)
+    sq_cols = [c for c in df.columns if c[1] == 'sumsq']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if sq_cols:
+            sq_pos = [sum_cols.index((c[0], 'sum')) for c in sq_cols]
+            s, n = sums[:, sq_pos], counts[:, sq_pos]
+            # integer valued variables (e.g. eICU) have a nullable sumsq, missing where not charted
+            var = (df.loc[:, sq_cols].to_numpy(dtype=float, na_value=np.nan) - s * s / n) / (n - 1)
+            df.loc[:, sq_cols] = np.where(n > 1, np.sqrt(np.clip(var, 0, None)), np.nan)
+        df.loc[:, sum_cols] = np.where(counts > 0, sums / counts, np.nan)
+    rename = {'sum': 'mean', 'sumsq': 'std'}
+    df.columns = pd.MultiIndex.from_tuples([(c[0], rename.get(c[1], c[1])) for c in df.columns],
+                                           names=df.columns.names)
+    return df
 
-    col_2.loc[~mask, 'mean'] = col_1.loc[~mask, 'mean']
+def encode_categories(df, vocab):
+    """
+    One-hot encode categorical columns against a fixed vocabulary, in place of pd.get_dummies:
+    every category gets a uint8 column whether or not it occurs, so chunks share one column set
+    :param df: pd.DataFrame, e.g. the vital table, columns are a multiindex
+    :param vocab: dict, categorical column -> categories, e.g. {('culturesite', 'last'): ['culturesite0', ...]}
+    :return: df: pd.DataFrame, columns flattened to tuples, the categorical columns replaced by one-hot columns
+                named as pd.get_dummies would, e.g. "('culturesite', 'last')_culturesite0", appended at the end;
+                missing values and categories outside the vocabulary encode as all zeros
+    """
+    encoded = {}
+    for col, categories in vocab.items():
+        codes = pd.Categorical(df[col], categories=categories).codes
+        onehot = np.zeros((len(df), len(categories)), dtype=np.uint8)
+        rows = np.flatnonzero(codes >= 0)
+        onehot[rows, codes[rows]] = 1
+        for j, category in enumerate(categories):
+            encoded[f'{col}_{category}'] = onehot[:, j]
+    df = df.drop(columns=list(vocab))
+    df.columns = df.columns.to_flat_index()
+    return pd.concat([df, pd.DataFrame(encoded, index=df.index)], axis=1)
+
+def compact_vital(df):
+    """
+    Dtype compaction of a vital table: masks and one-hot columns (flat string names) become uint8, every other
+    numeric column (means, counts, culture flags, optional statistics) float32
+    :param df: pd.DataFrame, vital table
+    :return: df: pd.DataFrame, same values with compact dtypes
+    """
+    dtypes = {}
+    for c in df.columns:
+        if pd.api.types.is_numeric_dtype(df[c].dtype):
+            dtypes[c] = np.uint8 if isinstance(c, str) or c[-1] == 'mask' else np.float32
+    return df.astype(dtypes)
 
-    # c_filled = len(b) - b.loc[:, 'mean'].isnull().sum()
-    # c_mean = b.loc[:, 'mean'].dropna().mean()
+def compact_indicators(df, cols):
+    """
+    Dtype compaction of intervention indicators, 0/1 columns become uint8
+    :param df: pd.DataFrame, intervention table, missing hours already filled with 0
+    :param cols: list, indicator columns, e.g. ['vent', 'antibiotic', ...]
+    :return: df: pd.DataFrame, same values with compact dtypes
+    """
+    return df.astype({c: np.uint8 for c in cols})
 
-    # print('Original mean is %.3f, original filled is %d\nCombined mean is %.3f, combined filled is %d\n' % (
-    # or_mean, or_filled, c_mean, c_filled))
-    return col_2
+def compact_static(df):
+    """
+    Dtype compaction of a static table, string columns become categoricals
+    :param df: pd.DataFrame, static table, e.g. gender, ethnicity, anchor_year_group
+    :return: df: pd.DataFrame, same values with compact dtypes
+    """
+    return df.astype({c: 'category' for c in df.columns if df[c].dtype == object})
 
 def range_unnest(df, col, out_col_name=None, reset_index=False):
     """
@@ -65,250 +191,399 @@ def range_unnest(df, col, out_col_name=None, reset_index=False):
         col_flat = col_flat.set_index(df.index.names[0])
     return col_flat
 
-def process_query_results(df, fill_df):
+def to_bins(delta, bin_minutes=BASE_BIN_MINUTES, clip=True):
+    """
+    Map the time elapsed since ICU admission onto the fine bins of the event store
+    :param delta: pd.Series, timedelta (MIMIC, charttime - icu_intime) or minute offsets (eICU, e.g. chartoffset)
+    :param bin_minutes: int, width of one fine bin in minutes
+    :param clip: bool, whether to move events charted before admission into bin 0
+    :return: pd.Series, float bin index (NaN where the time is missing)
+    """
+    if pd.api.types.is_timedelta64_dtype(delta):
+        delta = delta / pd.Timedelta(minutes=1)
+    bins = np.floor(delta.astype(float) / bin_minutes)
+    if clip:
+        bins = bins.clip(lower=0)
+    return bins
+
+def window_factor(time_window, bin_minutes=BASE_BIN_MINUTES):
+    """
+    Number of fine bins in one time window
+    :param time_window: int, time window in hours, e.g. 1, 2, 4
+    :param bin_minutes: int, width of one fine bin in minutes
+    :return: int, e.g. 4 for a 1h window over 15-minute bins
+    """
+    if (60 * time_window) % bin_minutes != 0:
+        raise ValueError(f'time_window of {time_window}h is not a multiple of the {bin_minutes}-minute store bins')
+    return 60 * time_window // bin_minutes
+
+def aggregate_events(df, id_cols, bin_col='bin', aggs=('sum', 'count'), time_col=None):
+    """
+    Aggregate raw events into the fine-grained event store. All statistics are reductions over one shared
+    groupby of the events (the groups are factorized once), squared values and charting times ride along
+    as extra columns of the same frame.
+    :param df: pd.DataFrame, raw events with id columns, a fine bin column (see to_bins) and value columns
+    :param id_cols: list, e.g. ['subject_id', 'hadm_id', 'stay_id'] or ['patientunitstayid']
+    :param bin_col: str, name of the fine bin column
+    :param aggs: tuple, aggregate state, ('sum', 'count') plus any of 'sumsq', 'min', 'max', 'last', 't_first',
+                't_last' for measurements (see aggregate_state), or ('last',) for categories
+    :param time_col: str, column with the charting time in minutes since admission, used to order 'last' and
+                for 't_first' / 't_last'; it is not aggregated itself
+    :return: df: pd.DataFrame, index: id_cols + bin_col, column becomes a multiindex,
+                e.g. level 0: so2, level 1: sum, count
     """
-    :param df: pd.DataFrame, results after query, shape e.g. (237081, 27)
-    :param fill_df: pd.DataFrame, a multiindex template, indices: subject_id hadm_id stay_id hours_in,
-                    shape e.g. (2697900, 1)
-    :return: df: pd.DataFrame, dataframe after filling query results into the template and
-                apply aggregation function, shape e.g. (2697900, 44), with row index same as fill_df
-                but column becomes a multiindex, e.g. level 0: so2, level 1: mean, count
+    df = df.dropna(subset=[bin_col])
+    df = df.assign(**{bin_col: df[bin_col].astype('int64')})
+    if time_col is not None and 'last' in aggs:
+        df = df.sort_values(time_col, kind='stable')
+    keys = id_cols + [bin_col]
+    values = [c for c in df.columns if c not in keys and c != time_col]
+    extra = {}
+    if 'sumsq' in aggs:
+        extra['sumsq'] = df[values].apply(pd.to_numeric, errors='coerce') ** 2
+    if 't_first' in aggs or 't_last' in aggs:
+        times = df[values].notna().to_numpy()
+        extra['time'] = pd.DataFrame(np.where(times, df[[time_col]].to_numpy(dtype=float), np.nan),
+                                     index=df.index, columns=values)
+    frame = pd.concat([df[keys + values]] + [e.add_prefix(f'{k}\0') for k, e in extra.items()], axis=1)
+    grouped = frame.groupby(keys)
+
+    parts = {}
+    for agg in aggs:
+        if agg == 'sumsq':
+            part = grouped[[f'sumsq\0{v}' for v in values]].sum()
+        elif agg in ('t_first', 't_last'):
+            part = getattr(grouped[[f'time\0{v}' for v in values]], 'min' if agg == 't_first' else 'max')()
+        else:
+            part = getattr(grouped[values], agg)()
+        part.columns = values
+        parts[agg] = part
+    df = pd.concat(parts, axis=1).swaplevel(axis=1)
+    return df.reindex(columns=pd.MultiIndex.from_product([values, list(aggs)]))
+
+def rollup_events(df, factor, fill_df=None, bin_level='bin'):
     """
-    df = df.groupby(ID_COLS + ['hours_in']).agg(['mean', 'count'])
-    df.index = df.index.set_levels(df.index.levels[1].astype(int), level=1)
-    df = df.reindex(fill_df.index)
+    Roll event store entries up to a coarser time window and fill them into the template
+    :param df: pd.DataFrame, store entries from aggregate_events, index: id levels + bin_level
+    :param factor: int, number of fine bins per time window, see window_factor
+    :param fill_df: pd.DataFrame, a multiindex template, indices: id levels + hours_in, None to skip reindexing
+    :return: df: pd.DataFrame, index: id levels + hours_in, each piece of aggregate state merged across the
+                window as in STATE_REDUCERS, e.g. sum/count added up, last keeps the last non-null value
+    """
+    keys = [df.index.get_level_values(n) for n in df.index.names if n != bin_level]
+    hours = pd.Index(df.index.get_level_values(bin_level) // factor, name='hours_in')
+    grouped = df.groupby(keys + [hours])
+    by_reducer = {}
+    for c in df.columns:
+        by_reducer.setdefault(STATE_REDUCERS[c[-1]], []).append(c)
+    parts = [getattr(grouped[cols], reducer)() for reducer, cols in by_reducer.items()]
+    df = pd.concat(parts, axis=1)[df.columns]
+    if fill_df is not None:
+        df = df.reindex(fill_df.index)
     return df
 
-def compile_intervention(inv_query, c, time_window=1):
-    """
-    Organize queried intervention table
-    :param inv_query: pd.DataFrame, Queried intervention results, shape e.g.  (54257, 8)
-                    columns, e.g. subject_id, hadm_id, stay_id, starttime, endtime, icu_intime, icu_outtime, max_hours
-    :param c: str, column name of the intervention procedure, e.g. 'vent'
-    :return: inv_query: pd.DataFrame, after organizing, the last column will indicate a state at that hour (0 or 1)
-                    columns, e.g. stay_id, subject_id, hadm_id, hours_in, vent, shape e.g. (2290028, 5)
-    """
-    # df_copy = df.copy(deep=True)
-    to_hours = lambda x: max(0, x.days * 24//time_window + x.seconds // (3600 * time_window))
-    inv_query['max_hours'] = (inv_query['icu_outtime'] - inv_query['icu_intime']).apply(to_hours)
-    inv_query.loc[:, 'starttime'] = inv_query.loc[:, ['starttime', 'icu_intime']].max(axis=1)
-    inv_query.loc[:, 'endtime'] = inv_query.loc[:, ['endtime', 'icu_outtime']].min(axis=1)
-    inv_query['starttime'] = inv_query['starttime'] - inv_query['icu_intime']
-    inv_query['starttime'] = inv_query.starttime.apply(to_hours) #lambda x: x.days * 24 + x.seconds // 3600)
-    inv_query['endtime'] = inv_query['endtime'] - inv_query['icu_intime']
-    inv_query['endtime'] = inv_query.endtime.apply(to_hours) #lambda x: x.days * 24 + x.seconds // 3600)
-    if c == 'antibiotics':
-        inv_query = inv_query.groupby('stay_id').apply(add_antibitics_indicators)
-    else:
-        inv_query = inv_query.groupby('stay_id').apply(add_outcome_indicators)
-
-    inv_query.rename(columns={'on': c}, inplace=True)
-    # heparin_2.rename(columns={'values': c + ' conc'}, inplace=True)
-    inv_query = inv_query.reset_index(level='stay_id')
-    return inv_query
-
-def add_outcome_indicators(out_gb):
-    """
-    Iterate a groupby object and add intervention procedure indicator
-    :param out_gb: Pandas groupby object, specific intervention variable grouped by e.g. 'stay_id'
-    :return: pd.DataFrame, for each stay_id, iterate through the hours with the procedure, represent it by 1
-                for any other hours, fill 0, shape e.g. (2290028, 5)
-    """
-    subject_id = out_gb['subject_id'].unique()[0]
-    hadm_id = out_gb['hadm_id'].unique()[0]
-    # icustay_id = out_gb['stay_id'].unique()[0]
-    max_hrs = out_gb['max_hours'].unique()[0]
-    on_hrs = set()
-    # on_values = []
-
-    # p_set = on_hrs.copy()
-    for index, row in out_gb.iterrows():
-        on_hrs.update(range(row['starttime'], row['endtime'] + 1))
-        # if on_hrs - p_set:
-        # only when sets updates, append a value
-        # on_values.append([row['values']]*len(on_hrs - p_set))
-        # p_set = on_hrs.copy()
-
-    off_hrs = set(range(max_hrs + 1)) - on_hrs
-    # values flatten a nested list
-    # values = [0]*len(off_hrs) + [item for sublist in on_values for item in sublist]
-    on_vals = [0] * len(off_hrs) + [1] * len(on_hrs)
-    hours = list(off_hrs) + list(on_hrs)
-    return pd.DataFrame({'subject_id': subject_id, 'hadm_id': hadm_id,
-                         'hours_in': hours, 'on': on_vals})  # icustay_id': icustay_id})
-
-def add_antibitics_indicators(out_gb):
-    """
-    Iterate a groupby object and add intervention procedure indicator --- antibiotics version
-    :param out_gb: Pandas groupby object, specific intervention variable grouped by e.g. 'stay_id'
-    :return: pd.DataFrame, for each stay_id, iterate through the hours with the antibitics name and route
-            shape e.g. (1964815, 6), column names: stay_id, subject_id, hadm_id, hours_in, antibiotic, route
-    """
-    subject_id = out_gb['subject_id'].unique()[0]
-    hadm_id = out_gb['hadm_id'].unique()[0]
-    # icustay_id = out_gb['stay_id'].unique()[0]
-    max_hrs = out_gb['max_hours'].unique()[0]
-    on_hrs = set()
-    on_values = []
-    on_route = []
-
-    p_set = on_hrs.copy()
-    for index, row in out_gb.iterrows():
-        on_hrs.update(range(row['starttime'], row['endtime'] + 1))
-        if on_hrs - p_set:
-            # only when sets updates, append a value
-            on_values.append([row['antibiotic']] * len(on_hrs - p_set))
-            on_route.append([row['route']] * len(on_hrs - p_set))
-
-        p_set = on_hrs.copy()
-
-    off_hrs = set(range(max_hrs + 1)) - on_hrs
-    # values flatten a nested list
-    values = [np.nan] * len(off_hrs) + [item for sublist in on_values for item in sublist]
-    route = [np.nan] * len(off_hrs) + [item for sublist in on_route for item in sublist]
-    # on_vals = [0]*len(off_hrs) + [1]*len(on_hrs)
-    hours = list(off_hrs) + list(on_hrs)
-    return pd.DataFrame({'subject_id': subject_id, 'hadm_id': hadm_id,
-                         'hours_in': hours, 'antibiotic': values, 'route': route})  # icustay_id': icustay_id})
-
-def add_blank_indicators(out_gb):
-    """
-    Function to add blank indicator for stays with no ventilation records
-    :param out_gb: Pandas groupby object, grouped from a dataframe
-    :return: pd.DataFrame, shape e.g. (407872, 4), index: stay_id, column names: subject_id, hadm_id, hours_in, on
-            with on being all 0s
-    """
-    subject_id = out_gb['subject_id'].unique()[0]
-    hadm_id = out_gb['hadm_id'].unique()[0]
-    # icustay_id = out_gb['icustay_id'].unique()[0]
-    max_hrs = out_gb['max_hours'].unique()[0]
-
-    hrs = range(max_hrs + 1)
-    vals = list([0] * len(hrs))
-    return pd.DataFrame({'subject_id': subject_id, 'hadm_id': hadm_id,
-                         'hours_in': hrs, 'on': vals})  # 'icustay_id': icustay_id,
-
-
-def continuous_outcome_processing(out_data, data, icustay_timediff):
-    '''
-
-    :param out_data:
-    :param data:
-    :param icustay_timediff:
-    :return:
-    '''
-    to_hours = lambda x: max(0, x.days * 24 // time_window + x.seconds // (3600 * time_window))
-    out_data['icu_intime'] = out_data['stay_id'].map(data['icu_intime'].to_dict())
-    out_data['icu_outtime'] = out_data['stay_id'].map(data['icu_outtime'].to_dict())
-    out_data['max_hours'] = out_data['stay_id'].map(icustay_timediff)
-    out_data['starttime'] = out_data['starttime'] - out_data['icu_intime']
-    out_data['starttime'] = out_data.starttime.apply(to_hours)  #lambda x: x.days * 24 + x.seconds // 3600)
-    out_data['endtime'] = out_data['endtime'] - out_data['icu_intime']
-    out_data['endtime'] = out_data.endtime.apply(to_hours) #lambda x: x.days * 24 + x.seconds // 3600)
-    out_data = out_data.groupby(['stay_id'])
-    return out_data
-
-def remove_outliers_h(X, X_or, col, range):
-    """
-    Remove entries higher than a threshold and set count column to 0
-    :param X: pd.DataFrame, all the columns with mean columns to be changed
-    :param X_or: pd.DataFrame, all the mean columns with original values
-    :param col: str, name of the column to be cleaned
-    :param range: int, the threshold value
-    :return: None,
-    """
-    X.loc[:, [(col, 'mean')]] = X.loc[:, [(col, 'mean')]].mask((X_or.loc[:, [(col, 'mean')]] > range).values)
-    X.loc[:, [(col, 'count')]] = X.loc[:, [(col, 'count')]].mask((X_or.loc[:, [(col, 'mean')]] > range).values, other=0.0)
-    return
+def rollup_intervals(df, tw_in_min, cols=('starttime', 'endtime', 'max_hours')):
+    """
+    Coarsen minute-resolution intervention intervals to time windows, FLOOR(FLOOR(x/1)/tw) == FLOOR(x/tw)
+    :param df: pd.DataFrame, queried intervention results with tw_in_minutes=1, e.g. from query_vent_eicu
+    :param tw_in_min: int, time window in minutes
+    :return: df: pd.DataFrame, a new dataframe with the interval columns in time windows
+    """
+    return df.assign(**{c: df[c] // tw_in_min for c in cols})
 
-def remove_outliers_l(X, X_or, col, range):
+def interval_hours(df, time_window=1, start='starttime', end='endtime', intime='icu_intime', outtime='icu_outtime'):
     """
-    Remove entries lower than a threshold and set count column to 0
-    :param X: pd.DataFrame, all the columns with mean columns to be changed
-    :param X_or: pd.DataFrame, all the mean columns with original values
-    :param col: str, name of the column to be cleaned
-    :param range: int, the threshold value
-    :return: None,
+    Intervention intervals in time windows since ICU admission, clipped to the stay
+    :param df: pd.DataFrame, queried intervals with timestamps, e.g. from query_vent_mimic, columns include
+                stay_id, starttime, endtime, icu_intime, icu_outtime
+    :param time_window: int, time window in hours
+    :return: df: pd.DataFrame, the same rows with starttime and endtime as the first and last window (inclusive),
+                floor((t - icu_intime) / time_window) like the vital template, never before window 0
     """
-    X.loc[:, [(col, 'mean')]] = X.loc[:, [(col, 'mean')]].mask((X_or.loc[:, [(col, 'mean')]] < range).values)
-    X.loc[:, [(col, 'count')]] = X.loc[:, [(col, 'count')]].mask((X_or.loc[:, [(col, 'mean')]] < range).values, other=0.0)
-    return
+    window = pd.Timedelta(hours=time_window)
+    # missing start/end times fall back to the admission/discharge time
+    starts = df[start].where(df[start] > df[intime], df[intime])
+    ends = df[end].where(df[end] < df[outtime], df[outtime])
+    return df.assign(**{start: np.maximum(0, (starts - df[intime]) // window).astype(int),
+                        end: np.maximum(0, (ends - df[intime]) // window).astype(int)})
+
+def assemble_indicators(index, level, intervals, start='starttime', end='endtime'):
+    """
+    Intervention table from hour intervals, every source written straight into its column of one uint8 matrix
+    :param index: pd.MultiIndex, stay-hour rows grouped by stay with hours_in 0..max_hours in order,
+                e.g. the sorted fill_df template
+    :param level: str, level that tells stays apart, e.g. 'stay_id' or 'patientunitstayid'
+    :param intervals: dict, column name -> pd.DataFrame of intervals with columns level, start and end
+                (first and last window, inclusive); stays outside index and windows past a stay are ignored
+    :return: df: pd.DataFrame, index: index, one uint8 column per entry of intervals in order,
+                1 for the hours covered by any interval, else 0
+    """
+    offsets = stay_offsets(index, level)
+    n_hours = np.diff(offsets)
+    hours = index.get_level_values('hours_in').to_numpy()
+    if not np.array_equal(hours, np.arange(len(index)) - np.repeat(offsets[:-1], n_hours)):
+        raise ValueError('hours_in of every stay must run from 0 without gaps, sort the index first')
+    stays = pd.Index(index.get_level_values(level)[offsets[:-1]])
+    out = np.zeros((len(index), len(intervals)), dtype=np.uint8)
+    for j, df in enumerate(intervals.values()):
+        if df.empty:
+            continue
+        pos = stays.get_indexer(df[level])
+        known = pos >= 0
+        pos = pos[known]
+        first = df[start].to_numpy()[known].astype(np.int64)
+        last = np.minimum(df[end].to_numpy()[known].astype(np.int64), n_hours[pos] - 1)
+        first = np.maximum(first, 0)
+        lengths = np.maximum(last - first + 1, 0)
+        # rows first..last of every interval, as one flat array of row numbers
+        shift = offsets[pos] + first - (np.cumsum(lengths) - lengths)
+        out[np.repeat(shift, lengths) + np.arange(lengths.sum()), j] = 1
+    return pd.DataFrame(out, index=index, columns=list(intervals))
+
+def compile_outlier_bounds(mean_cols, range_dict_low, range_dict_high):
+    """
+    Compile the outlier thresholds into bound vectors aligned to the mean columns
+    :param mean_cols: list, mean columns of the vital table, e.g. [('so2', 'mean'), ('po2', 'mean'), ...]
+    :param range_dict_low: dict, variable -> lowest valid value, e.g. loaded from mimic_outlier_low.json
+    :param range_dict_high: dict, variable -> highest valid value, e.g. loaded from mimic_outlier_high.json
+    :return: low, high: np.ndarray, one bound per mean column, -inf / inf where no rule applies
+    """
+    position = {c[0]: i for i, c in enumerate(mean_cols)}
+    low = np.full(len(mean_cols), -np.inf)
+    high = np.full(len(mean_cols), np.inf)
+    for bounds, range_dict in [(low, range_dict_low), (high, range_dict_high)]:
+        for var, threshold in range_dict.items():
+            if var not in position:
+                raise KeyError(f'Outlier threshold given for {var}, which has no mean column')
+            bounds[position[var]] = threshold
+    return low, high
+
+def remove_outliers(X, mean_cols, low, high):
+    """
+    Remove entries outside [low, high] in one broadcast comparison: the mean becomes NaN, the count 0
+    and optional statistics of the same variable (see output_stats) NaN
+    :param X: pd.DataFrame, all the columns with mean columns to be changed, changed in place
+    :param mean_cols: list, mean columns the bounds are aligned to
+    :param low: np.ndarray, lower bounds from compile_outlier_bounds
+    :param high: np.ndarray, upper bounds from compile_outlier_bounds
+    :return: removed: pd.Series, number of removed entries per variable
+    """
+    values = X.loc[:, mean_cols].to_numpy()
+    if values.dtype.kind != 'f':
+        values = values.astype(float)
+    # compare in the dtype of the columns: a float32 mean at a bound equals the bound rounded to float32, but
+    # lies on either side of the float64 bound
+    low, high = low.astype(values.dtype), high.astype(values.dtype)
+    outlier = (values < low) | (values > high)
+    names = [c[0] for c in mean_cols]
+    removed = pd.Series(outlier.sum(axis=0), index=names)
+    hit = np.flatnonzero(removed.to_numpy())
+    if len(hit) == 0:
+        return removed
+
+    # only the columns of variables with removals are written back, each as a whole column
+    stats = [s for s in output_stats(EXTRA_STATS) if any((names[i], s) in X.columns for i in hit)]
+    for i in hit:
+        count_col = (names[i], 'count')
+        X[mean_cols[i]] = np.where(outlier[:, i], np.nan, values[:, i]).astype(X[mean_cols[i]].dtype)
+        X[count_col] = np.where(outlier[:, i], 0, X[count_col].to_numpy()).astype(X[count_col].dtype)
+        for stat in stats:
+            if (names[i], stat) in X.columns:
+                X[(names[i], stat)] = X[(names[i], stat)].mask(outlier[:, i])
+    return removed
+
+def moment_stats(df):
+    """
+    Mergeable moments of every column (Welford/Chan state), NaN ignored
+    :param df: pd.DataFrame, e.g. the mean columns of one vital chunk
+    :return: stats: pd.DataFrame, index: the columns of df, columns: n, mean, m2 (sum of squared deviations)
+    """
+    values = df.to_numpy(dtype=np.float64)
+    n = (~np.isnan(values)).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n > 0, np.nansum(values, axis=0) / n, 0.0)
+    m2 = np.nansum((values - mean) ** 2, axis=0)
+    return pd.DataFrame({'n': n.astype(np.float64), 'mean': mean, 'm2': m2}, index=df.columns)
+
+def merge_moments(a, b):
+    """
+    Merge two moment states with the parallel update of Chan et al., so chunks can be summarized independently
+    :param a: pd.DataFrame, moments from moment_stats / merge_moments, or None
+    :param b: pd.DataFrame, moments over the same columns
+    :return: stats: pd.DataFrame, moments of the union of both parts
+    """
+    if a is None:
+        return b
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n > 0, a['mean'] + delta * b['n'] / n, 0.0)
+        m2 = np.where(n > 0, a['m2'] + b['m2'] + delta ** 2 * a['n'] * b['n'] / n, 0.0)
+    return pd.DataFrame({'n': n, 'mean': mean, 'm2': m2}, index=a.index)
+
+def finalize_moments(stats, ddof=1):
+    """
+    Mean and standard deviation from merged moments, as pandas .mean() / .std() would give on the whole table
+    :param stats: pd.DataFrame, moments from moment_stats / merge_moments
+    :param ddof: int, delta degrees of freedom of the std
+    :return: col_means, col_stds: pd.Series, NaN where there are too few observations
+    """
+    n = stats['n']
+    col_means = stats['mean'].where(n > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        col_stds = np.sqrt(stats['m2'] / (n - ddof)).where(n > ddof)
+    return col_means, col_stds
 
-def fill_query(df, fill_df, tw_in_min, time='chartoffset'):
-    """
-    Organize queried results into the template fill_df format
-    :param df: pd.DataFrame, queried results
-    :param fill_df: pd.DataFrame, a template with all stay ids and each stay id has hours_in level 1 index
-    :param time: str, how the time column was represented e.g. 'chartoffset', 'observationoffset'
-    :return: df, pd.DataFrame, the same structure as the template
-    """
-    df['hours_in'] = df[time].floordiv(tw_in_min)
-    df.drop(columns=[time], inplace=True)
-    df.set_index(['patientunitstayid']+ ['hours_in'], inplace=True)
-    df.reset_index(inplace=True)
-    # level_to_change = 1
-    df = df.groupby(['patientunitstayid'] + ['hours_in']).agg(['mean', 'count'])
-    # df.index = df.index.set_levels(df.index.levels[level_to_change].astype(int), level=level_to_change)
-    df = df.reindex(fill_df.index)
-    return df
+SPLITS = (('train', 0.7), ('dev', 0.1), ('test', 0.2))
 
-def add_outcome_indicators_e(out_gb):
-    """
-    For eICU data, iterate a groupby object and add intervention procedure indicator
-    :param out_gb: Pandas groupby object, specific intervention variable grouped by e.g. 'patientunitstayid'
-    :return: pd.DataFrame, for each stay_id, iterate through the hours with the procedure, represent it by 1
-                for any other hours, fill 0,
-    """
-    # patientunitstayid = out_gb['patientunitstayid'].unique()[0]
-    max_hrs = out_gb['max_hours'].unique()[0]
-    on_hrs = set()
-    # on_values = []
-
-    p_set = on_hrs.copy()
-    for index, row in out_gb.iterrows():
-        on_hrs.update(range(row['starttime'], row['endtime'] + 1))
-        # if on_hrs - p_set:
-        # only when sets updates, append a value
-            # on_values.append([row['values']]*len(on_hrs - p_set))
-        # p_set = on_hrs.copy()
-
-    off_hrs = set(range(max_hrs + 1)) - on_hrs
-    ##values flatten a nested list
-    # values = [0]*len(off_hrs) + [item for sublist in on_values for item in sublist]
-    on_vals = [0]*len(off_hrs) + [1]*len(on_hrs)
-    hours = list(off_hrs) + list(on_hrs)
-    return pd.DataFrame({
-                        'hours_in':hours, 'on':on_vals}) #icustay_id': icustay_id})
-
-def add_blank_indicators_e(out_gb):
-    """
-    For eICU data, add blank indicator for stays with no ventilation records
-    :param out_gb: Pandas groupby object, grouped from a dataframe
-    :return: pd.DataFrame, index: patientunitstayid, column names: hours_in, on
-            with on being all 0s
-    """
-    # subject_id = out_gb['subject_id'].unique()[0]
-    # hadm_id = out_gb['hadm_id'].unique()[0]
-    #icustay_id = out_gb['icustay_id'].unique()[0]
-    max_hrs = out_gb['max_hours'].unique()[0]
-
-    hrs = range(max_hrs + 1)
-    vals = list([0]*len(hrs))
-    return pd.DataFrame({
-                        'hours_in':hrs, 'on':vals})#'icustay_id': icustay_id,
-
-def process_inv(df, name):
-    """
-    Organize queried intervention table
-    :param df:  pd.DataFrame, Queried intervention results,
-    :param name: str, column name of the intervention procedure, e.g. 'vent'
-    :return: df, pd.DataFrame, after organizing, the last column will indicate a state at that hour (0 or 1)
-                    columns, e.g. patientunitstayid, hours_in, vent
-    """
-    df.starttime = df.starttime.astype(int)
-    df.endtime = df.endtime.astype(int)
-    df.max_hours = df.max_hours.astype(int)
-    df = df.groupby(['patientunitstayid']).apply(add_outcome_indicators_e)
-    df.rename(columns={'on': name}, inplace=True)
-    df = df.reset_index()
-    return df
+def hash_ids(ids):
+    """
+    Deterministic 64-bit hash of ids, the same in every run, process and chunk
+    :param ids: array-like, e.g. stay or patient ids
+    :return: hashes: np.ndarray of uint64
+    """
+    return pd.util.hash_array(np.asarray(ids), categorize=False)
+
+def assign_split(ids, splits=SPLITS):
+    """
+    Split of every id from its hash alone, so no global shuffle is needed and every chunk can be assigned on its own
+    :param ids: array-like, e.g. the stay id level of a chunk
+    :param splits: tuple of (name, fraction), fractions are normalized to sum to 1
+    :return: split: np.ndarray of split names, aligned with ids
+    """
+    names = np.array([name for name, _ in splits], dtype=object)
+    bounds = np.cumsum([frac for _, frac in splits], dtype=np.float64)
+    # top 53 bits as a uniform number in [0, 1)
+    unit = (hash_ids(ids) >> np.uint64(11)).astype(np.float64) / 2 ** 53
+    return names[np.minimum(np.searchsorted(bounds / bounds[-1], unit, side='right'), len(names) - 1)]
+
+def stay_bucket(ids, n_buckets):
+    """
+    Bucket of every id in [0, n_buckets), from the low bits of the same hash as assign_split
+    :param ids: array-like
+    :param n_buckets: int
+    :return: bucket: np.ndarray of int
+    """
+    return (hash_ids(ids) % np.uint64(n_buckets)).astype(np.int64)
+
+def split_paths(root, split, buckets=None):
+    """
+    Files of one split of a dataset partitioned by split (extract_database._write_split_dataset)
+    :param root: str, dataset directory, e.g. output/MIMIC_split/vital
+    :param split: str, 'train', 'dev' or 'test'
+    :param buckets: iterable of int, only these stay buckets when the dataset was written with --split_buckets
+    :return: paths: list of str, bucket by bucket in chunk order, every file holds whole stays
+    """
+    pattern = os.path.join(root, f'split={split}', '**', '*.parquet')
+    paths = sorted(glob.glob(pattern, recursive=True))
+    if buckets is not None:
+        keep = {f'bucket={b:03d}' for b in buckets}
+        paths = [p for p in paths if os.path.basename(os.path.dirname(p)) in keep]
+    return paths
+
+def read_split(root, split, buckets=None):
+    """
+    Read one split of a dataset partitioned by split (extract_database._write_split_dataset), only its files are opened
+    :param root: str, dataset directory, e.g. output/MIMIC_split/vital
+    :param split: str, 'train', 'dev' or 'test'
+    :param buckets: iterable of int, only these stay buckets when the dataset was written with --split_buckets
+    :return: df: pd.DataFrame, the rows of the split, bucket by bucket in chunk order
+    """
+    paths = split_paths(root, split, buckets)
+    if not paths:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(p) for p in paths])
+
+def stay_offsets(index, level):
+    """
+    Row offsets of the stays in a frame whose rows are grouped by stay (contiguous blocks in time order)
+    :param index: pd.MultiIndex, e.g. subject_id, hadm_id, stay_id, hours_in
+    :param level: str, level that tells stays apart, e.g. 'stay_id' or 'patientunitstayid'
+    :return: offsets: np.ndarray, start row of every stay followed by the total number of rows
+    """
+    ids = index.get_level_values(level).to_numpy()
+    starts = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    offsets = np.concatenate([[0], starts, [len(ids)]])
+    if len(offsets) - 1 != len(pd.unique(ids)):
+        raise ValueError(f'Rows of a {level} are not contiguous, sort the index before imputing')
+    return offsets
+
+def _impute_ffill(values, prev, nxt, rows, means, max_age=None, **kwargs):
+    # carry the last observation forward, for at most max_age windows if given
+    carry = prev >= 0
+    if max_age is not None:
+        carry &= rows - prev <= max_age
+    last = np.take_along_axis(values, np.clip(prev, 0, None), axis=0)
+    return np.where(carry, last, np.nan)
+
+def _impute_linear(values, prev, nxt, rows, means, **kwargs):
+    # interpolate between the surrounding observations, carry the last one forward after it
+    last = np.take_along_axis(values, np.clip(prev, 0, None), axis=0)
+    upcoming = np.take_along_axis(values, np.clip(nxt, None, len(values) - 1), axis=0)
+    between = (prev >= 0) & (nxt < len(values))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = ((rows - prev) / (nxt - prev)).astype(values.dtype)
+    return np.where(between, last + (upcoming - last) * frac, np.where(prev >= 0, last, np.nan))
+
+def _impute_decay(values, prev, nxt, rows, means, decay=6.0, **kwargs):
+    # the last observation decays toward the stay mean with time constant decay (in windows)
+    last = np.take_along_axis(values, np.clip(prev, 0, None), axis=0)
+    weight = np.exp(-(rows - prev) / decay).astype(values.dtype)
+    return np.where(prev >= 0, means + (last - means) * weight, np.nan)
+
+IMPUTE_STRATEGIES = {'ffill': _impute_ffill, 'linear': _impute_linear, 'decay': _impute_decay}
+
+def impute_segments(values, offsets, strategy='ffill', fallback=0.0, block=16, **kwargs):
+    """
+    Impute a (rows, variables) matrix in which every stay is a contiguous block of rows in time order.
+    For each entry the kernel finds the last and next observation of the same stay (a segmented running
+    max/min over row numbers) and the stay mean of the observed values; the strategy fills from those, entries
+    it leaves empty get the stay mean and variables never observed during a stay get *fallback*.
+    :param values: np.ndarray, e.g. z-scored mean columns as float32, not changed
+    :param offsets: np.ndarray, start row of every stay plus the total row count, see stay_offsets
+    :param strategy: str, key of IMPUTE_STRATEGIES: 'ffill' (optionally with max_age in windows), 'linear'
+                (interpolation between observations) or 'decay' (toward the stay mean, time constant decay in windows)
+    :param fallback: float, value for variables without any observation in a stay, 0 is the mean after z-scoring
+    :param block: int, number of columns processed at a time, bounds the size of the row-index temporaries
+    :return: imputed: np.ndarray, same shape and dtype as values
+    """
+    fill_fn = IMPUTE_STRATEGIES[strategy]
+    n = values.shape[0]
+    index_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+    lengths = np.diff(offsets)
+    rows = np.arange(n, dtype=index_dtype)[:, None]
+    seg_start = np.repeat(offsets[:-1], lengths).astype(index_dtype)[:, None]
+    seg_end = np.repeat(offsets[1:], lengths).astype(index_dtype)[:, None]
+
+    imputed = np.empty_like(values)
+    for j in range(0, values.shape[1], block):
+        v = values[:, j:j + block]
+        observed = ~np.isnan(v)
+        # row of the last / next observation within the same stay, -1 / n when there is none
+        prev = np.maximum.accumulate(np.where(observed, rows, -1), axis=0)
+        prev = np.where(prev >= seg_start, prev, -1)
+        nxt = np.minimum.accumulate(np.where(observed, rows, n)[::-1], axis=0)[::-1]
+        nxt = np.where(nxt < seg_end, nxt, n)
+        sums = np.add.reduceat(np.where(observed, v, 0).astype(np.float64), offsets[:-1], axis=0)
+        counts = np.add.reduceat(observed, offsets[:-1], axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stay_means = np.where(counts > 0, sums / counts, fallback).astype(v.dtype)
+        means = np.repeat(stay_means, lengths, axis=0)
+        out = np.where(observed, v, fill_fn(v, prev, nxt, rows, means, **kwargs))
+        imputed[:, j:j + block] = np.where(np.isnan(out), means, out)
+    return imputed
+
+def impute_columns(df, cols, level, strategy='ffill', **kwargs):
+    """
+    Impute columns of a vital table in place with impute_segments, working on float32
+    :param df: pd.DataFrame, vital table, rows of a stay contiguous and in time order
+    :param cols: list, columns to impute, e.g. the z-scored mean columns
+    :param level: str, index level that tells stays apart, e.g. 'stay_id' or 'patientunitstayid'
+    :param strategy: str, key of IMPUTE_STRATEGIES, other keyword arguments go to the strategy
+    :return: None
+    """
+    values = df.loc[:, cols].to_numpy(dtype=np.float32)
+    imputed = impute_segments(values, stay_offsets(df.index, level), strategy=strategy, **kwargs)
+    for i, c in enumerate(cols):
+        df[c] = imputed[:, i]
+    return
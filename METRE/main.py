@@ -9,14 +9,16 @@ from constants import PROJECT_ID, DEFAULT_AGE_MIN, DEFAULT_LOS_MIN, DEFAULT_LOS_
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parse to query MIMIC/eICU data")
-    parser.add_argument("--database", type=str, default='MIMIC', choices=['MIMIC', 'eICU'])
+    parser.add_argument("--database", type=str, default='MIMIC', choices=list(SOURCES))
     parser.add_argument("--project_id", type=str, default=PROJECT_ID,
                         help='Specify the Bigquery billing project')
     parser.add_argument("--age_min", type=int, default=DEFAULT_AGE_MIN, help='Min patient age to query')
     parser.add_argument("--los_min", type=int, default=DEFAULT_LOS_MIN, help='Min ICU LOS in hour')
     parser.add_argument("--los_max", type=int, default=DEFAULT_LOS_MAX, help='Max ICU LOS in hour')
-    parser.add_argument("--patient_group", type=str, default='Generic', choices=['Generic', 'sepsis_3', 'ARF', 'shock', 'COPD', 'CHF'],
-                        help='Specific groups to extract')
+    parser.add_argument("--patient_group", type=str, nargs='+', default=['Generic'],
+                        choices=['Generic'] + PATIENT_GROUPS + ['all'],
+                        help='Specific groups to extract, several (or all) come out of one extraction of the Generic '
+                             'cohort, each group but Generic in <output_dir>/<group>')
     parser.add_argument("--custom_id", action='store_true', default=False, help="Whether use custom stay ids")
     parser.add_argument('--customid_dir', required='--custom_id' in sys.argv, help="Specify custom id dir")
     parser.add_argument("--exit_point", type=str, default='All', choices=['All', 'Raw', 'Outlier_removal', 'Impute'],
@@ -24,15 +26,39 @@ if __name__ == '__main__':
     parser.add_argument("--no_removal", action='store_true', default=False, help="When set to True, no outlier removal")
     parser.add_argument("--norm_eicu", type=str, default='MIMIC', choices=['MIMIC', 'eICU'],
                         help="Whether use MIMIC mean and std to standardize eICU variables")
-    parser.add_argument("--time_window", type=int, default=DEFAULT_TIME_WINDOW, help='Time window to aggregate the data')
+    parser.add_argument("--impute", type=str, default='ffill', choices=list(IMPUTE_STRATEGIES),
+                        help='How missing means are imputed within a stay before the stay mean fallback')
+    parser.add_argument("--impute_max_age", type=int, default=None,
+                        help='With --impute ffill, carry an observation forward for at most this many time windows')
+    parser.add_argument("--impute_decay", type=float, default=6.0,
+                        help='With --impute decay, time constant (in time windows) of the decay toward the stay mean')
+    parser.add_argument("--time_window", type=lambda v: [int(w) for w in v.split(',')], default=[DEFAULT_TIME_WINDOW],
+                        help='Time window to aggregate the data (hours), several comma separated windows (e.g. 1,2,4) '
+                             'come out of one run, each in <output_dir>/tw_<hours>h')
+    parser.add_argument("--extra_stats", type=str, nargs='*', default=[], choices=EXTRA_STATS,
+                        help='Optional statistics per time window next to mean and count, '
+                             'std is the sample std, time adds the first/last charting minute')
     parser.add_argument("--output_dir", type=str, default='./output')
     parser.add_argument("--cache_dir", type=str, default='./cache',
                         help='Directory to store cached BigQuery results (avoids re-querying)')
     parser.add_argument("--force_query", action='store_true', default=False,
                         help='Bypass cache and re-fetch all data from BigQuery')
+    parser.add_argument("--offline", action='store_true', default=False,
+                        help='Never query BigQuery, every query result must be in --cache_dir (e.g. written by '
+                             'synthetic.py)')
+    parser.add_argument("--workers", type=int, default=1,
+                        help='Number of processes building the stay chunks of the vital, outlier and impute stages')
+    parser.add_argument("--memory_budget", type=float, default=None,
+                        help='Memory budget in GB: raw tables are binned in slices and the vital stages run in '
+                             'as many stay chunks as needed to stay within it')
+    parser.add_argument("--engine", type=str, default='pandas', choices=['pandas', 'duckdb'],
+                        help='Engine that bins the cached raw tables into the event store, duckdb runs it as '
+                             'multi-threaded SQL over the parquet files (needs the duckdb package)')
+    parser.add_argument("--split_by", type=str, default='stay', choices=['stay', 'patient'],
+                        help='Id whose hash assigns the train/dev/test split, patient keeps all stays of a '
+                             'patient in one split (MIMIC only)')
+    parser.add_argument("--split_buckets", type=int, default=0,
+                        help='Also partition the split outputs into this many stay buckets by hash')
     args = parser.parse_args()
-    if args.database == 'MIMIC':
-        extract_mimic(args)
-    elif args.database == 'eICU':
-        extract_eicu(args)
+    extract_source(args, SOURCES[args.database])
 
@@ -31,7 +31,8 @@ patient = cached_query(CACHE_DIR, 'patient', get_patient_group_eicu, args, clien
 young_age = [str(i) for i in range(args.age_min)]
 patient = patient.loc[~patient.loc[:, 'age'].isin(young_age)]
 icuids_to_keep = set([str(s) for s in patient['patientunitstayid']])
-tw_in_min = args.time_window
+# intervention intervals are cached at minute resolution, extract_eicu coarsens them to --time_window
+tw_in_min = 1
 
 queries = [
     ('bg', query_bg_eicu, [client, icuids_to_keep]),
@@ -44,21 +45,21 @@ queries = [
     ('cvp', query_cvp_eicu, [client, icuids_to_keep]),
     ('labmakeup', query_labmakeup_eicu, [client, icuids_to_keep]),
     ('tidal_vol', query_tidalvol_eicu, [client, icuids_to_keep]),
-    ('vent', query_vent_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('antibiotics', query_anti_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('crrt', query_crrt_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('rbc_trans', query_rbc_trans_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('ffp_trans', query_ffp_trans_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('pll_trans', query_pll_trans_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('colloid', query_colloid_eicu, [client, icuids_to_keep, tw_in_min]),
-    ('crystalloid', query_crystalloid_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('vent_min', query_vent_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('antibiotics_min', query_anti_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('crrt_min', query_crrt_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('rbc_trans_min', query_rbc_trans_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('ffp_trans_min', query_ffp_trans_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('pll_trans_min', query_pll_trans_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('colloid_min', query_colloid_eicu, [client, icuids_to_keep, tw_in_min]),
+    ('crystalloid_min', query_crystalloid_eicu, [client, icuids_to_keep, tw_in_min]),
     ('comorbidity', query_comorbidity_eicu, [client, icuids_to_keep]),
 ]
 
 med_names = ['dopamine', 'epinephrine', 'norepinephrine', 'phenylephrine',
              'vasopressin', 'dobutamine', 'milrinone', 'heparin']
 for m in med_names:
-    queries.append((f'med_{m}', query_med_eicu, [client, icuids_to_keep, m, tw_in_min]))
+    queries.append((f'med_{m}_min', query_med_eicu, [client, icuids_to_keep, m, tw_in_min]))
 
 print(f"Will fetch {len(queries)} queries (skipping cached ones)\n")
 for name, fn, fn_args in queries:
@@ -0,0 +1,191 @@
+"""
+Per-stage run reports: wall and CPU time, peak RSS, rows, columns and bytes written.
+
+    with RunReport('MIMIC_Generic', report_dir):
+        with stage('cohort') as st:
+            patient = ...
+            st.output(patient)
+
+Every stage opened while a report is active becomes one record; on exit
+the report is written as JSON (<report_dir>/<name>_<timestamp>.json) and
+a summary table is printed. Without an active report stage() only times.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# reports currently open, stages go to the innermost one
+_ACTIVE = []
+# number of stages currently open, nested stages are indented in the summary
+_DEPTH = [0]
+
+
+def peak_rss_mb():
+    """High-water mark of this process' resident memory in MB, None where it cannot be read."""
+    # VmHWM starts over with the program; ru_maxrss is kept across exec, so a process started by a larger one
+    # (e.g. a benchmark or test driver) would report the high-water mark of its parent
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if os.uname().sysname == 'Darwin' else peak / 2 ** 10
+
+
+def rss_mb():
+    """Resident memory of this process right now in MB, the high-water mark where it cannot be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def _cpu_seconds():
+    # this process and the children it has waited for, e.g. the pool workers of map_workers
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Stage:
+    """Measurements of one stage, filled in by the code that runs it."""
+
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = dict(info)
+        self.status = 'ok'
+        self.rows_in = self.rows_out = self.cols_out = None
+        self.bytes_written = 0
+
+    def input(self, df):
+        """Record the rows of an input frame (added up over calls)."""
+        self.rows_in = (self.rows_in or 0) + len(df)
+
+    def output(self, df):
+        """Record the rows and columns of an output frame (rows added up over calls)."""
+        self.rows_out = (self.rows_out or 0) + len(df)
+        self.cols_out = df.shape[1] if getattr(df, 'ndim', 1) > 1 else 1
+
+    def written(self, *paths):
+        """Record files written by the stage, their sizes count towards bytes_written."""
+        self.bytes_written += sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+@contextmanager
+def stage(name, **info):
+    """Time a stage and record it in the active report, yields its Stage to record rows and files."""
+    st = Stage(name, **info)
+    rss0, wall0, cpu0 = peak_rss_mb(), time.perf_counter(), _cpu_seconds()
+    depth = _DEPTH[0]
+    _DEPTH[0] += 1
+    try:
+        yield st
+    except BaseException:
+        st.status = 'error'
+        raise
+    finally:
+        _DEPTH[0] -= 1
+        rss1 = peak_rss_mb()
+        record = {'stage': name, 'status': st.status, 'depth': depth, 'start_s': wall0,
+                  'wall_s': round(time.perf_counter() - wall0, 3), 'cpu_s': round(_cpu_seconds() - cpu0, 3),
+                  'peak_rss_mb': None if rss1 is None else round(rss1, 1),
+                  'rss_growth_mb': None if rss1 is None else round(rss1 - rss0, 1),
+                  'rows_in': st.rows_in, 'rows_out': st.rows_out, 'cols_out': st.cols_out,
+                  'bytes_written': st.bytes_written, **st.info}
+        if _ACTIVE:
+            _ACTIVE[-1].stages.append(record)
+
+
+def staged(name):
+    """Decorator form of stage(); the function's output is recorded when it is a frame."""
+    def decorate(fn):
+        @wraps(fn)
+        def run(*args, **kwargs):
+            with stage(name) as st:
+                out = fn(*args, **kwargs)
+                if hasattr(out, 'shape'):
+                    st.output(out)
+                return out
+        return run
+    return decorate
+
+
+class RunReport:
+    """Collects the stages of one run, see the module docstring."""
+
+    def __init__(self, name, report_dir, **info):
+        self.name = name
+        self.report_dir = report_dir
+        self.info = dict(info)
+        self.stages = []
+        self.path = None
+
+    def __enter__(self):
+        self.started = datetime.now()
+        self._wall0, self._cpu0 = time.perf_counter(), _cpu_seconds()
+        _ACTIVE.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _ACTIVE.remove(self)
+        # stages are recorded as they end, list them as they started with times relative to the run
+        for s in self.stages:
+            s['start_s'] = round(s['start_s'] - self._wall0, 3)
+        self.stages.sort(key=lambda s: s['start_s'])
+        report = {'run': self.name, 'started': self.started.isoformat(timespec='seconds'),
+                  'status': 'ok' if exc_type is None else 'error',
+                  'wall_s': round(time.perf_counter() - self._wall0, 3),
+                  'cpu_s': round(_cpu_seconds() - self._cpu0, 3), 'peak_rss_mb': peak_rss_mb(),
+                  **self.info, 'stages': self.stages}
+        os.makedirs(self.report_dir, exist_ok=True)
+        self.path = os.path.join(self.report_dir, f"{self.name}_{self.started.strftime('%Y%m%d_%H%M%S')}.json")
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(summary_table(report))
+        print(f'Run report -> {self.path}')
+        return False
+
+
+def _fmt(value, unit=''):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.1f}{unit}'
+    return f'{value:,}{unit}'
+
+
+def summary_table(report, min_share=1.0):
+    """Text table of a report's stages in run order, nested stages indented, with the share of the run's
+    wall time; stages below *min_share* percent are only counted (they are all in the JSON)."""
+    total = report['wall_s'] or 1e-9
+    rows = [('stage', 'status', 'wall s', '%', 'cpu s', 'peak MB', '+MB', 'rows in', 'rows out', 'cols', 'MB written')]
+    shown = [s for s in report['stages'] if 100 * s['wall_s'] / total >= min_share]
+    for s in shown:
+        rows.append(('  ' * s['depth'] + s['stage'], s['status'], _fmt(s['wall_s']), _fmt(100 * s['wall_s'] / total),
+                     _fmt(s['cpu_s']), _fmt(s['peak_rss_mb']), _fmt(s['rss_growth_mb']), _fmt(s['rows_in']),
+                     _fmt(s['rows_out']), _fmt(s['cols_out']), _fmt(s['bytes_written'] / 2 ** 20)))
+    widths = [max(len(str(r[i])) for r in rows) for i in range(len(rows[0]))]
+    lines = [f"Run {report['run']}: {report['wall_s']:.1f}s wall, {report['cpu_s']:.1f}s cpu, "
+             f"peak {_fmt(report['peak_rss_mb'], ' MB')}"]
+    for i, r in enumerate(rows):
+        lines.append('  ' + '  '.join(str(c).ljust(w) if j < 2 else str(c).rjust(w)
+                                      for j, (c, w) in enumerate(zip(r, widths))))
+        if i == 0:
+            lines.append('  ' + '  '.join('-' * w for w in widths))
+    if len(shown) < len(report['stages']):
+        lines.append(f"  ({len(report['stages']) - len(shown)} stages under {min_share:g}% of the run not shown)")
+    return '\n'.join(lines)
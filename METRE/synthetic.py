@@ -0,0 +1,389 @@
+"""
+Synthetic MIMIC-IV / eICU data at a configurable scale, for running the pipeline without BigQuery.
+
+The pipeline never reads the source tables itself: every query result is
+cached as <cache_dir>/<database>_Generic/raw/<name>.parquet (see
+cached_query) and all later stages start from those files. This module
+writes the same files, with the columns and dtypes the queries return,
+for a cohort of synthetic stays, so that --offline runs end to end:
+
+    python synthetic.py --database MIMIC eICU --scale 2 --cache_dir ./synthetic_cache
+    python main.py --database MIMIC --offline --cache_dir ./synthetic_cache
+
+Scale 1 is STAYS_PER_SCALE stays, the size of the MIMIC-IV Generic cohort is a
+scale of about 39.
+Lengths of stay are log-normal (median MEDIAN_LOS_HOURS) within
+[--los_min, --los_max], each event table is charted at about the rate of
+the real one (events per ICU hour, see MIMIC_EVENTS / EICU_EVENTS) and
+values are drawn around normal ranges, within the outlier bounds.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from constants import DEFAULT_AGE_MIN, DEFAULT_LOS_MIN, DEFAULT_LOS_MAX
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAYS_PER_SCALE = 1000
+MEDIAN_LOS_HOURS = 48
+# marks a cache written by this module, any other cache directory is never overwritten
+MARKER = '_synthetic.json'
+
+# mean and sd of common variables, the others are drawn within their outlier bounds
+RANGES = {
+    'heart_rate': (85, 18), 'heartrate': (85, 18), 'sbp': (120, 20), 'sbp_ni': (120, 20), 'dbp': (62, 12),
+    'dbp_ni': (62, 12), 'mbp': (80, 13), 'mbp_ni': (80, 13), 'ibp_systolic': (120, 20), 'nibp_systolic': (120, 20),
+    'ibp_diastolic': (62, 12), 'nibp_diastolic': (62, 12), 'ibp_mean': (80, 13), 'nibp_mean': (80, 13),
+    'resp_rate': (19, 5), 'RespiratoryRate': (19, 5), 'temperature': (37, 0.6), 'spo2': (97, 2.5),
+    'so2': (96, 3), 'glucose': (135, 40), 'ph': (7.38, 0.07), 'pH': (7.38, 0.07), 'po2': (110, 50),
+    'pao2': (110, 50), 'pco2': (41, 8), 'paco2': (41, 8), 'fio2': (50, 15), 'fio2_chartevents': (50, 15),
+    'baseexcess': (0, 4), 'basedeficit': (2, 3), 'bicarbonate': (24, 4), 'totalco2': (25, 4), 'TotalCO2': (25, 4),
+    'sodium': (139, 4), 'potassium': (4.1, 0.5), 'chloride': (104, 5), 'calcium': (8.5, 0.6), 'bun': (25, 15),
+    'BUN': (25, 15), 'creatinine': (1.3, 0.8), 'hemoglobin': (10, 2), 'hematocrit': (31, 5), 'wbc': (11, 5),
+    'platelet': (200, 80), 'platelets': (200, 80), 'lactate': (2, 1.2), 'inr': (1.3, 0.3), 'INR': (1.3, 0.3),
+    'gcs': (12, 3), 'weight': (82, 20), 'uo': (120, 80), 'urineoutput': (120, 80), 'cvp': (10, 4),
+}
+
+MIMIC_VASO = ['dopamine', 'epinephrine', 'norepinephrine', 'phenylephrine', 'vasopressin', 'dobutamine', 'milrinone']
+EICU_MEDS = MIMIC_VASO + ['heparin']
+CHARLSON = ['myocardial_infarct', 'congestive_heart_failure', 'peripheral_vascular_disease', 'cerebrovascular_disease',
+            'dementia', 'chronic_pulmonary_disease', 'rheumatic_disease', 'peptic_ulcer_disease', 'mild_liver_disease',
+            'diabetes_without_cc', 'diabetes_with_cc', 'paraplegia', 'renal_disease', 'malignant_cancer',
+            'severe_liver_disease', 'metastatic_solid_tumor', 'aids']
+# share of the stays in each patient group
+GROUP_SHARE = {'sepsis_3': 0.3, 'ARF': 0.2, 'shock': 0.15, 'COPD': 0.1, 'CHF': 0.2}
+
+# event table: (events per ICU hour, share of the value columns charted in an event, value columns)
+MIMIC_EVENTS = {
+    'bg': (0.25, 0.5, ['so2', 'po2', 'pco2', 'fio2_chartevents', 'fio2', 'aado2', 'aado2_calc', 'pao2fio2ratio',
+                       'ph', 'baseexcess', 'bicarbonate', 'totalco2', 'hematocrit', 'hemoglobin', 'carboxyhemoglobin',
+                       'methemoglobin', 'chloride', 'calcium', 'temperature', 'potassium', 'sodium', 'lactate',
+                       'glucose']),
+    'vitalsign': (1.0, 0.7, ['heart_rate', 'sbp', 'dbp', 'mbp', 'sbp_ni', 'dbp_ni', 'mbp_ni', 'resp_rate',
+                             'temperature', 'spo2', 'glucose']),
+    'blood_diff': (0.03, 0.7, ['wbc', 'basophils', 'eosinophils', 'lymphocytes', 'monocytes', 'neutrophils',
+                               'atypical_lymphocytes', 'bands', 'immature_granulocytes', 'metamyelocytes', 'nrbc',
+                               'basophils_abs', 'eosinophils_abs', 'lymphocytes_abs', 'monocytes_abs',
+                               'neutrophils_abs']),
+    'cardiac_marker': (0.01, 0.6, ['troponin_t', 'ck_mb', 'ntprobnp']),
+    'chemistry': (0.08, 0.9, ['albumin', 'globulin', 'total_protein', 'aniongap', 'bicarbonate', 'bun', 'calcium',
+                              'chloride', 'creatinine', 'glucose', 'sodium', 'potassium']),
+    'coagulation': (0.05, 0.8, ['d_dimer', 'fibrinogen', 'thrombin', 'inr', 'pt', 'ptt']),
+    'cbc': (0.07, 0.95, ['hematocrit', 'hemoglobin', 'mch', 'mchc', 'mcv', 'platelet', 'rbc', 'rdw', 'rdwsd', 'wbc']),
+    'enzyme': (0.02, 0.7, ['alt', 'alp', 'ast', 'amylase', 'bilirubin_total', 'bilirubin_direct',
+                           'bilirubin_indirect', 'ck_cpk', 'ck_mb', 'ggt', 'ld_ldh']),
+    'gcs': (0.25, 1.0, ['gcs']),
+    'inflammation': (0.005, 1.0, ['crp']),
+    'uo': (0.7, 1.0, ['weight', 'uo']),
+}
+EICU_EVENTS = {
+    'bg': (0.2, 0.5, ['fio2', 'pao2', 'paco2', 'pH', 'aniongap', 'basedeficit', 'baseexcess', 'peep']),
+    'lab': (0.1, 0.3, ['albumin', 'bilirubin', 'BUN', 'calcium', 'chloride', 'creatinine', 'glucose', 'bicarbonate',
+                       'TotalCO2', 'hematocrit', 'hemoglobin', 'INR', 'lactate', 'platelets', 'potassium', 'ptt',
+                       'sodium', 'wbc', 'bands', 'basos', 'eos', 'lymphs', 'monos', 'polys', 'alt', 'ast', 'alp',
+                       'troponin_t', 'cpk_mb', 'total_protein', 'fibrinogen', 'pt', 'mch', 'mchc', 'mcv', 'rbc',
+                       'rdw', 'amylase', 'cpk', 'crp']),
+    'vital': (1.0, 0.7, ['heartrate', 'RespiratoryRate', 'spo2', 'nibp_systolic', 'nibp_diastolic', 'nibp_mean',
+                         'temperature', 'ibp_systolic', 'ibp_diastolic', 'ibp_mean']),
+    'gcs': (0.2, 1.0, ['gcs']),
+    'uo': (0.5, 1.0, ['urineoutput']),
+    'weight': (0.02, 1.0, ['weight']),
+    'cvp': (0.3, 1.0, ['cvp']),
+    'labmakeup': (0.03, 0.5, ['urine_creat', 'magnesium', 'phosphate', 'wbc_urine']),
+    'tidal_vol': (0.1, 1.0, ['tidal_vol_obs']),
+}
+CHART_LAB_RATE = 3.0
+CULTURE_RATE = 0.02
+# intervention: (share of the stays, mean hours of an interval)
+MIMIC_INTERVENTIONS = {
+    'vent': (0.4, 30), 'antibiotics': (0.6, 24), 'crrt': (0.05, 48), 'rbc_trans': (0.1, 2), 'pll_trans': (0.04, 1),
+    'ffp_trans': (0.05, 1), 'colloid': (0.1, 1), 'crystalloid': (0.5, 1),
+    **{f'vasoactive_{c}': (0.3 if c == 'norepinephrine' else 0.06, 12) for c in MIMIC_VASO},
+}
+EICU_INTERVENTIONS = {
+    'vent_min': (0.35, 30), 'antibiotics_min': (0.5, 24), 'crrt_min': (0.03, 48), 'rbc_trans_min': (0.08, 2),
+    'pll_trans_min': (0.03, 1), 'ffp_trans_min': (0.04, 1), 'colloid_min': (0.08, 1), 'crystalloid_min': (0.4, 1),
+    **{f'med_{c}_min': (0.25 if c in ('norepinephrine', 'heparin') else 0.05, 12) for c in EICU_MEDS},
+}
+
+
+def _json(name):
+    with open(os.path.join(HERE, 'json_files', name)) as f:
+        return json.load(f)
+
+
+def stay_lengths(rng, n, los_min, los_max):
+    """
+    Log-normal ICU lengths of stay, truncated to the cohort's bounds
+    :param rng: np.random.Generator
+    :param n: int, number of stays
+    :param los_min: int, hours, e.g. 24
+    :param los_max: int, hours, e.g. 240
+    :return: np.ndarray of n lengths in minutes
+    """
+    los = np.empty(0)
+    while len(los) < n:
+        draw = np.exp(rng.normal(np.log(MEDIAN_LOS_HOURS), 0.8, 2 * n))
+        los = np.concatenate([los, draw[(draw >= los_min) & (draw <= los_max)]])
+    return np.round(los[:n] * 60)
+
+
+def values(rng, col, n, low, high):
+    """
+    Values of one variable, normal around its usual range (RANGES) or skewed towards the low end of its
+    outlier bounds
+    :param rng: np.random.Generator
+    :param col: str, column name, e.g. 'heart_rate'
+    :param n: int, number of values
+    :param low: dict, outlier lower bounds of the source
+    :param high: dict, outlier upper bounds of the source
+    :return: np.ndarray of n floats within [low, high]
+    """
+    lo, hi = low.get(col, 0), high.get(col, 100)
+    if col in RANGES:
+        v = rng.normal(*RANGES[col], n)
+    else:
+        v = lo + (hi - lo) * rng.beta(2, 8, n)
+    return np.clip(v, lo, hi).round(2)
+
+
+def events(rng, los, rate, start=-30):
+    """
+    Event times of an event table charted at *rate* per ICU hour
+    :param rng: np.random.Generator
+    :param los: np.ndarray, length of every stay in minutes
+    :param rate: float, events per hour
+    :param start: int, minutes before admission the first events may be charted
+    :return: (np.ndarray, np.ndarray), position of the stay of each event and its minute since admission
+    """
+    counts = rng.poisson(rate * los / 60)
+    stay = np.repeat(np.arange(len(los)), counts)
+    return stay, rng.uniform(start, los[stay])
+
+
+def _value_table(rng, los, rate, share, cols, low, high):
+    """Event table with the value columns *cols*, each charted in *share* of the events."""
+    stay, minute = events(rng, los, rate)
+    df = pd.DataFrame({'_stay': stay, '_minute': minute})
+    for c in cols:
+        v = values(rng, c, len(df), low, high)
+        v[rng.random(len(df)) >= share] = np.nan
+        df[c] = v
+    return df
+
+
+def _intervals(rng, los, share, mean_hours):
+    """Intervals of an intervention given to *share* of the stays, start and end in minutes since admission."""
+    given = np.flatnonzero(rng.random(len(los)) < share)
+    stay = np.repeat(given, 1 + rng.poisson(0.5, len(given)))
+    start = rng.uniform(-60, los[stay])
+    end = np.minimum(start + rng.exponential(mean_hours * 60, len(stay)) + 15, los[stay] + 60)
+    return stay, np.round(start), np.round(end)
+
+
+def _write(raw_dir, name, df):
+    df.reset_index(drop=True).to_parquet(os.path.join(raw_dir, f'{name}.parquet'))
+
+
+def mimic_tables(n, rng, age_min=DEFAULT_AGE_MIN, los_min=DEFAULT_LOS_MIN, los_max=DEFAULT_LOS_MAX):
+    """
+    Query results of a synthetic MIMIC-IV cohort
+    :param n: int, number of ICU stays
+    :param rng: np.random.Generator
+    :return: dict, cache name -> pd.DataFrame, the tables extract_database caches under MIMIC_Generic/raw
+    """
+    low, high = _json('mimic_outlier_low.json'), _json('mimic_outlier_high.json')
+    los = stay_lengths(rng, n, los_min, los_max)
+    # about 1.25 stays per patient, one admission per stay
+    subject = 10000000 + np.unique(rng.integers(0, n, n), return_inverse=True)[1]
+    ids = pd.DataFrame({'subject_id': subject, 'hadm_id': 20000000 + rng.permutation(n),
+                        'stay_id': 30000000 + np.sort(rng.choice(10 * n, n, replace=False))})
+    intime = pd.Timestamp('2110-01-01') + pd.to_timedelta(rng.integers(0, 90 * 525600, n), unit='m')
+    outtime = intime + pd.to_timedelta(los, unit='m')
+    mort_hosp = rng.random(n) < 0.11
+    mort_icu = mort_hosp & (rng.random(n) < 0.65)
+    admittime = intime - pd.to_timedelta(rng.integers(0, 48 * 60, n), unit='m')
+    dischtime = outtime + pd.to_timedelta(rng.integers(0, 120 * 60, n), unit='m')
+    deathtime = pd.Series(np.where(mort_icu, outtime, dischtime)).where(mort_hosp)
+    tables = {'patient': ids.assign(
+        gender=rng.choice(['M', 'F'], n, p=[0.56, 0.44]),
+        age=np.clip(rng.normal(65, 16, n), age_min, 91).round().astype(int),
+        race=rng.choice(['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC/LATINO', 'ASIAN', 'OTHER', 'UNKNOWN'], n,
+                        p=[0.65, 0.1, 0.05, 0.03, 0.07, 0.1]),
+        hospital_expire_flag=mort_hosp.astype(int), hospstay_seq=1, los_icu=(los / 1440).round(2),
+        admittime=admittime, dischtime=dischtime, icu_intime=intime, icu_outtime=outtime,
+        admission_type=rng.choice(['EW EMER.', 'URGENT', 'ELECTIVE', 'OBSERVATION ADMIT'], n, p=[0.6, 0.2, 0.1, 0.1]),
+        insurance=rng.choice(['Medicare', 'Medicaid', 'Private', 'Other'], n, p=[0.45, 0.1, 0.35, 0.1]),
+        deathtime=deathtime,
+        discharge_location=np.where(mort_hosp, 'DIED', rng.choice(['HOME', 'SKILLED NURSING FACILITY', 'REHAB'], n)),
+        mort_icu=mort_icu.astype(int), mort_hosp=mort_hosp.astype(int),
+        readmission_30=(rng.random(n) < 0.05).astype(int))}
+    tables['group_flags'] = ids[['stay_id']].assign(**{g: rng.random(n) < s for g, s in GROUP_SHARE.items()})
+
+    def at(stay, minute):
+        # id columns and chart time of events, hadm_id comes back as a float from the lab tables
+        return pd.DataFrame({'subject_id': ids['subject_id'].to_numpy()[stay],
+                             'hadm_id': ids['hadm_id'].to_numpy()[stay].astype(float),
+                             'stay_id': ids['stay_id'].to_numpy()[stay], 'icu_intime': intime[stay],
+                             'charttime': intime[stay] + pd.to_timedelta(np.round(minute), unit='m')})
+
+    for name, (rate, share, cols) in MIMIC_EVENTS.items():
+        df = _value_table(rng, los, rate, share, cols, low, high)
+        df = pd.concat([at(df.pop('_stay').to_numpy(), df.pop('_minute').to_numpy()), df], axis=1)
+        if name in ('bg', 'vitalsign'):
+            site = ['ART.', 'VEN.', 'MIX.'] if name == 'bg' else ['Oral', 'Axillary', 'Blood', 'Rectal']
+            df['specimen' if name == 'bg' else 'temperature_site'] = rng.choice(site, len(df))
+        elif name not in ('gcs', 'inflammation', 'uo'):
+            df['specimen_id'] = rng.permutation(len(df)) + 1
+        tables[name] = df
+
+    # MIMIC-IV 3.1 has no culture table, the query returns no rows
+    tables['culture'] = pd.DataFrame(columns=['subject_id', 'charttime', 'specimen', 'screen', 'positive_culture',
+                                              'has_sensitivity', 'hadm_id', 'stay_id', 'icu_intime'])
+    var_map = pd.read_csv(os.path.join(HERE, 'resources', 'Chart_makeup_0505 - var_map0505.csv')).dropna()
+    stay, minute = events(rng, los, CHART_LAB_RATE)
+    item = rng.integers(0, len(var_map), len(stay))
+    value = np.concatenate([values(rng, level2, 1, low, high) for level2 in var_map['LEVEL2']])
+    value = value[item] * rng.lognormal(0, 0.2, len(stay))
+    tables['chart_lab'] = at(stay, minute).drop(columns='icu_intime').assign(
+        itemid=var_map['itemid'].to_numpy()[item], value=value.round(2).astype(str), valueuom=None)
+
+    for name, (share, hours) in MIMIC_INTERVENTIONS.items():
+        stay, start, end = _intervals(rng, los, share, hours)
+        df = ids.iloc[stay].assign(starttime=intime[stay] + pd.to_timedelta(start, unit='m'),
+                                   endtime=intime[stay] + pd.to_timedelta(end, unit='m'),
+                                   icu_intime=intime[stay], icu_outtime=outtime[stay])
+        if name == 'antibiotics':
+            df['antibiotic'] = rng.choice(['Vancomycin', 'Cefepime', 'Piperacillin-Tazobactam', 'Metronidazole'],
+                                          len(df))
+            df['route'] = rng.choice(['IV', 'PO/NG'], len(df), p=[0.85, 0.15])
+        elif name in ('colloid', 'crystalloid'):
+            df[f'{name}_bolus'] = rng.choice([250, 500, 1000], len(df)).astype(float)
+        tables[name] = df
+    # MIMIC-IV 3.1 has no heparin table either
+    tables['heparin'] = pd.DataFrame(columns=['subject_id', 'starttime', 'endtime', 'hadm_id', 'stay_id',
+                                              'icu_intime', 'icu_outtime'])
+    first_year = rng.choice([2008, 2011, 2014, 2017, 2020], n)
+    tables['anchor_year'] = ids.assign(icu_intime=intime, icu_outtime=outtime, anchor_year=intime.year,
+                                       anchor_year_group=[f'{y} - {y + 2}' for y in first_year])
+    tables['comorbidity'] = ids.assign(**{c: (rng.random(n) < 0.12).astype(int) for c in CHARLSON})
+    return tables
+
+
+def eicu_tables(n, rng, age_min=DEFAULT_AGE_MIN, los_min=DEFAULT_LOS_MIN, los_max=DEFAULT_LOS_MAX):
+    """
+    Query results of a synthetic eICU cohort, ages are strings ('> 89') and times minute offsets
+    :param n: int, number of unit stays
+    :param rng: np.random.Generator
+    :return: dict, cache name -> pd.DataFrame, the tables extract_database caches under eICU_Generic/raw
+    """
+    low, high = _json('eicu_outlier_low.json'), _json('eicu_outlier_high.json')
+    los = stay_lengths(rng, n, los_min, los_max)
+    stay_ids = 141000 + np.sort(rng.choice(30 * n, n, replace=False))
+    # the eICU cohort query does not filter by age, extract_database drops the young stays
+    age = np.clip(rng.normal(63, 17, n), max(age_min - 3, 0), 95).round().astype(int)
+    hosp_mort = rng.random(n) < 0.09
+    tables = {'patient': pd.DataFrame({
+        'patientunitstayid': stay_ids, 'gender': rng.choice(['Male', 'Female'], n, p=[0.54, 0.46]),
+        'age': np.where(age > 89, '> 89', age.astype(str)),
+        'ethnicity': rng.choice(['Caucasian', 'African American', 'Hispanic', 'Asian', 'Other/Unknown'], n,
+                                p=[0.77, 0.11, 0.04, 0.02, 0.06]),
+        'hosp_mort': hosp_mort.astype(int), 'icu_los_hours': np.round(los / 60),
+        'hospitaladmitoffset': -rng.integers(0, 48 * 60, n), 'hospitaldischargeoffset': los.astype(int) + rng.integers(0, 7200, n),
+        'unitdischargeoffset': los.astype(int),
+        'hospitaladmitsource': rng.choice(['Emergency Department', 'Operating Room', 'Floor', 'Direct Admit'], n),
+        'unitdischargelocation': rng.choice(['Floor', 'Step-Down Unit (SDU)', 'Home', 'Death'], n),
+        'icu_mort': (hosp_mort & (rng.random(n) < 0.6)).astype(int),
+        'hospitaldischargeyear': rng.choice([2014, 2015], n), 'hospitalid': rng.integers(50, 460, n)})}
+    # eICU sepsis-3 stays come from an id file, not from the query
+    tables['group_flags'] = pd.DataFrame({'patientunitstayid': stay_ids,
+                                          **{g: rng.random(n) < s for g, s in GROUP_SHARE.items()}}).drop(
+        columns='sepsis_3')
+
+    for name, (rate, share, cols) in EICU_EVENTS.items():
+        df = _value_table(rng, los, rate, share, cols, low, high)
+        time = 'observationoffset' if name == 'cvp' else 'chartoffset'
+        df.insert(0, 'patientunitstayid', stay_ids[df['_stay'].to_numpy()])
+        df.insert(1, time, np.round(df.pop('_minute')).astype(int))
+        df = df.drop(columns='_stay')
+        if name == 'vital':
+            df.insert(2, 'entryoffset', df[time] + rng.integers(0, 30, len(df)))
+        elif name == 'cvp':
+            df['cvp'] = df['cvp'].round().astype('Int64')
+        tables[name] = df
+
+    stay, minute = events(rng, los, CULTURE_RATE, start=-60)
+    tables['microlab'] = pd.DataFrame({
+        'patientunitstayid': stay_ids[stay], 'culturetakenoffset': np.round(minute).astype(int),
+        'culturesite': rng.choice([f'culturesite{i}' for i in range(14)], len(stay)),
+        'positive': (rng.random(len(stay)) < 0.3).astype(int), 'screen': (rng.random(len(stay)) < 0.2).astype(int),
+        'has_sensitivity': (rng.random(len(stay)) < 0.15).astype(int)})
+
+    for name, (share, hours) in EICU_INTERVENTIONS.items():
+        # queried with a one minute time window: floored minutes, clipped to the unit stay
+        stay, start, end = _intervals(rng, los, share, hours)
+        df = pd.DataFrame({'patientunitstayid': stay_ids[stay], 'starttime': np.maximum(start, 0),
+                           'endtime': np.minimum(end, los[stay]), 'max_hours': los[stay]})
+        if name.startswith('med_'):
+            df.insert(3, name[len('med_'):-len('_min')], 1)
+        tables[name] = df
+    tables['comorbidity'] = pd.DataFrame({'patientunitstayid': stay_ids,
+                                          **{c: (rng.random(n) < 0.12).astype(int) for c in CHARLSON}})
+    return tables
+
+
+GENERATORS = {'MIMIC': mimic_tables, 'eICU': eicu_tables}
+
+
+def write_cache(database, cache_dir, scale=1.0, seed=0, age_min=DEFAULT_AGE_MIN, los_min=DEFAULT_LOS_MIN,
+                los_max=DEFAULT_LOS_MAX, overwrite=False):
+    """
+    Write the raw query cache of a synthetic cohort, <cache_dir>/<database>_Generic/raw/<name>.parquet
+    :param database: str, 'MIMIC' or 'eICU'
+    :param scale: float, cohort size in STAYS_PER_SCALE stays
+    :param seed: int, the same seed and scale give the same tables
+    :param overwrite: bool, whether to replace a cache that was not written by this module
+    :return: str, the cache root
+    """
+    from extract_database import _save_params
+    cache_root = os.path.join(cache_dir, f'{database}_Generic')
+    if os.path.exists(cache_root):
+        # the event store and stage checkpoints of an older cohort must not survive it
+        if not overwrite and not os.path.exists(os.path.join(cache_root, MARKER)):
+            raise FileExistsError(f'{cache_root} holds a cache that is not synthetic, pass --overwrite to replace it')
+        shutil.rmtree(cache_root)
+    raw_dir = os.path.join(cache_root, 'raw')
+    os.makedirs(raw_dir)
+    n = max(int(round(scale * STAYS_PER_SCALE)), 1)
+    tables = GENERATORS[database](n, np.random.default_rng(seed), age_min=age_min, los_min=los_min, los_max=los_max)
+    for name, df in tables.items():
+        _write(raw_dir, name, df)
+    params = argparse.Namespace(database=database, age_min=age_min, los_min=los_min, los_max=los_max)
+    _save_params(cache_root, params)
+    with open(os.path.join(cache_root, MARKER), 'w') as f:
+        json.dump({'scale': scale, 'seed': seed, 'stays': n}, f, indent=2)
+    rows = sum(len(df) for df in tables.values())
+    print(f'{database}: {n} synthetic stays, {len(tables)} tables, {rows:,} rows -> {raw_dir}')
+    return cache_root
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic MIMIC/eICU query results for --offline runs")
+    parser.add_argument("--database", type=str, nargs='+', default=['MIMIC'], choices=list(GENERATORS))
+    parser.add_argument("--scale", type=float, default=1.0, help=f'Cohort size in {STAYS_PER_SCALE} stays')
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache_dir", type=str, default='./synthetic_cache')
+    parser.add_argument("--age_min", type=int, default=DEFAULT_AGE_MIN, help='Min patient age of the cohort')
+    parser.add_argument("--los_min", type=int, default=DEFAULT_LOS_MIN, help='Min ICU LOS in hour')
+    parser.add_argument("--los_max", type=int, default=DEFAULT_LOS_MAX, help='Max ICU LOS in hour')
+    parser.add_argument("--overwrite", action='store_true', default=False,
+                        help='Replace an existing cache of the database even if it was not written by this script')
+    args = parser.parse_args()
+    for database in args.database:
+        write_cache(database, args.cache_dir, scale=args.scale, seed=args.seed, age_min=args.age_min,
+                    los_min=args.los_min, los_max=args.los_max, overwrite=args.overwrite)
@@ -0,0 +1,53 @@
+"""
+Helpers of the pipeline tests: synthetic caches (synthetic.py) and offline runs of main.py.
+
+The runs are separate processes started in METRE/, the way main.py is run, so the relative
+json_files/ and resources/ paths resolve and every run reports its own peak RSS.
+"""
+import glob
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+METRE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, METRE_DIR)
+
+# main.py with the vital table kept in float64, i.e. without compact_vital
+FLOAT64_MAIN = ("import runpy, sys, extract_database; extract_database.compact_vital = lambda df: df; "
+                "sys.argv[0] = 'main.py'; runpy.run_path('main.py', run_name='__main__')")
+
+
+def _run(cmd):
+    env = dict(os.environ, PYTHONWARNINGS='ignore')
+    result = subprocess.run(cmd, cwd=METRE_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AssertionError(f'{" ".join(cmd)} failed:\n{result.stdout[-3000:]}\n{result.stderr[-3000:]}')
+    return result.stdout
+
+
+def synthetic_cache(cache_dir, scale, database='MIMIC', seed=0):
+    """
+    Write a synthetic cache of scale x 1000 stays, return its directory. Runs checkpoint their stages in
+    the cache, so runs that have to compute them on their own get a cache each (same seed, same tables).
+    """
+    _run([sys.executable, 'synthetic.py', '--database', database, '--scale', str(scale), '--seed', str(seed),
+          '--cache_dir', str(cache_dir)])
+    return str(cache_dir)
+
+
+def extract(cache_dir, output_dir, *args, database='MIMIC', float64=False):
+    """Run main.py --offline on a cache, return the run report."""
+    main = ['-c', FLOAT64_MAIN] if float64 else ['main.py']
+    _run([sys.executable, *main, '--database', database, '--offline', '--cache_dir', str(cache_dir),
+          '--output_dir', str(output_dir), *args])
+    with open(sorted(glob.glob(os.path.join(str(output_dir), 'reports', '*.json')))[-1]) as f:
+        return json.load(f)
+
+
+def read_outputs(output_dir, database='MIMIC'):
+    """MEEP_* tables of an exit point before All, by table name."""
+    return {t: pd.read_parquet(os.path.join(str(output_dir), f'MEEP_{database}_{t}.parquet'))
+            for t in ('vital', 'inv', 'static')}
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from extraction_utils import combine_aggregates, finalize_aggregates
+
+
+def _events(seed=0, n=400):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'bin': rng.integers(0, 30, n), 'item': rng.choice(['k', 'k_serum', 'k_whole'], n),
+                         'minute': rng.permutation(n).astype(float), 'value': rng.normal(4, 1, n)})
+
+
+def _state(events):
+    """Aggregate state of every (bin, item), the way the event store keeps it."""
+    events = events.sort_values('minute')
+    g = events.assign(sq=events['value'] ** 2).groupby(['bin', 'item'])
+    state = pd.DataFrame({'sum': g['value'].sum(), 'count': g['value'].count(), 'sumsq': g['sq'].sum(),
+                          'min': g['value'].min(), 'max': g['value'].max(), 'last': g['value'].last(),
+                          't_last': g['minute'].max()})
+    state = state.unstack('item').swaplevel(axis=1).sort_index(axis=1)
+    counts = state.loc[:, pd.IndexSlice[:, ['sum', 'count', 'sumsq']]]
+    state.loc[:, counts.columns] = counts.fillna(0)
+    return state
+
+
+def test_combined_state_gives_the_statistics_of_the_pooled_events():
+    events = _events()
+    # k_whole flows into k_serum, which then flows into k along with it
+    df = finalize_aggregates(combine_aggregates(_state(events), [['k_serum', 'k_whole'], ['k', 'k_serum']]))
+    assert set(df.columns.get_level_values(0)) == {'k'}
+    pooled = events.sort_values('minute').groupby('bin')['value']
+    expected = pd.DataFrame({'mean': pooled.mean(), 'count': pooled.count(), 'std': pooled.std(),
+                             'min': pooled.min(), 'max': pooled.max(), 'last': pooled.last()})
+    for stat in expected:
+        np.testing.assert_allclose(df[('k', stat)].to_numpy(), expected[stat].to_numpy(), rtol=1e-9, err_msg=stat)
+
+
+def test_finalize_leaves_windows_without_enough_values_missing():
+    columns = pd.MultiIndex.from_product([['hr'], ['sum', 'count', 'sumsq']])
+    df = finalize_aggregates(pd.DataFrame([[0.0, 0, 0.0], [70.0, 1, 4900.0], [150.0, 2, 11300.0]],
+                                          columns=columns))
+    assert list(df.columns) == [('hr', 'mean'), ('hr', 'count'), ('hr', 'std')]
+    np.testing.assert_allclose(df[('hr', 'mean')], [np.nan, 70, 75])
+    np.testing.assert_allclose(df[('hr', 'std')], [np.nan, np.nan, np.sqrt(50)])
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from extraction_utils import encode_categories
+
+
+def _vital(sites):
+    columns = pd.MultiIndex.from_tuples([('hr', 'mean'), ('site', 'last')])
+    return pd.DataFrame({('hr', 'mean'): np.arange(len(sites), dtype=float), ('site', 'last'): sites},
+                        columns=columns)
+
+
+def test_matches_get_dummies_with_a_fixed_vocabulary():
+    sites = ['blood', 'urine', 'blood', 'sputum']
+    encoded = encode_categories(_vital(sites), {('site', 'last'): ['blood', 'sputum', 'urine', 'wound']})
+    dummies = pd.get_dummies(_vital(sites), columns=[('site', 'last')], dtype=np.uint8)
+    assert list(encoded.columns[:-1]) == list(dummies.columns.to_flat_index())
+    pd.testing.assert_frame_equal(encoded.iloc[:, :-1], dummies.set_axis(encoded.columns[:-1], axis=1))
+    # a category of the vocabulary that does not occur in the chunk still gets its column
+    assert encoded["('site', 'last')_wound"].tolist() == [0, 0, 0, 0]
+    assert encoded["('site', 'last')_blood"].dtype == np.uint8
+
+
+def test_missing_and_unknown_categories_encode_as_zeros():
+    encoded = encode_categories(_vital(['blood', None, 'csf']), {('site', 'last'): ['blood', 'urine']})
+    onehot = encoded[["('site', 'last')_blood", "('site', 'last')_urine"]].to_numpy()
+    assert onehot.tolist() == [[1, 0], [0, 0], [0, 0]]
+    assert encoded[('hr', 'mean')].tolist() == [0, 1, 2]
@@ -0,0 +1,31 @@
+import ast
+
+import numpy as np
+import pytest
+
+from conftest import extract, read_outputs, synthetic_cache
+
+
+@pytest.mark.parametrize('database', ['MIMIC', 'eICU'])
+def test_extra_stats_after_impute_are_nan_where_not_observed(tmp_path, database):
+    cache = synthetic_cache(tmp_path / 'cache', 0.1, database=database)
+    # eICU is normalized with its own statistics, there is no MIMIC run to take them from
+    norm = ['--norm_eicu', 'eICU'] if database == 'eICU' else []
+    extract(cache, tmp_path / 'out', '--exit_point', 'Impute', '--extra_stats', 'min', 'max', 'last', 'std',
+            'time', *norm, database=database)
+    vital = read_outputs(tmp_path / 'out', database)['vital']
+    # parquet keeps the (variable, statistic) columns as their repr
+    vital.columns = [ast.literal_eval(c) if c.endswith(')') else c for c in vital.columns]
+    extra = ['min', 'max', 'last', 'std', 't_first', 't_last']
+    assert not vital.loc[:, [c for c in vital.columns if c[1] not in extra]].isna().any().any()
+    observed_any = False
+    for var in (c[0] for c in vital.columns if c[1] == 'mean'):
+        observed = vital[(var, 'count')].to_numpy() == 1
+        observed_any |= observed.any()
+        for s in ('min', 'max', 'last', 't_first', 't_last'):
+            # unobserved hours are missing, not 0
+            np.testing.assert_array_equal(vital[(var, s)].notna().to_numpy(), observed, err_msg=f'{var} {s}')
+        assert not vital[(var, 'std')][~observed].notna().any()
+        low, high = vital[(var, 'min')][observed], vital[(var, 'max')][observed]
+        assert (low <= high).all() and (vital[(var, 'last')][observed].between(low, high)).all()
+    assert observed_any
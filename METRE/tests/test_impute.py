@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from extraction_utils import impute_columns, impute_segments, stay_offsets
+
+
+def _stays(seed=0, n_stays=40, n_vars=5):
+    """Vital means of stays of 1 to 30 windows, about half missing, some stays starting with missing values
+    and some variables never observed in a stay."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 31, n_stays)
+    stay = np.repeat(np.arange(n_stays), lengths)
+    values = rng.normal(size=(len(stay), n_vars)).astype(np.float32)
+    values[rng.random(values.shape) < 0.5] = np.nan
+    offsets = np.r_[0, np.cumsum(lengths)]
+    values[offsets[:-1][:5]] = np.nan
+    values[offsets[7]:offsets[8], 2] = np.nan
+    return values, offsets, stay
+
+
+def _fallback(filled, observed, stay):
+    # what the kernel does with entries the strategy leaves empty: mean of the observed values of the stay, then 0
+    return filled.fillna(observed.groupby(stay).transform('mean')).fillna(0)
+
+
+@pytest.mark.parametrize('max_age', [None, 2])
+def test_ffill_matches_pandas(max_age):
+    values, offsets, stay = _stays()
+    df = pd.DataFrame(values)
+    expected = _fallback(df.groupby(stay).ffill(limit=max_age), df, stay)
+    imputed = impute_segments(values, offsets, 'ffill', max_age=max_age, block=2)
+    assert imputed.dtype == np.float32
+    np.testing.assert_allclose(imputed, expected.to_numpy(), rtol=1e-6, atol=1e-6)
+
+
+def test_linear_matches_pandas():
+    values, offsets, stay = _stays(seed=1)
+    df = pd.DataFrame(values, dtype=np.float64)
+    # interpolation between observations, then the last one carried forward
+    expected = df.groupby(stay, group_keys=False).apply(lambda g: g.interpolate(limit_area='inside').ffill())
+    np.testing.assert_allclose(impute_segments(values, offsets, 'linear'), _fallback(expected, df, stay).to_numpy(),
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_decay_toward_the_stay_mean():
+    values = np.array([[np.nan], [1.0], [np.nan], [np.nan], [3.0], [np.nan]], dtype=np.float32)
+    imputed = impute_segments(values, np.array([0, 6]), 'decay', decay=2.0)[:, 0]
+    # stay mean 2: before the first observation it is the mean, afterwards the last value decays toward it
+    expected = [2, 1, 2 - np.exp(-0.5), 2 - np.exp(-1), 3, 2 + np.exp(-0.5)]
+    np.testing.assert_allclose(imputed, expected, rtol=1e-6)
+
+
+def test_impute_columns_needs_contiguous_stays():
+    index = pd.MultiIndex.from_arrays([[1, 1, 2, 2], [0, 1, 0, 1]], names=['stay_id', 'hours_in'])
+    df = pd.DataFrame({('hr', 'mean'): [np.nan, 60.0, 80.0, np.nan], ('hr', 'count'): [0, 1, 1, 0]}, index=index)
+    impute_columns(df, [('hr', 'mean')], 'stay_id')
+    assert df[('hr', 'mean')].tolist() == [60.0, 60.0, 80.0, 80.0]
+    with pytest.raises(ValueError, match='not contiguous'):
+        stay_offsets(df.index[[0, 2, 1, 3]], 'stay_id')
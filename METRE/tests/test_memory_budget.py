@@ -0,0 +1,53 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from conftest import extract, read_outputs, synthetic_cache
+from extract_database import BIN_WORK_FACTOR, N_CHUNKS, WORK_FACTOR, _raw_slices, _vital_chunk_count
+
+# a run on 1000 synthetic stays peaks at about 220 MB without a budget
+BUDGET_GB = 0.2
+
+
+def test_raw_slices_fit_the_budget(tmp_path):
+    rng = np.random.default_rng(0)
+    stays = np.repeat(np.arange(200), rng.integers(1, 400, 200))
+    path = str(tmp_path / 'events.parquet')
+    pd.DataFrame({'stay_id': rng.permutation(stays), 'value': rng.random(len(stays)),
+                  'charttime': rng.random(len(stays))}).to_parquet(path)
+    row_size = 3 * 8 * BIN_WORK_FACTOR
+    budget = len(stays) * row_size / 5
+    slices = _raw_slices(path, 'stay_id', budget)
+    rows = pd.Series(stays).value_counts()
+    # every stay in exactly one slice, every slice within the budget up to the stay it ends on
+    assert sorted(s for ids in slices for s in ids) == sorted(rows.index)
+    assert len(slices) == 5
+    assert all((rows[ids].sum() - rows.max()) * row_size <= budget for ids in slices)
+    assert _raw_slices(path, 'stay_id', len(stays) * row_size) is None
+
+
+def test_vital_chunks_fit_the_headroom():
+    rows, cols, headroom = 2_000_000, 184, 2 ** 30
+    for workers in (1, 4):
+        n = _vital_chunk_count(rows, cols, workers, headroom)
+        assert rows / n * cols * 8 * WORK_FACTOR * workers <= headroom
+        # a power of two times N_CHUNKS, at most twice what is needed
+        assert n // N_CHUNKS & (n // N_CHUNKS - 1) == 0
+        assert n == N_CHUNKS or rows / (n / 2) * cols * 8 * WORK_FACTOR * workers > headroom
+    assert _vital_chunk_count(1000, cols, 1, headroom) == N_CHUNKS
+
+
+def test_memory_budget_bounds_peak_rss_and_keeps_outputs(tmp_path):
+    cache = synthetic_cache(tmp_path / 'cache', 1)
+    shutil.copytree(cache, tmp_path / 'cache_budget')
+    full_report = extract(cache, tmp_path / 'full', '--exit_point', 'Impute')
+    report = extract(tmp_path / 'cache_budget', tmp_path / 'budget', '--exit_point', 'Impute',
+                     '--memory_budget', str(BUDGET_GB))
+    # the budget is below what the run takes without one, and the run stays within it
+    assert full_report['peak_rss_mb'] > BUDGET_GB * 1024
+    assert report['peak_rss_mb'] < BUDGET_GB * 1024
+    assert all(s['peak_rss_mb'] < BUDGET_GB * 1024 for s in report['stages'])
+    full, budget = read_outputs(tmp_path / 'full'), read_outputs(tmp_path / 'budget')
+    for table in full:
+        pd.testing.assert_frame_equal(budget[table], full[table])
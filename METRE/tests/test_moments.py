@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+from extraction_utils import finalize_moments, merge_moments, moment_stats
+
+
+def test_merged_chunk_moments_match_the_whole_table():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(50, 10, size=(1000, 4)), columns=['a', 'b', 'c', 'never'])
+    df[df > 60] = np.nan
+    df['never'] = np.nan
+    df.loc[3, 'c'] = 1e6
+    moments = None
+    # uneven chunks, one of them empty
+    for start, end in [(0, 0), (0, 7), (7, 300), (300, 301), (301, 800), (800, 1000)]:
+        chunk = df.iloc[start:end]
+        moments = merge_moments(moments, moment_stats(chunk))
+    col_means, col_stds = finalize_moments(moments)
+    pd.testing.assert_series_equal(col_means, df.mean(), check_names=False, rtol=1e-12)
+    pd.testing.assert_series_equal(col_stds, df.std(), check_names=False, rtol=1e-9)
+    assert np.isnan(col_means['never']) and np.isnan(col_stds['never'])
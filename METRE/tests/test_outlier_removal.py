@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from conftest import extract, read_outputs, synthetic_cache
+from extraction_utils import compact_vital, compile_outlier_bounds, remove_outliers
+
+
+def test_float32_means_at_the_bounds_are_kept():
+    mean_cols = [('calcium', 'mean'), ('lactate', 'mean')]
+    low, high = compile_outlier_bounds(mean_cols, {'lactate': 0.01}, {'calcium': 1.87})
+    X = pd.DataFrame({('calcium', 'mean'): [1.87, 1.88, np.nan], ('calcium', 'count'): [1.0, 2.0, 0.0],
+                      ('lactate', 'mean'): [0.01, 0.005, 1.0], ('lactate', 'count'): [1.0, 1.0, 1.0]})
+    for df in (X.copy(), compact_vital(X)):
+        removed = remove_outliers(df, mean_cols, low, high)
+        assert removed.to_dict() == {'calcium': 1, 'lactate': 1}
+        assert df[('calcium', 'mean')].notna().tolist() == [True, False, False]
+        assert df[('lactate', 'mean')].notna().tolist() == [True, False, True]
+        assert df[('lactate', 'count')].tolist() == [1, 0, 1]
+
+
+def test_outlier_removal_matches_float64_run(tmp_path):
+    # compact_vital only changes how the means are stored, entries removed at the bounds stay the same
+    out = {}
+    for name, float64 in (('float32', False), ('float64', True)):
+        cache = synthetic_cache(tmp_path / f'cache_{name}', 0.1)
+        extract(cache, tmp_path / name, '--exit_point', 'Outlier_removal', float64=float64)
+        out[name] = read_outputs(tmp_path / name)
+    vital, reference = out['float32']['vital'], out['float64']['vital']
+    pd.testing.assert_frame_equal(vital, reference.astype(vital.dtypes.to_dict()))
+    for table in ('inv', 'static'):
+        pd.testing.assert_frame_equal(out['float32'][table], out['float64'][table])
@@ -0,0 +1,10 @@
+import pytest
+
+from conftest import extract, synthetic_cache
+
+
+def test_eicu_groups_without_the_sepsis_id_file(tmp_path):
+    cache = synthetic_cache(tmp_path / 'cache', 0.1, database='eICU')
+    extract(cache, tmp_path / 'out', '--patient_group', 'ARF', '--exit_point', 'Raw', database='eICU')
+    with pytest.raises(AssertionError, match='eicu_sepsis_3_id.csv'):
+        extract(cache, tmp_path / 'out', '--patient_group', 'sepsis_3', '--exit_point', 'Raw', database='eICU')
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+
+from conftest import METRE_DIR
+
+sys.path.insert(0, os.path.join(METRE_DIR, 'training'))
+from ragged_dataset import DatasetWriter, load_dataset  # noqa: E402
+
+
+def test_splits_without_stays_are_written_empty(tmp_path):
+    path = str(tmp_path / 'compile')
+    with DatasetWriter(path, ['hosp_mort', 'age']) as writer:
+        writer.add('train', np.arange(12).reshape(4, 3), [1, 3], [10, 11], [[0, 60], [1, 70]])
+    assert sorted(writer.meta['splits']) == ['dev', 'test', 'train']
+    data = load_dataset(path)
+    assert [h.shape for h in data['train_head']] == [(3, 1), (3, 3)]
+    for split in ('dev', 'test'):
+        assert len(data[f'{split}_head']) == 0
+        assert data[f'{split}_head'].offsets.tolist() == [0]
+        assert data[f'{split}_head'].values.shape == (0, 3)
+        assert data[f'static_{split}_filter'].shape == (0, 2)
+        assert len(data[f'{split}_stay_ids']) == 0
@@ -0,0 +1,14 @@
+import subprocess
+import sys
+
+import numpy as np
+
+from conftest import METRE_DIR
+
+PEAK = 'import run_report; print(run_report.peak_rss_mb())'
+
+
+def test_peak_rss_is_not_inherited_from_the_parent():
+    held = np.ones(50_000_000)  # 400 MB in this process
+    child = subprocess.run([sys.executable, '-c', PEAK], cwd=METRE_DIR, capture_output=True, text=True, check=True)
+    assert held.sum() and float(child.stdout) < 200
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from conftest import extract, synthetic_cache
+from extraction_utils import SPLITS, assign_split, read_split, stay_bucket
+
+
+def test_split_of_an_id_does_not_depend_on_the_chunk():
+    ids = np.arange(30000000, 30100000)
+    split = assign_split(ids)
+    # every chunk is assigned on its own
+    np.testing.assert_array_equal(np.concatenate([assign_split(c) for c in np.array_split(ids, 7)]), split)
+    np.testing.assert_array_equal(assign_split(ids[::-1]), split[::-1])
+    shares = pd.Series(split).value_counts(normalize=True)
+    for name, frac in SPLITS:
+        assert abs(shares[name] - frac) < 0.01
+    buckets = stay_bucket(ids, 16)
+    assert buckets.min() == 0 and buckets.max() == 15
+    np.testing.assert_array_equal(stay_bucket(ids[:100], 16), buckets[:100])
+
+
+def test_stays_of_a_patient_are_in_one_split(tmp_path):
+    cache = synthetic_cache(tmp_path / 'cache', 0.1)
+    extract(cache, tmp_path / 'out', '--split_by', 'patient', '--split_buckets', '4')
+    root = os.path.join(tmp_path, 'out', 'MIMIC_split')
+    stays = {}
+    for name, _ in SPLITS:
+        vital = read_split(os.path.join(root, 'vital'), name)
+        static = read_split(os.path.join(root, 'static'), name)
+        assert (static['split'] == name).all()
+        assert set(vital.index.get_level_values('stay_id')) == set(static.index.get_level_values('stay_id'))
+        stays[name] = static.index.to_frame(index=False)
+    stays = pd.concat(stays, names=['split']).reset_index('split')
+    assert stays['stay_id'].is_unique
+    assert (stays.groupby('subject_id')['split'].nunique() == 1).all()
+    # a subset of the buckets is a subset of the rows
+    part = read_split(os.path.join(root, 'vital'), 'train', buckets=[0, 1])
+    assert 0 < len(part) < len(read_split(os.path.join(root, 'vital'), 'train'))
@@ -0,0 +1,40 @@
+import os
+import shutil
+
+import pandas as pd
+
+from conftest import extract, read_outputs, synthetic_cache
+
+
+def _statuses(report):
+    return [(s['stage'], s['status']) for s in report['stages'] if s['stage'] in
+            ('intervention', 'static', 'vital', 'outlier', 'norm_stats', 'impute')]
+
+
+def test_changed_raw_tables_invalidate_the_stages_built_from_them(tmp_path):
+    cache = synthetic_cache(tmp_path / 'cache', 0.1)
+    extract(cache, tmp_path / 'first', '--exit_point', 'Impute')
+    # every stage once, from the checkpoints
+    assert _statuses(extract(cache, tmp_path / 'first', '--exit_point', 'Impute')) == [
+        ('intervention', 'cached'), ('static', 'cached'), ('vital', 'cached'), ('outlier', 'cached'),
+        ('norm_stats', 'cached'), ('impute', 'cached')]
+
+    # an event table and an intervention table queried again, with other results
+    raw = os.path.join(cache, 'MIMIC_Generic', 'raw')
+    vitalsign = pd.read_parquet(os.path.join(raw, 'vitalsign.parquet'))
+    vitalsign['heart_rate'] += 5
+    vent = pd.read_parquet(os.path.join(raw, 'vent.parquet'))
+    vent = vent.iloc[len(vent) // 2:]
+    fresh = tmp_path / 'fresh_cache'
+    shutil.copytree(cache, fresh, ignore=shutil.ignore_patterns('stages', 'store_*'))
+    for root in (raw, os.path.join(fresh, 'MIMIC_Generic', 'raw')):
+        vitalsign.to_parquet(os.path.join(root, 'vitalsign.parquet'))
+        vent.to_parquet(os.path.join(root, 'vent.parquet'))
+
+    statuses = dict(_statuses(extract(cache, tmp_path / 'second', '--exit_point', 'Impute')))
+    assert [statuses[s] for s in ('intervention', 'vital', 'outlier', 'norm_stats', 'impute')] == ['ok'] * 5
+    extract(fresh, tmp_path / 'fresh', '--exit_point', 'Impute')
+    second, reference = read_outputs(tmp_path / 'second'), read_outputs(tmp_path / 'fresh')
+    for table in second:
+        pd.testing.assert_frame_equal(second[table], reference[table])
+    assert not read_outputs(tmp_path / 'first')['inv'].equals(second['inv'])
@@ -1,23 +1,32 @@
 """
-Compile MEEP parquet files to .npy format expected by METRE training scripts.
+Compile MEEP parquet files to the dataset format expected by METRE training scripts.
 
-Converts MEEP_MIMIC_vital.parquet, MEEP_MIMIC_inv.parquet, MEEP_MIMIC_static.parquet
-into the train_head/dev_head/test_head + static_train_filter/etc. structure.
+Converts MEEP_MIMIC_vital.parquet, MEEP_MIMIC_inv.parquet, MEEP_MIMIC_static.parquet,
+or the MIMIC_split/ datasets of the All exit point, into the
+train_head/dev_head/test_head + static_train_filter/etc. structure, saved as a
+memory-mappable ragged dataset directory (see ragged_dataset.py) or, with --format npy,
+as the older pickled .npy dict. Both are read with ragged_dataset.load_dataset.
+The ragged dataset is written block by block (one vital partition or row group and the
+intervention rows of its stays), memory does not grow with the cohort.
 
 Usage:
-    python compile_meep_to_npy.py --input_dir ../output --output_path ../output/MIMIC_compile.npy
-    python compile_meep_to_npy.py --input_dir ../output --output_path ../output/MIMIC_compile.npy --database eICU
+    python compile_meep_to_npy.py --input_dir ../output --output_path ../output/MIMIC_compile
+    python compile_meep_to_npy.py --input_dir ../output --output_path ../output/eICU_compile --database eICU
 """
 import argparse
-import json
 import os
+import sys
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from extraction_utils import SPLITS, assign_split, read_split, split_paths
+from run_report import RunReport, stage
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ragged_dataset import DatasetWriter
 
-# Match extract_database split
-SEED = 41
-TRAIN_FRAC, DEV_FRAC, TEST_FRAC = 0.7, 0.1, 0.2
 
 # Intervention column order (must match extract_database merge order)
 INV_COLS = [
@@ -25,196 +34,282 @@ INV_COLS = [
     'phenylephrine', 'vasopressin', 'dobutamine', 'milrinone', 'heparin',
     'crrt', 'rbc_trans', 'platelets_trans', 'ffp_trans', 'colloid_bolus', 'crystalloid_bolus'
 ]
+# The same interventions under their eICU names
+EICU_INV_COLS = [
+    'vent', 'antib', 'dopamine', 'epinephrine', 'norepinephrine',
+    'phenylephrine', 'vasopressin', 'dobutamine', 'milrinone', 'heparin',
+    'crrt', 'rbc', 'platelets', 'ffp', 'colloid', 'crystalloid'
+]
 
-
-def _load_mimic(input_dir):
-    """Load MIMIC MEEP parquets."""
-    vital = pd.read_parquet(os.path.join(input_dir, 'MEEP_MIMIC_vital.parquet'))
-    inv = pd.read_parquet(os.path.join(input_dir, 'MEEP_MIMIC_inv.parquet'))
-    static = pd.read_parquet(os.path.join(input_dir, 'MEEP_MIMIC_static.parquet'))
-    return vital, inv, static
-
-
-def _load_eicu(input_dir):
-    """Load eICU MEEP parquets."""
-    vital = pd.read_parquet(os.path.join(input_dir, 'MEEP_eICU_vital.parquet'))
-    inv = pd.read_parquet(os.path.join(input_dir, 'MEEP_eICU_inv.parquet'))
-    static = pd.read_parquet(os.path.join(input_dir, 'MEEP_eICU_static.parquet'))
-    return vital, inv, static
-
-
-def _get_stay_id_level(df, database):
-    """Return the index level name for stay_id."""
-    if database == 'MIMIC':
-        return 2  # subject_id=0, hadm_id=1, stay_id=2
-    else:
-        return 0  # patientunitstayid
-
-
-def _build_stay_arrays(vital, inv, database):
+# Static labels and covariates of the compiled data: name -> (MIMIC column, eICU column). mort_hosp is
+# first, the training scripts read the mortality label from column 0
+STATIC_COLUMNS = {
+    'mort_hosp': ('mort_hosp', 'hosp_mort'),
+    'mort_icu': ('mort_icu', 'icu_mort'),
+    'readmission_30': ('readmission_30', None),
+    'los_icu_hours': ('los_icu', 'icu_los_hours'),
+    'max_hours': ('max_hours', 'max_hours'),
+    'age': ('age', 'age'),
+    'gender_male': ('gender', 'gender'),
+    **{c: (c, c) for c in [
+        'myocardial_infarct', 'congestive_heart_failure', 'peripheral_vascular_disease', 'cerebrovascular_disease',
+        'dementia', 'chronic_pulmonary_disease', 'rheumatic_disease', 'peptic_ulcer_disease', 'mild_liver_disease',
+        'diabetes_without_cc', 'diabetes_with_cc', 'paraplegia', 'renal_disease', 'malignant_cancer',
+        'severe_liver_disease', 'metastatic_solid_tumor', 'aids']},
+}
+
+
+def _stay_level(database):
+    """Index level that tells stays apart."""
+    return 'stay_id' if database == 'MIMIC' else 'patientunitstayid'
+
+
+def _stay_matrix(vital, inv, database):
     """
-    Build list of (n_features, n_hours) arrays, one per stay.
+    Hours of all stays as one (rows, n_features) float32 matrix, sorted by stay and hour.
     Features = vital columns (184) + intervention columns (16) = 200.
+
+    Returns the matrix, the number of hours of every stay and the stay ids (ascending).
     """
-    stay_level_name = 'stay_id' if database == 'MIMIC' else 'patientunitstayid'
+    stay_level_name = _stay_level(database)
 
     vital_cols = list(vital.columns)
-    for c in INV_COLS:
+    inv_cols = INV_COLS if database == 'MIMIC' else EICU_INV_COLS
+    for c in inv_cols:
         if c not in inv.columns:
             raise ValueError(f"Missing intervention column: {c}")
 
-    head_list = []
-    stay_order = []
-
-    # Merge vital and inv on index for alignment
-    merged = vital.merge(inv[INV_COLS], left_index=True, right_index=True, how='outer')
-
-    for stay_id, group in merged.groupby(level=stay_level_name):
-        # Reset index to get hours_in as column, sort, ensure one row per hour
-        group = group.reset_index()
-        if 'hours_in' in group.columns:
-            group = group.sort_values('hours_in').drop_duplicates(subset=['hours_in'], keep='first')
-        cols_need = vital_cols + INV_COLS
-        group = group[[c for c in cols_need if c in group.columns]]
-        group = group.fillna(0)
-
-        v_arr = group[vital_cols].values.T.astype(np.float32)  # (184, n_hours)
-        i_arr = group[INV_COLS].values.T.astype(np.float32)   # (16, n_hours)
-        combined = np.vstack([v_arr, i_arr])  # (200, n_hours)
-        head_list.append(combined)
-        stay_order.append(stay_id)
-
-    return head_list, stay_order
-
-
-def _build_static_arrays(static, stay_order, database):
-    """Build static_train_filter etc. - list of arrays with mort_hosp as first column."""
-    stay_level_name = 'stay_id' if database == 'MIMIC' else 'patientunitstayid'
-    mort_col = 'mort_hosp' if 'mort_hosp' in static.columns else 'hosp_mort'
-
-    static_arrays = []
-    for stay_id in stay_order:
-        try:
-            if stay_level_name in static.index.names:
-                row = static.xs(stay_id, level=stay_level_name)
-            else:
-                row = static.loc[stay_id]
-            if isinstance(row, pd.DataFrame):
-                row = row.iloc[0]
-            val = row[mort_col] if mort_col in row.index else np.nan
-            static_arrays.append(np.array([val], dtype=np.float32))
-        except (KeyError, IndexError):
-            static_arrays.append(np.array([np.nan], dtype=np.float32))
-
-    return static_arrays
-
-
-def _split_stays(stay_ids, stay_level_idx):
-    """Same 70/10/20 split as extract_database (SEED=41)."""
-    np.random.seed(SEED)
-    perm = np.random.permutation(list(stay_ids))
-    N = len(perm)
-    n_train = int(TRAIN_FRAC * N)
-    n_dev = int(DEV_FRAC * N)
-    n_test = N - n_train - n_dev
-    train_stay = set(perm[:n_train])
-    dev_stay = set(perm[n_train:n_train + n_dev])
-    test_stay = set(perm[n_train + n_dev:])
-    return train_stay, dev_stay, test_stay
-
+    # Align vital and inv on index, by a lookup instead of a merge when both have the same (unique) rows
+    pos = None
+    if len(vital) == len(inv) and vital.index.is_unique and inv.index.is_unique:
+        pos = inv.index.get_indexer(vital.index)
+    if pos is not None and (pos >= 0).all():
+        index, sources = vital.index, [(vital, None), (inv[inv_cols], pos)]
+    else:
+        merged = vital.merge(inv[inv_cols], left_index=True, right_index=True, how='outer')
+        index, sources = merged.index, [(merged[vital_cols + inv_cols], None)]
+
+    # One sort by (stay, hour), then keep the first row of every (stay, hour)
+    stays = index.get_level_values(stay_level_name).to_numpy()
+    if 'hours_in' in index.names:
+        hours = index.get_level_values('hours_in').to_numpy()
+        order = np.lexsort((hours, stays))
+        stays, hours = stays[order], hours[order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (stays[1:] != stays[:-1]) | (hours[1:] != hours[:-1])
+        order, stays = order[keep], stays[keep]
+    else:
+        order = np.argsort(stays, kind='stable')
+        stays = stays[order]
 
-def compile_mimic(input_dir):
-    """Compile MIMIC MEEP parquets to training format."""
-    vital, inv, static = _load_mimic(input_dir)
-    stay_level = _get_stay_id_level(vital, 'MIMIC')
-    stay_ids = set(vital.index.get_level_values(stay_level).unique())
+    # One float32 conversion per source, gathered straight into the sorted matrix
+    values = np.empty((len(order), len(vital_cols) + len(inv_cols)), dtype=np.float32)
+    col = 0
+    for frame, rows in sources:
+        values[:, col:col + frame.shape[1]] = frame.to_numpy(np.float32)[order if rows is None else rows[order]]
+        col += frame.shape[1]
+    np.copyto(values, 0, where=np.isnan(values))
 
-    train_stay, dev_stay, test_stay = _split_stays(stay_ids, stay_level)
+    starts = np.flatnonzero(np.r_[True, stays[1:] != stays[:-1]]) if len(stays) else np.empty(0, dtype=np.int64)
+    lengths = np.diff(np.r_[starts, len(stays)])
+    return values, lengths, stays[starts]
 
-    def select_stays(df, stays):
-        return df[df.index.get_level_values(stay_level).isin(stays)]
 
-    vital_train = select_stays(vital, train_stay)
-    vital_dev = select_stays(vital, dev_stay)
-    vital_test = select_stays(vital, test_stay)
-    inv_train = select_stays(inv, train_stay)
-    inv_dev = select_stays(inv, dev_stay)
-    inv_test = select_stays(inv, test_stay)
+def _build_stay_arrays(vital, inv, database):
+    """
+    Build list of (n_features, n_hours) arrays, one per stay, as views of the _stay_matrix rows.
+    """
+    values, lengths, stay_order = _stay_matrix(vital, inv, database)
+    head_list = [rows.T for rows in np.split(values, np.cumsum(lengths)[:-1])] if len(lengths) else []
+    return head_list, list(stay_order)
+
+
+def _static_column(static, name, database):
+    """One STATIC_COLUMNS column of the static table as floats, NaN where the database does not have it."""
+    col = STATIC_COLUMNS[name][0 if database == 'MIMIC' else 1]
+    if col not in static.columns:
+        return pd.Series(np.nan, index=static.index)
+    values = static[col]
+    if name == 'gender_male':
+        return values.astype(str).map({'M': 1.0, 'Male': 1.0, 'F': 0.0, 'Female': 0.0})
+    if name == 'age':
+        # eICU ages are strings, older than 89 is '> 89'
+        return pd.to_numeric(values.astype(str).replace('> 89', '90'), errors='coerce')
+    values = pd.to_numeric(values, errors='coerce')
+    if name == 'los_icu_hours' and database == 'MIMIC':
+        return values * 24  # los_icu is in days
+    return values
+
+
+def _static_table(static, database):
+    """STATIC_COLUMNS of the static table as floats, indexed by stay id (the first row of every stay)."""
+    table = pd.DataFrame({name: _static_column(static, name, database) for name in STATIC_COLUMNS})
+    table.index = static.index.get_level_values(_stay_level(database))
+    return table[~table.index.duplicated()]
+
+
+def _build_static_arrays(table, stay_order):
+    """
+    Build static_train_filter etc. - a (n_stays, len(STATIC_COLUMNS)) float32 array in stay_order,
+    mort_hosp as first column, from the _static_table. Stays missing from the static table are NaN.
+    """
+    return table.reindex(stay_order).to_numpy(np.float32)
 
-    def build_split(v, i, s):
-        head_list, order = _build_stay_arrays(v, i, 'MIMIC')
-        static_list = _build_static_arrays(s, order, 'MIMIC')
-        return head_list, static_list
 
-    train_head, static_train_filter = build_split(vital_train, inv_train, static)
-    dev_head, static_dev_filter = build_split(vital_dev, inv_dev, static)
-    test_head, static_test_filter = build_split(vital_test, inv_test, static)
+def _read_stays(paths, stay_name, stays):
+    """Rows of the given stays from parquet files, the other rows are filtered out while reading."""
+    ids = list(stays)
+    frames = [pd.read_parquet(p, filters=[(stay_name, 'in', ids)]) for p in paths] if ids else []
+    return pd.concat(frames) if frames else pd.DataFrame()
 
-    return {
-        'train_head': train_head,
-        'dev_head': dev_head,
-        'test_head': test_head,
-        'static_train_filter': static_train_filter,
-        'static_dev_filter': static_dev_filter,
-        'static_test_filter': static_test_filter,
-    }
 
+def _row_groups(path, stay_name):
+    """
+    Yield the rows of a parquet file one row group at a time, cut at stay boundaries.
 
-def compile_eicu(input_dir):
-    """Compile eICU MEEP parquets to training format."""
-    vital, inv, static = _load_eicu(input_dir)
-    stay_level = _get_stay_id_level(vital, 'eICU')
-    stay_ids = set(vital.index.get_level_values(stay_level).unique())
+    The rows of the last stay of a row group are held back and yielded with the next one, so every
+    block has whole stays as long as the rows of a stay are contiguous in the file.
+    """
+    pf = pq.ParquetFile(path)
+    carry, seen = None, set()
+    for i in range(pf.num_row_groups):
+        block = pf.read_row_group(i).to_pandas()
+        if carry is not None:
+            block = pd.concat([carry, block])
+        ids = block.index.get_level_values(stay_name)
+        carry = None
+        if i < pf.num_row_groups - 1 and len(block):
+            tail = ids == ids[-1]
+            carry, block, ids = block[tail], block[~tail], ids[~tail]
+        stays = set(ids.unique())
+        if not seen.isdisjoint(stays):
+            raise ValueError(f'{path}: the rows of a {stay_name} are not contiguous, cannot compile it in blocks')
+        seen |= stays
+        if len(block):
+            yield block
+
+
+def _load_splits(input_dir, database):
+    """
+    Yield (split, vital, inv) blocks of whole stays, plus the static table first as (None, static, None).
 
-    train_stay, dev_stay, test_stay = _split_stays(stay_ids, stay_level)
+    From the split dataset of the All exit point (<database>_split/) when it exists, one vital partition
+    (an extraction chunk, or chunk and stay bucket) at a time. Otherwise from the MEEP_* files of an earlier
+    exit point, one row group of the vital file at a time, split by the static 'split' column or, for older
+    outputs, by the same stay id hash as extract_database. Only the inv rows of the stays of a block are read,
+    so memory is bounded by one block and the static table, not by the cohort.
+    """
+    stay_name = _stay_level(database)
+    split_dir = os.path.join(input_dir, f'{database}_split')
+    if os.path.isdir(os.path.join(split_dir, 'vital')):
+        with stage('load') as st:
+            static = pd.concat([read_split(os.path.join(split_dir, 'static'), split) for split, _ in SPLITS])
+            st.output(static)
+        yield None, static, None
+        for split, _ in SPLITS:
+            inv_paths = split_paths(os.path.join(split_dir, 'inv'), split)
+            for part, path in enumerate(split_paths(os.path.join(split_dir, 'vital'), split)):
+                with stage('load', split=split, part=part) as st:
+                    vital = pd.read_parquet(path)
+                    inv = _read_stays(inv_paths, stay_name, vital.index.get_level_values(stay_name).unique())
+                    st.output(vital)
+                yield split, vital, inv
+        return
+
+    meep = lambda table: os.path.join(input_dir, f'MEEP_{database}_{table}.parquet')
+    with stage('load') as st:
+        static = pd.read_parquet(meep('static'))
+        st.output(static)
+    yield None, static, None
+    if 'split' in static.columns:
+        split_of = pd.Series(static['split'].to_numpy(), index=static.index.get_level_values(stay_name))
+        split_of = split_of[~split_of.index.duplicated()]
+    else:
+        split_of = None
+    for part, vital in enumerate(_row_groups(meep('vital'), stay_name)):
+        with stage('load', part=part) as st:
+            stays = vital.index.get_level_values(stay_name)
+            inv = _read_stays([meep('inv')], stay_name, stays.unique())
+            st.output(vital)
+        inv_stays = inv.index.get_level_values(stay_name)
+        split = assign_split(stays) if split_of is None else split_of.reindex(stays).to_numpy()
+        inv_split = assign_split(inv_stays) if split_of is None else split_of.reindex(inv_stays).to_numpy()
+        for name, _ in SPLITS:
+            if (split == name).any():
+                yield name, vital[split == name], inv[inv_split == name]
+
+
+def _compile(input_dir, database, add):
+    """
+    Compile the MEEP parquets of one database to the training format, block by block.
 
-    def select_stays(df, stays):
-        return df[df.index.get_level_values(stay_level).isin(stays)]
+    add(split, values, lengths, stay_ids, static) receives every block of whole stays as it is built,
+    e.g. DatasetWriter.add, nothing is kept here.
+    """
+    splits = _load_splits(input_dir, database)
+    _, static, _ = next(splits)
+    static = _static_table(static, database)
+    for split, vital, inv in splits:
+        with stage('stay_arrays', split=split) as st:
+            values, lengths, order = _stay_matrix(vital, inv, database)
+            static_block = _build_static_arrays(static, order)
+            st.input(vital)
+        add(split, values, lengths, order, static_block)
+
+
+def _compile_dict(input_dir, database):
+    """Compile to the in-memory dict of the .npy format: lists of (n_features, n_hours) stay arrays."""
+    blocks = {split: [] for split, _ in SPLITS}
+    _compile(input_dir, database, lambda split, *block: blocks[split].append(block))
+    data = {'static_columns': list(STATIC_COLUMNS)}
+    for split, parts in blocks.items():
+        data[f'{split}_head'] = [rows.T for values, lengths, _, _ in parts
+                                 for rows in np.split(values, np.cumsum(lengths)[:-1]) if len(lengths)]
+        data[f'{split}_stay_ids'] = np.concatenate([ids for _, _, ids, _ in parts]) if parts else np.array([])
+        data[f'static_{split}_filter'] = (np.concatenate([static for *_, static in parts]) if parts else
+                                          np.empty((0, len(STATIC_COLUMNS)), np.float32))
+    return data
 
-    vital_train = select_stays(vital, train_stay)
-    vital_dev = select_stays(vital, dev_stay)
-    vital_test = select_stays(vital, test_stay)
-    inv_train = select_stays(inv, train_stay)
-    inv_dev = select_stays(inv, dev_stay)
-    inv_test = select_stays(inv, test_stay)
 
-    def build_split(v, i, s):
-        head_list, order = _build_stay_arrays(v, i, 'eICU')
-        static_list = _build_static_arrays(s, order, 'eICU')
-        return head_list, static_list
+def compile_mimic(input_dir):
+    """Compile MIMIC MEEP parquets to training format."""
+    return _compile_dict(input_dir, 'MIMIC')
 
-    train_head, static_train_filter = build_split(vital_train, inv_train, static)
-    dev_head, static_dev_filter = build_split(vital_dev, inv_dev, static)
-    test_head, static_test_filter = build_split(vital_test, inv_test, static)
 
-    return {
-        'train_head': train_head,
-        'dev_head': dev_head,
-        'test_head': test_head,
-        'static_train_filter': static_train_filter,
-        'static_dev_filter': static_dev_filter,
-        'static_test_filter': static_test_filter,
-    }
+def compile_eicu(input_dir):
+    """Compile eICU MEEP parquets to training format."""
+    return _compile_dict(input_dir, 'eICU')
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Compile MEEP parquet to .npy for METRE training")
-    parser.add_argument("--input_dir", type=str, required=True, help="Directory containing MEEP_*_vital.parquet etc.")
-    parser.add_argument("--output_path", type=str, required=True, help="Output .npy file path")
+    parser = argparse.ArgumentParser(description="Compile MEEP parquet to a dataset for METRE training")
+    parser.add_argument("--input_dir", type=str, required=True, help="Directory containing MEEP_*_vital.parquet etc. or the <database>_split datasets")
+    parser.add_argument("--output_path", type=str, required=True,
+                        help="Output dataset directory (or .npy file path with --format npy)")
     parser.add_argument("--database", type=str, default='MIMIC', choices=['MIMIC', 'eICU'])
+    parser.add_argument("--format", type=str, default='ragged', choices=['ragged', 'npy'],
+                        help="ragged: memory-mappable dataset directory, npy: pickled dict of stay arrays")
     args = parser.parse_args()
 
-    if args.database == 'MIMIC':
-        data = compile_mimic(args.input_dir)
-    else:
-        data = compile_eicu(args.input_dir)
-
-    os.makedirs(os.path.dirname(os.path.abspath(args.output_path)) or '.', exist_ok=True)
-    np.save(args.output_path, data, allow_pickle=True)
+    output_dir = os.path.dirname(os.path.abspath(args.output_path)) or '.'
+    os.makedirs(output_dir, exist_ok=True)
+    with RunReport(f'compile_{args.database}', os.path.join(output_dir, 'reports')):
+        if args.format == 'ragged':
+            # stays are written as they are built, only one block is in memory
+            with DatasetWriter(args.output_path, list(STATIC_COLUMNS), splits=[s for s, _ in SPLITS]) as writer:
+                _compile(args.input_dir, args.database, writer.add)
+            with stage('save') as st:
+                st.written(*(os.path.join(args.output_path, f) for f in os.listdir(args.output_path)))
+            stays = {split: info['stays'] for split, info in writer.meta['splits'].items()}
+        else:
+            data = _compile_dict(args.input_dir, args.database)
+            with stage('save') as st:
+                np.save(args.output_path, data, allow_pickle=True)
+                st.written(args.output_path)
+            stays = {split: len(data[f'{split}_head']) for split, _ in SPLITS}
     print(f"Saved {args.output_path}")
-    print(f"  train: {len(data['train_head'])} stays, shapes e.g. {data['train_head'][0].shape}")
-    print(f"  dev:   {len(data['dev_head'])} stays")
-    print(f"  test:  {len(data['test_head'])} stays")
+    for split, _ in SPLITS:
+        print(f"  {split + ':':<6} {stays.get(split, 0)} stays")
 
 
 if __name__ == '__main__':
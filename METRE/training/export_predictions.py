@@ -19,19 +19,11 @@ from sklearn.metrics import (
     log_loss,
 )
 
-# Import filter logic and stay-order reconstruction from compile
+# Import stay loading and stay-order reconstruction from compile
 import sys
 sys.path.insert(0, os.path.dirname(__file__))
-from compile_meep_to_npy import (
-    _load_mimic,
-    _get_stay_id_level,
-    _build_stay_arrays,
-    _split_stays,
-    SEED,
-    TRAIN_FRAC,
-    DEV_FRAC,
-    TEST_FRAC,
-)
+from compile_meep_to_npy import _build_stay_arrays, _load_splits
+from ragged_dataset import load_dataset
 
 
 def filter_los(static_data, vitals_data, thresh, gap):
@@ -85,29 +77,18 @@ def flatten_for_sklearn(data_list):
 
 
 def get_test_stay_ids_and_data(input_dir, data_path, database="MIMIC"):
-    """Reconstruct test stay IDs and verify they match compiled data."""
-    vital, inv, static = _load_mimic(input_dir) if database == "MIMIC" else (
-        __import__("compile_meep_to_npy")._load_eicu(input_dir)
-    )
-    stay_level_name = "stay_id" if database == "MIMIC" else "patientunitstayid"
-    stay_ids = set(vital.index.get_level_values(stay_level_name).unique())
-
-    # Same split as compile (must use list(stay_ids) to match compile's permutation order)
-    np.random.seed(SEED)
-    perm = np.random.permutation(list(stay_ids))
-    N = len(perm)
-    n_train = int(TRAIN_FRAC * N)
-    n_dev = int(DEV_FRAC * N)
-    test_stay = set(perm[n_train + n_dev :])
-
-    vital_test = vital[vital.index.get_level_values(stay_level_name).isin(test_stay)]
-    inv_test = inv[inv.index.get_level_values(stay_level_name).isin(test_stay)]
-
-    head_list, order = _build_stay_arrays(vital_test, inv_test, database)
-    test_stay_ids = order  # same order as test_head in compiled .npy
-
-    # Verify compiled data matches
-    data = np.load(data_path, allow_pickle=True).item()
+    """Test stay IDs in the order of test_head, the compiled data and the static table."""
+    splits = _load_splits(input_dir, database)
+    _, static, _ = next(splits)
+    data = load_dataset(data_path)
+    if "test_stay_ids" in data:
+        return list(data["test_stay_ids"]), data, static
+
+    # Older .npy files do not store stay ids, rebuild the test split as compile does and verify it
+    test_blocks = [(vital, inv) for split, vital, inv in splits if split == "test"]
+    vital_test = pd.concat([vital for vital, _ in test_blocks])
+    inv_test = pd.concat([inv for _, inv in test_blocks])
+    head_list, test_stay_ids = _build_stay_arrays(vital_test, inv_test, database)
     test_head = data["test_head"]
     assert len(test_head) == len(test_stay_ids), "Mismatch: compiled test size vs reconstructed"
     for i in range(min(5, len(test_head))):
@@ -118,7 +99,7 @@ def get_test_stay_ids_and_data(input_dir, data_path, database="MIMIC"):
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--data_path", type=str, default=os.path.join(os.path.dirname(__file__), "..", "output", "MIMIC_compile.npy"))
+    parser.add_argument("--data_path", type=str, default=os.path.join(os.path.dirname(__file__), "..", "output", "MIMIC_compile"))
     parser.add_argument("--input_dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "output"))
     parser.add_argument("--models_dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "output", "benchmarks", "models"))
     parser.add_argument("--output_path", type=str, default=os.path.join(os.path.dirname(__file__), "..", "output", "benchmarks", "test_predictions.csv"))
@@ -6,17 +6,12 @@ import argparse
 import json
 import os
 from tqdm import tqdm
-import importlib
 import models
 import prepare_data
 import make_optimizer
 import utils
 import loss_fn
-importlib.reload(models)
-importlib.reload(make_optimizer)
-importlib.reload(prepare_data)
-importlib.reload(utils)
-importlib.reload(loss_fn)
+from ragged_dataset import load_dataset
 from sklearn.model_selection import KFold
 from sklearn.metrics import roc_auc_score
 from sklearn.metrics import average_precision_score
@@ -169,7 +164,7 @@ if __name__ == "__main__":
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     task_map = {0: 'hosp_mort', 1: 'ARF', 2: 'shock'}
     # load data
-    data_label = np.load(args.dataset_path, allow_pickle=True).item()
+    data_label = load_dataset(args.dataset_path)
     train_head = data_label['train_head']
     static_train_filter = data_label['static_train_filter']
     dev_head = data_label['dev_head']
@@ -180,7 +175,7 @@ if __name__ == "__main__":
     s_dev = np.stack(static_dev_filter, axis=0)
     s_test = np.stack(static_test_filter, axis=0)
     # load cross validation data from the other database
-    data_label = np.load(args.dataset_path_cv, allow_pickle=True).item()
+    data_label = load_dataset(args.dataset_path_cv)
     etrain_head = data_label['train_head']
     estatic_train_filter = data_label['static_train_filter']
     edev_head = data_label['dev_head']
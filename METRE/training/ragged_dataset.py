@@ -0,0 +1,190 @@
+"""
+Memory-mappable ragged dataset format for the compiled training data.
+
+A compiled dataset is a directory with, for every split:
+
+    <split>.values         raw float32 buffer of shape (rows, n_features), the hours of all stays back to back
+    <split>_offsets.npy    int64 (n_stays + 1,), stay i is rows offsets[i]:offsets[i + 1]
+    <split>_stay_ids.npy   stay id of every stay
+    <split>_static.npy     float32 (n_stays, n_static), static labels in the order of meta.json 'static_columns'
+
+and a meta.json written last, so a directory without it is an interrupted compile. The buffers are opened
+with np.memmap: loading reads no data, processes training on the same file share its pages through the
+OS cache, and a stay is a zero-copy (n_features, n_hours) view.
+"""
+import json
+import os
+import shutil
+from collections.abc import Sequence
+
+import numpy as np
+
+FORMAT = 'metre-ragged'
+VERSION = 1
+DTYPE = np.float32
+
+
+class RaggedSplit(Sequence):
+    """
+    Stays of one split as a sequence of (n_features, n_hours) arrays.
+
+    Every item is a transposed view of the rows of the stay in the shared buffer, nothing is copied.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @property
+    def lengths(self):
+        """Number of hours of every stay."""
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f'stay {i} out of range for {len(self)} stays')
+        return self.values[self.offsets[i]:self.offsets[i + 1]].T
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+
+class DatasetWriter:
+    """
+    Write a ragged dataset one block of stays at a time.
+
+    :param path: output directory, replaced if it exists
+    :param static_columns: names of the static columns
+    :param n_features: number of features per hour, taken from the first block if not given
+    :param splits: splits the dataset has, written even if no stay of them is added
+    """
+
+    def __init__(self, path, static_columns, n_features=None, splits=('train', 'dev', 'test')):
+        self.path = path
+        self.n_features = n_features
+        self.static_columns = list(static_columns)
+        self.splits = list(splits)
+        self.meta = None
+        self._splits = {}
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    def add(self, split, values, lengths, stay_ids, static):
+        """
+        Append stays to a split.
+
+        :param split: split name
+        :param values: (rows, n_features) array, the hours of the stays back to back
+        :param lengths: number of rows of every stay
+        :param stay_ids: id of every stay
+        :param static: (n_stays, n_static) static labels
+        """
+        values = np.ascontiguousarray(values, dtype=DTYPE)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if self.n_features is None and values.ndim == 2:
+            self.n_features = values.shape[1]
+        if values.ndim != 2 or values.shape[1] != self.n_features:
+            raise ValueError(f'values of shape {values.shape} do not have {self.n_features} features')
+        if lengths.sum() != len(values):
+            raise ValueError(f'stay lengths add up to {lengths.sum()} rows, values have {len(values)}')
+        state = self._splits.setdefault(split, {'lengths': [], 'stay_ids': [], 'static': []})
+        with open(os.path.join(self.path, f'{split}.values'), 'ab') as f:
+            f.write(values.tobytes())
+        state['lengths'].append(lengths)
+        state['stay_ids'].append(np.asarray(stay_ids))
+        state['static'].append(np.asarray(static, dtype=DTYPE).reshape(len(lengths), len(self.static_columns)))
+
+    def close(self):
+        """Write the offsets, stay ids and static labels of every split, then meta.json."""
+        splits = {}
+        for split in self.splits + [s for s in self._splits if s not in self.splits]:
+            state = self._splits.get(split)
+            if state is None:
+                # no stay of the split was added: empty buffer, offsets [0] and a (0, n_static) static table
+                open(os.path.join(self.path, f'{split}.values'), 'wb').close()
+                state = {'lengths': [np.zeros(0, np.int64)], 'stay_ids': [np.zeros(0, np.int64)],
+                         'static': [np.zeros((0, len(self.static_columns)), DTYPE)]}
+            lengths = np.concatenate(state['lengths'])
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(os.path.join(self.path, f'{split}_offsets.npy'), offsets)
+            np.save(os.path.join(self.path, f'{split}_stay_ids.npy'), np.concatenate(state['stay_ids']))
+            np.save(os.path.join(self.path, f'{split}_static.npy'), np.concatenate(state['static']))
+            splits[split] = {'stays': len(lengths), 'rows': int(offsets[-1])}
+        self.meta = {'format': FORMAT, 'version': VERSION, 'dtype': np.dtype(DTYPE).name,
+                     'n_features': self.n_features, 'static_columns': self.static_columns, 'splits': splits}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def save_dataset(path, data, splits=('train', 'dev', 'test')):
+    """
+    Write a compiled dataset held in memory.
+
+    :param path: output directory
+    :param data: dict with {split}_head (list of (n_features, n_hours) arrays), static_{split}_filter,
+        {split}_stay_ids and static_columns
+    :param splits: splits to write
+    """
+    n_features = next(len(h) for s in splits for h in data[f'{s}_head'][:1])
+    with DatasetWriter(path, data['static_columns'], n_features) as writer:
+        for split in splits:
+            head = data[f'{split}_head']
+            values = np.concatenate([h.T for h in head]) if len(head) else np.empty((0, n_features), DTYPE)
+            writer.add(split, values, [h.shape[1] for h in head], data[f'{split}_stay_ids'],
+                       np.reshape(data[f'static_{split}_filter'], (len(head), -1)))
+
+
+def _open_values(path, rows, n_features, mmap):
+    if rows == 0:
+        return np.empty((0, n_features or 0), DTYPE)
+    if mmap:
+        return np.memmap(path, dtype=DTYPE, mode='r', shape=(rows, n_features))
+    return np.fromfile(path, dtype=DTYPE).reshape(rows, n_features)
+
+
+def load_dataset(path, mmap=True):
+    """
+    Open a compiled dataset.
+
+    :param path: ragged dataset directory, or a legacy pickled .npy file
+    :param mmap: memory-map the buffers instead of reading them
+    :return: dict with {split}_head (RaggedSplit), static_{split}_filter ((n_stays, n_static) array),
+        {split}_stay_ids and static_columns; a legacy file is returned as saved
+    """
+    if os.path.isfile(path):
+        return np.load(path, allow_pickle=True).item()
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(f'{path} is not a compiled dataset (no meta.json), run compile_meep_to_npy.py')
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT or meta.get('version') != VERSION:
+        raise ValueError(f'{path}: unsupported format {meta.get("format")} version {meta.get("version")}')
+    mmap_mode = 'r' if mmap else None
+    data = {'static_columns': meta['static_columns']}
+    for split, info in meta['splits'].items():
+        values = _open_values(os.path.join(path, f'{split}.values'), info['rows'], meta['n_features'], mmap)
+        offsets = np.load(os.path.join(path, f'{split}_offsets.npy'))
+        data[f'{split}_head'] = RaggedSplit(values, offsets)
+        data[f'static_{split}_filter'] = np.load(os.path.join(path, f'{split}_static.npy'), mmap_mode=mmap_mode)
+        data[f'{split}_stay_ids'] = np.load(os.path.join(path, f'{split}_stay_ids.npy'), allow_pickle=True)
+    return data
@@ -2,7 +2,7 @@
 Run LR and RF benchmark models on compiled MEEP data.
 
 Usage:
-    python run_benchmarks_lr_rf.py --data_path ../output/MIMIC_compile.npy --output_dir ../output/benchmarks
+    python run_benchmarks_lr_rf.py --data_path ../output/MIMIC_compile --output_dir ../output/benchmarks
 
 Saves: trained models (.joblib), results (CSV, JSON), and test predictions CSV to output_dir.
 Requires: scikit-learn, numpy.
@@ -16,6 +16,9 @@ from datetime import datetime
 
 import numpy as np
 import joblib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from run_report import RunReport, stage
+from ragged_dataset import load_dataset
 from sklearn.model_selection import KFold, cross_val_score
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
@@ -71,8 +74,8 @@ def flatten_for_sklearn(data_list):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_path", type=str,
-                        default=os.path.join(os.path.dirname(__file__), "..", "output", "MIMIC_compile.npy"),
-                        help="Path to MIMIC_compile.npy (from compile_meep_to_npy.py)")
+                        default=os.path.join(os.path.dirname(__file__), "..", "output", "MIMIC_compile"),
+                        help="Path to the compiled dataset (from compile_meep_to_npy.py)")
     parser.add_argument("--output_dir", type=str,
                         default=os.path.join(os.path.dirname(__file__), "..", "output", "benchmarks"),
                         help="Directory for saved models and results")
@@ -86,8 +89,14 @@ def main():
     if not os.path.exists(data_path):
         print(f"Error: {data_path} not found. Run compile_meep_to_npy.py first.")
         return 1
+    with RunReport('benchmarks_lr_rf', os.path.join(output_dir, 'reports')):
+        return run_benchmarks(args, data_path, output_dir, models_dir)
 
-    data = np.load(data_path, allow_pickle=True).item()
+
+def run_benchmarks(args, data_path, output_dir, models_dir):
+    with stage('load') as st:
+        data = load_dataset(data_path)
+        st.rows_out = len(data["train_head"]) + len(data["dev_head"]) + len(data["test_head"])
     train_head = data["train_head"]
     dev_head = data["dev_head"]
     test_head = data["test_head"]
@@ -124,18 +133,23 @@ def main():
             dev_data, dev_label = filter_shock(dev_head, thresh, gap)
             test_data, test_label = filter_shock(test_head, thresh, gap)
 
-        X_train = flatten_for_sklearn(train_data)
-        X_test = flatten_for_sklearn(test_data)
-        trainval_data = train_data + dev_data
-        trainval_label = np.concatenate([train_label, dev_label])
-        X_trainval = flatten_for_sklearn(trainval_data)
+        with stage(f'flatten/{task_map[target_idx]}_{thresh}h') as st:
+            X_train = flatten_for_sklearn(train_data)
+            X_test = flatten_for_sklearn(test_data)
+            trainval_data = train_data + dev_data
+            trainval_label = np.concatenate([train_label, dev_label])
+            X_trainval = flatten_for_sklearn(trainval_data)
+            st.output(X_trainval)
 
         for model_name, model in [
             ("LR", LogisticRegression(class_weight="balanced", max_iter=1000, random_state=0, solver="lbfgs")),
             ("RF", RandomForestClassifier(n_estimators=100, class_weight="balanced", random_state=0, n_jobs=args.n_jobs)),
         ]:
-            scores = cross_val_score(model, X_trainval, trainval_label, cv=kf, scoring="roc_auc", n_jobs=args.n_jobs)
-            model.fit(X_trainval, trainval_label)
+            with stage(f'fit/{task_map[target_idx]}_{thresh}h/{model_name}') as st:
+                scores = cross_val_score(model, X_trainval, trainval_label, cv=kf, scoring="roc_auc",
+                                         n_jobs=args.n_jobs)
+                model.fit(X_trainval, trainval_label)
+                st.input(X_trainval)
             test_auc = roc_auc_score(test_label, model.predict_proba(X_test)[:, 1])
             test_ap = average_precision_score(test_label, model.predict_proba(X_test)[:, 1])
             task_name = f"{task_map[target_idx]}_{thresh}h_gap{gap}h"
@@ -183,7 +197,8 @@ def main():
         "--population_path", os.path.join(output_dir, "test_population_summary.csv"),
     ]
     print(f"\nExporting test predictions...")
-    ret = subprocess.run(export_cmd)
+    with stage('export_predictions'):
+        ret = subprocess.run(export_cmd)
     if ret.returncode != 0:
         print(f"Warning: export_predictions.py exited with code {ret.returncode}")
     else:
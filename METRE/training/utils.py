@@ -1,36 +1,37 @@
+import copy
 import torch
 from torch.autograd import Variable
 import torch.nn as nn
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 import numpy as np
 import sklearn.metrics as metrics
 from sklearn.metrics import roc_auc_score
-
-import importlib
 import loss_fn
-import models
 
-importlib.reload(models)
-importlib.reload(loss_fn)
-import copy
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 ce_loss = nn.CrossEntropyLoss()
 softmax = torch.nn.Softmax(dim=1)
 f_sm = nn.Softmax(dim=1)
 
-import matplotlib
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-matplotlib.rcParams["figure.dpi"] = 100
-matplotlib.rcParams["figure.dpi"] = 300
-plt.style.use('bmh')
-plt.rcParams["font.weight"] = "bold"
-plt.rcParams["axes.labelweight"] = "bold"
 legend_properties = {'weight': 'bold', 'size': 10}
 
 
+def _pyplot():
+    '''
+    matplotlib.pyplot with the plot style of this module, imported and styled on the first plot only
+    :return: matplotlib.pyplot module
+    '''
+    import matplotlib
+    import matplotlib.pyplot as plt
+    if not getattr(_pyplot, 'styled', False):
+        matplotlib.rcParams["figure.dpi"] = 300
+        plt.style.use('bmh')
+        plt.rcParams["font.weight"] = "bold"
+        plt.rcParams["axes.labelweight"] = "bold"
+        _pyplot.styled = True
+    return plt
+
+
 def cal_acc(pred, label):
     '''
 
@@ -217,6 +218,8 @@ def plot_confusion_matrix(y_list, y_pred_list, title='Confusion matrix', label_x
         xlabel = ['Pred-%d' % i for i in range(num_class)]
         ylabel = ['%d' % i for i in range(num_class)]
 
+    plt = _pyplot()
+    import seaborn as sns
     sns.set(font_scale=1.5)
 
     hm = sns.heatmap(cf_matrix, annot=labels, fmt='', cmap='OrRd', \
@@ -250,6 +253,8 @@ def plot_confusion_matrix_cpu(y_list, y_pred_list, title='Confusion matrix', lab
         xlabel = ['Pred-%d' % i for i in range(num_class)]
         ylabel = ['%d' % i for i in range(num_class)]
 
+    plt = _pyplot()
+    import seaborn as sns
     sns.set(font_scale=1.5)
 
     hm = sns.heatmap(cf_matrix, annot=labels, fmt='', cmap='OrRd', \
@@ -270,6 +275,7 @@ def plot_auprc(y_list, y_pred_list):
     '''
     binary_label = torch.concat(y_list).detach().cpu().numpy()
     binary_outputs = softmax(torch.concat(y_pred_list)).detach().cpu().numpy()
+    plt = _pyplot()
     metrics.PrecisionRecallDisplay.from_predictions(binary_label, binary_outputs[:, 1])
 
     no_skill = len(binary_label[binary_label == 1]) / len(binary_label)
@@ -289,6 +295,7 @@ def plot_roc(y_list, y_pred_list):
     '''
     binary_label = torch.concat(y_list).detach().cpu().numpy()
     binary_outputs = softmax(torch.concat(y_pred_list)).detach().cpu().numpy()
+    plt = _pyplot()
     metrics.RocCurveDisplay.from_predictions(binary_label, binary_outputs[:, 1])
 
     plt.plot([0, 1], [0, 1], linestyle='--', label='No Skill')